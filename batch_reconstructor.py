@@ -0,0 +1,146 @@
+from multiprocessing import Pool, cpu_count
+from time import time
+from Bio import SeqIO
+from network_reconstructor import standard_processing, consensus_graph, \
+	permute_edges
+
+import os
+import pickle
+import random
+
+SEQUENCE_FILENAME = 'Run %s Simulation Segment %s Sequences.fasta'
+NETWORK_FILENAME = 'Run %s Reconstructed Transmission Tree.gpickle'
+NULL_NETWORK_FILENAME = 'Run %s Reconstructed Null Transmission Tree.gpickle'
+
+def run_filenames(run_number, sequence_directory, network_directory, \
+	num_segments=2):
+	"""
+	This function returns the input FASTA files (one per segment) and the
+	output gpickle files (the reconstructed and the null network) of a run.
+	"""
+	inputs = [os.path.join(sequence_directory, SEQUENCE_FILENAME % \
+		(run_number, segment)) for segment in range(num_segments)]
+	outputs = [os.path.join(network_directory, filename % run_number) for \
+		filename in (NETWORK_FILENAME, NULL_NETWORK_FILENAME)]
+
+	return inputs, outputs
+
+def is_up_to_date(inputs, outputs):
+	"""
+	This function checks whether all of the outputs of a run exist, and are
+	newer than all of its inputs.
+	"""
+	if not all(os.path.exists(filename) for filename in outputs):
+		return False
+
+	newest_input = max(os.path.getmtime(filename) for filename in inputs)
+	oldest_output = min(os.path.getmtime(filename) for filename in outputs)
+
+	return oldest_output > newest_input
+
+def write_gpickle(graph, filename):
+	"""
+	This function writes a graph in the format of nx.write_gpickle. The graph
+	is written to a temporary file that is then renamed, so that a run that is
+	interrupted never leaves behind a partial gpickle that looks up to date.
+	"""
+	temporary_filename = filename + '.tmp'
+	with open(temporary_filename, 'wb') as handle:
+		pickle.dump(graph, handle, pickle.HIGHEST_PROTOCOL)
+	os.replace(temporary_filename, filename)
+
+def reconstruct_run(task):
+	"""
+	This function reconstructs the transmission network of one run from its
+	segment FASTA files, writes it and its null network, and returns the run
+	number and the wall time that it took.
+
+	It runs in a worker process; it can also be called directly.
+	"""
+	run_number, inputs, outputs, seed, min_segments = task
+	start = time()
+
+	# The null network is a random permutation. Each run gets its own seed,
+	# so that forked workers do not share their random streams.
+	if seed is None:
+		random.seed()
+	else:
+		random.seed('%s %s' % (seed, run_number))
+
+	graphs = []
+	for segment, filename in enumerate(inputs):
+		records = [record for record in SeqIO.parse(filename, 'fasta')]
+		graphs.append(standard_processing(records, segment=segment))
+
+	G_all = consensus_graph(graphs, min_segments=min_segments)
+	write_gpickle(G_all, outputs[0])
+
+	# Create "null" networks.
+	G_null = permute_edges(G_all)
+	write_gpickle(G_null, outputs[1])
+
+	return run_number, time() - start
+
+def reconstruct_runs(sequence_directory, network_directory, \
+	run_numbers=range(500), num_workers=None, seed=None, force=False, \
+	num_segments=2, min_segments=None):
+	"""
+	This function reconstructs the transmission networks of a batch of runs,
+	spread across a pool of worker processes, and reports the wall time of
+	each run as it finishes.
+
+	Runs whose output gpickles are newer than their input FASTA files are
+	skipped, unless force is True, so that an interrupted batch resumes
+	where it stopped.
+
+	INPUTS:
+	-	num_workers: the number of worker processes. Defaults to the number of
+		CPUs; if it is 1, the runs are reconstructed in the main process.
+	-	seed: the seed of the null network permutations. If it is None, they
+		are not reproducible.
+	-	num_segments: the number of segment FASTA files of each run.
+	-	min_segments: the number of segments in which an edge must be present
+		to be kept (see network_reconstructor.consensus_graph). Defaults to
+		all of them.
+
+	Returns: a dictionary of the wall time of each run that was
+	reconstructed.
+	"""
+	tasks = []
+	for run_number in run_numbers:
+		inputs, outputs = run_filenames(run_number, sequence_directory, \
+			network_directory, num_segments=num_segments)
+		if not force and is_up_to_date(inputs, outputs):
+			print('Run %s is up to date, skipping' % run_number)
+		else:
+			tasks.append((run_number, inputs, outputs, seed, min_segments))
+
+	print('Reconstructing %s of %s runs' % (len(tasks), len(run_numbers)))
+
+	wall_times = dict()
+	start = time()
+
+	pool = None
+	if num_workers == 1:
+		results = map(reconstruct_run, tasks)
+	else:
+		pool = Pool(processes=num_workers or cpu_count())
+		results = pool.imap_unordered(reconstruct_run, tasks)
+
+	try:
+		for run_number, wall_time in results:
+			wall_times[run_number] = wall_time
+			print('Run %s reconstructed in %.2f s' % (run_number, wall_time))
+	except BaseException:
+		if pool is not None:
+			pool.terminate()
+		raise
+	finally:
+		if pool is not None:
+			pool.close()
+			pool.join()
+
+	print('Reconstructed %s runs in %.2f s' % (len(wall_times), \
+		time() - start))
+
+	return wall_times
@@ -0,0 +1,476 @@
+import json
+import os
+import pickle
+import random
+
+import numpy as np
+
+from id_generator import IdAllocator, get_allocator, set_allocator, as_id
+from population import ArrayPopulation, GenotypePopulation
+from indexed_set import IndexedSet
+
+# The version of the checkpoint format.
+FORMAT_VERSION = 1
+
+# The ways in which a host can keep its viruses.
+POPULATION_KINDS = ('list', 'array', 'genotype')
+
+# The indexes of host states that are kept by each Environment. Their order 
+# determines the order in which hosts are stepped, so it is saved too.
+HOST_STATES = ('infected', 'uninfected', 'naive', 'dead')
+
+# The population columns with one entry per virus (as opposed to one entry 
+# per mutation).
+VIRUS_COLUMNS = ('ids', 'parents', 'creation_dates', 'template_indices', \
+	'counts')
+
+GENEALOGY_COLUMNS = ('ids', 'parents', 'hosts', 'creation_times')
+GENEALOGY_MUTATION_COLUMNS = ('mutation_ids', 'mutation_segments', \
+	'mutation_positions', 'mutation_letters')
+
+class CheckpointState(object):
+	"""
+	The CheckpointState records what the last checkpoint of a Controller
+	contains, so that the next checkpoint can be written incrementally.
+
+	----------
+
+	ATTRIBUTES
+
+	- STRING: filename
+		the file of the last checkpoint.
+
+	- DICTIONARY: host_versions
+		the version (see Host.update_state) of each host, by host ID, at the
+		time its state was last written.
+
+	- LIST: templates
+		the table of all templates that have been written, and a dictionary
+		template_indices from the key of each template to its position.
+
+	- TUPLE: genealogy_lengths
+		the numbers of virus rows and of mutation rows of the genealogy that
+		have been written.
+
+	- DICTIONARY: networks
+		the version (see ContactNetwork) of the contact network of each
+		environment, by environment ID, at the time it was last written.
+	"""
+
+	def __init__(self, filename):
+		super(CheckpointState, self).__init__()
+
+		self.filename = filename
+		self.host_versions = dict()
+		self.templates = []
+		self.template_indices = dict()
+		self.genealogy_lengths = (0, 0)
+		self.networks = dict()
+
+	def __repr__(self):
+		return "CheckpointState of %s" % self.filename
+
+	def fork(self, filename):
+		"""
+		This method returns a copy of the state, for the checkpoint that is
+		written next.
+		"""
+		state = CheckpointState(filename)
+		state.host_versions = dict(self.host_versions)
+		state.templates = list(self.templates)
+		state.template_indices = dict(self.template_indices)
+		state.genealogy_lengths = self.genealogy_lengths
+		state.networks = dict(self.networks)
+
+		return state
+
+def population_kind(host):
+	if isinstance(host.viruses, GenotypePopulation):
+		return POPULATION_KINDS.index('genotype')
+	elif isinstance(host.viruses, ArrayPopulation):
+		return POPULATION_KINDS.index('array')
+	else:
+		return POPULATION_KINDS.index('list')
+
+def population_arrays(host):
+	"""
+	This function returns the ArrayPopulation of a host. The viruses of a host
+	that keeps Virus objects are converted into a temporary ArrayPopulation.
+	"""
+	if isinstance(host.viruses, ArrayPopulation):
+		return host.viruses
+
+	population = ArrayPopulation()
+	population.add_viruses(host.viruses)
+
+	return population
+
+def pack_bytes(obj):
+	return np.frombuffer(pickle.dumps(obj, protocol=2), dtype=np.uint8)
+
+def unpack_bytes(array):
+	return pickle.loads(array.tobytes())
+
+def concatenate(arrays, dtype):
+	if len(arrays) == 0:
+		return np.zeros(0, dtype=dtype)
+
+	return np.concatenate(arrays).astype(dtype)
+
+def save_checkpoint(controller, filename, incremental=True):
+	"""
+	This function writes the state of a controller into a compressed NumPy
+	(.npz) file of columns.
+
+	If incremental is True and the controller has been checkpointed (or
+	restored from a checkpoint) before, only the state that has changed since
+	then is written: the hosts whose viruses or infection history have
+	changed, the new templates and the new rows of the genealogy. The
+	checkpoint refers to the previous one, which must be kept.
+
+	Returns: the CheckpointState of the new checkpoint.
+	"""
+	previous = getattr(controller, 'checkpoint', None)
+	if incremental and previous is not None:
+		state = previous.fork(filename)
+		base = os.path.relpath(previous.filename, \
+			os.path.dirname(os.path.abspath(filename)))
+	else:
+		state = CheckpointState(filename)
+		base = None
+
+	columns = dict()
+	num_templates = len(state.templates)
+
+	# The environments, and the order of their hosts, are always written.
+	columns['environment_ids'] = np.array([environment.id for environment in \
+		controller.environments], dtype=np.int64)
+	columns['environment_times'] = np.array([environment.current_time for \
+		environment in controller.environments], dtype=np.int64)
+	columns['environment_host_counts'] = np.array([len(environment.hosts) \
+		for environment in controller.environments], dtype=np.int64)
+	columns['environment_host_ids'] = np.array([host.id for environment in \
+		controller.environments for host in environment.hosts], dtype=np.int64)
+	for name in HOST_STATES:
+		columns['environment_%s_counts' % name] = np.array([len(getattr( \
+			environment, name)) for environment in controller.environments], \
+			dtype=np.int64)
+		columns['environment_%s_ids' % name] = np.array([host.id for \
+			environment in controller.environments for host in \
+			getattr(environment, name)], dtype=np.int64)
+
+	# The hosts that have changed since the previous checkpoint.
+	hosts = [host for environment in controller.environments for host in \
+		environment.hosts if state.host_versions.get(host.id) != host.version]
+
+	host_columns = dict((name, []) for name in ('history_times', \
+		'history_sources', 'population_templates') + \
+		GenotypePopulation.columns)
+	row_counts = []
+	for host in hosts:
+		history = sorted(host.infection_history.items(), key=lambda item: \
+			item[0])
+		host_columns['history_times'].append(np.array([time for time, \
+			source in history], dtype=np.float64))
+		host_columns['history_sources'].append(np.array([-1 if source is \
+			None else source.id for time, source in history], dtype=np.int64))
+
+		population = population_arrays(host)
+		template_indices = []
+		for template in population.templates:
+			key = population.template_key(template)
+			if key not in state.template_indices:
+				state.template_indices[key] = len(state.templates)
+				state.templates.append(template)
+			template_indices.append(state.template_indices[key])
+		host_columns['population_templates'].append(np.array( \
+			template_indices, dtype=np.int64))
+
+		arrays = population.to_arrays()
+		if 'counts' not in arrays:
+			arrays['counts'] = np.ones(len(population.ids), dtype=np.int64)
+		for column in GenotypePopulation.columns:
+			host_columns[column].append(arrays[column])
+		row_counts.append((len(history), len(template_indices), \
+			len(population.ids), len(population.mutation_ids)))
+
+		state.host_versions[host.id] = host.version
+
+	columns['host_ids'] = np.array([host.id for host in hosts], \
+		dtype=np.int64)
+	columns['host_versions'] = np.array([host.version for host in hosts], \
+		dtype=np.int64)
+	columns['host_kinds'] = np.array([population_kind(host) for host in \
+		hosts], dtype=np.int64)
+	columns['host_immune_halftimes'] = np.array([host.immune_halftime for \
+		host in hosts], dtype=np.float64)
+	columns['host_max_viruses'] = np.array([host.max_viruses for host in \
+		hosts], dtype=np.int64)
+	columns['host_batched_replication'] = np.array([host.batched_replication \
+		for host in hosts], dtype=bool)
+	columns['host_row_counts'] = np.array(row_counts, dtype=np.int64).reshape( \
+		(len(hosts), 4))
+
+	columns['history_times'] = concatenate(host_columns['history_times'], \
+		np.float64)
+	columns['history_sources'] = concatenate(host_columns['history_sources'], \
+		np.int64)
+	columns['population_templates'] = concatenate( \
+		host_columns['population_templates'], np.int64)
+	for column in GenotypePopulation.columns:
+		dtype = np.uint8 if column == 'mutation_letters' else np.int64
+		columns['population_' + column] = concatenate(host_columns[column], \
+			dtype)
+
+	columns['templates'] = pack_bytes(state.templates[num_templates:])
+
+	# The new rows of the genealogy.
+	genealogy = controller.genealogy
+	if genealogy is not None:
+		num_rows, num_mutations = state.genealogy_lengths
+		for column in GENEALOGY_COLUMNS:
+			columns['genealogy_' + column] = getattr(genealogy, \
+				column).values()[num_rows:]
+		for column in GENEALOGY_MUTATION_COLUMNS:
+			columns['genealogy_' + column] = getattr(genealogy, \
+				column).values()[num_mutations:]
+		state.genealogy_lengths = (len(genealogy.ids), \
+			len(genealogy.mutation_ids))
+
+	# The contact networks that have changed since they were last written.
+	for index, environment in enumerate(controller.environments):
+		network = environment.contact_network
+		if network is None or \
+			state.networks.get(environment.id) == network.version:
+			continue
+		prefix = 'network_%s_' % index
+		columns[prefix + 'indptr'] = network.rates.indptr
+		columns[prefix + 'indices'] = network.rates.indices
+		columns[prefix + 'data'] = network.rates.data
+		columns[prefix + 'hosts'] = np.array([host.id for host in \
+			network.hosts], dtype=np.int64)
+		state.networks[environment.id] = network.version
+
+	allocator = get_allocator()
+	metadata = dict(format_version=FORMAT_VERSION, base=base, \
+		current_time=controller.current_time, \
+		namespace=allocator.namespace, next_counter=allocator.next_counter, \
+		record_genealogy=genealogy is not None, \
+		genealogy_lengths=state.genealogy_lengths)
+	columns['metadata'] = np.frombuffer(json.dumps(metadata).encode('utf-8'), \
+		dtype=np.uint8)
+
+	columns['numpy_random_state'] = pack_bytes(np.random.get_state())
+	columns['python_random_state'] = pack_bytes(random.getstate())
+
+	with open(filename, 'wb') as handle:
+		np.savez_compressed(handle, **columns)
+
+	controller.checkpoint = state
+
+	return state
+
+def read_checkpoint(filename):
+	"""
+	This function reads one checkpoint file, and returns its metadata and its
+	columns.
+	"""
+	with np.load(filename) as data:
+		columns = dict((name, data[name]) for name in data.files)
+
+	metadata = json.loads(columns['metadata'].tobytes().decode('utf-8'))
+	if metadata['format_version'] != FORMAT_VERSION:
+		raise ValueError('Unsupported checkpoint format version %s!' % \
+			metadata['format_version'])
+
+	return metadata, columns
+
+def read_chain(filename):
+	"""
+	This function returns the (filename, metadata, columns) of a checkpoint
+	and of all of the checkpoints that it is based on, oldest first.
+	"""
+	chain = []
+	while filename is not None:
+		metadata, columns = read_checkpoint(filename)
+		chain.append((filename, metadata, columns))
+
+		if metadata['base'] is None:
+			filename = None
+		else:
+			filename = os.path.join(os.path.dirname(os.path.abspath( \
+				filename)), metadata['base'])
+
+	return chain[::-1]
+
+def split(array, counts):
+	return np.split(array, np.cumsum(counts)[:-1]) if len(counts) > 0 else []
+
+def load_checkpoint(filename, controller_class=None):
+	"""
+	This function restores a Controller from a checkpoint, applying the
+	incremental checkpoints that it is based on in order. Further
+	incremental checkpoints of the restored controller are based on this
+	checkpoint, so a run can be forked by restoring the same checkpoint more
+	than once.
+
+	The within-host engine and parallel stepping are not part of the
+	checkpoint, and must be set again.
+	"""
+	from controller import Controller
+	from environment import Environment
+	from host import Host
+	from contact_network import ContactNetwork
+
+	if controller_class is None:
+		controller_class = Controller
+
+	chain = read_chain(filename)
+	state = CheckpointState(filename)
+
+	host_records = dict()
+	networks = dict()
+	genealogy_columns = dict((column, []) for column in GENEALOGY_COLUMNS + \
+		GENEALOGY_MUTATION_COLUMNS)
+
+	for checkpoint_filename, metadata, columns in chain:
+		state.templates.extend(unpack_bytes(columns['templates']))
+
+		counts = columns['host_row_counts']
+		histories = zip(split(columns['history_times'], counts[:, 0]), \
+			split(columns['history_sources'], counts[:, 0]))
+		templates = split(columns['population_templates'], counts[:, 1])
+		rows = dict((column, split(columns['population_' + column], \
+			counts[:, 2 if column in VIRUS_COLUMNS else 3])) for column in \
+			GenotypePopulation.columns)
+
+		for i, (history, template_indices) in enumerate(zip(histories, \
+			templates)):
+			host_records[int(columns['host_ids'][i])] = dict( \
+				version=int(columns['host_versions'][i]), \
+				kind=POPULATION_KINDS[columns['host_kinds'][i]], \
+				immune_halftime=columns['host_immune_halftimes'][i], \
+				max_viruses=int(columns['host_max_viruses'][i]), \
+				batched_replication=bool( \
+				columns['host_batched_replication'][i]), \
+				history=history, templates=template_indices, \
+				arrays=dict((column, rows[column][i]) for column in \
+				GenotypePopulation.columns))
+
+		for column in genealogy_columns:
+			if 'genealogy_' + column in columns:
+				genealogy_columns[column].append(columns['genealogy_' + column])
+
+		for name in columns:
+			if name.startswith('network_') and name.endswith('_indptr'):
+				prefix = name[:-len('indptr')]
+				networks[int(name.split('_')[1])] = dict((part, \
+					columns[prefix + part]) for part in ('indptr', 'indices', \
+					'data', 'hosts'))
+
+	metadata, columns = chain[-1][1], chain[-1][2]
+
+	controller = controller_class(record_genealogy= \
+		metadata['record_genealogy'])
+	controller.current_time = metadata['current_time']
+
+	# Recreate the environments and their hosts, in their original order.
+	hosts = dict()
+	host_ids = split(columns['environment_host_ids'], \
+		columns['environment_host_counts'])
+	for index, environment_id in enumerate(columns['environment_ids']):
+		environment = Environment()
+		environment.id = as_id(environment_id)
+		environment.current_time = int(columns['environment_times'][index])
+		environment.genealogy = controller.genealogy
+		controller.environments.append(environment)
+
+		for host_id in host_ids[index] if len(host_ids) > 0 else []:
+			record = host_records[int(host_id)]
+			host = Host(environment, immune_halftime=record['immune_halftime'], \
+				array_population=record['kind'] != 'list', \
+				batched_replication=record['batched_replication'], \
+				deduplicate_genotypes=record['kind'] == 'genotype')
+			host.id = as_id(host_id)
+			host.max_viruses = record['max_viruses']
+
+			if record['kind'] == 'list':
+				population = ArrayPopulation()
+			else:
+				population = host.viruses
+			population.templates = [state.templates[i] for i in \
+				record['templates']]
+			population.template_keys = dict((population.template_key( \
+				template), i) for i, template in \
+				enumerate(population.templates))
+			population.load_arrays(record['arrays'])
+
+			if record['kind'] == 'list':
+				for virus in population.views(host=host):
+					host.viruses.add(virus)
+
+			hosts[int(host_id)] = host
+			state.host_versions[host.id] = record['version']
+
+	# The infection histories refer to other hosts, so they are restored
+	# once all of the hosts exist.
+	for host_id, host in hosts.items():
+		times, sources = host_records[host_id]['history']
+		for time, source in zip(times, sources):
+			time = int(time) if time == int(time) else float(time)
+			host.infection_history[time] = hosts.get(int(source))
+		host.update_state()
+		host.version = state.host_versions[host.id]
+
+	for name in HOST_STATES:
+		state_ids = split(columns['environment_%s_ids' % name], \
+			columns['environment_%s_counts' % name])
+		for environment, ids in zip(controller.environments, state_ids):
+			setattr(environment, name, IndexedSet([hosts[int(host_id)] for \
+				host_id in ids]))
+
+	for index, network in networks.items():
+		environment = controller.environments[index]
+		positions = dict((host.id, i) for i, host in \
+			enumerate(environment.hosts))
+		order = np.array([positions[host_id] for host_id in \
+			network['hosts']], dtype=np.int64)
+		rates = sparse_matrix(network, order, len(environment.hosts))
+		environment.contact_network = ContactNetwork(environment, rates)
+		state.networks[environment.id] = environment.contact_network.version
+
+	if controller.genealogy is not None:
+		columns_of = dict((column, np.concatenate(arrays) if len(arrays) > 0 \
+			else np.zeros(0, dtype=np.int64)) for column, arrays in \
+			genealogy_columns.items())
+		controller.genealogy.record(columns_of['ids'], columns_of['parents'], \
+			columns_of['hosts'], columns_of['creation_times'], mutations=tuple( \
+			columns_of[column] for column in GENEALOGY_MUTATION_COLUMNS))
+		state.genealogy_lengths = tuple(metadata['genealogy_lengths'])
+
+	for key, template in enumerate(state.templates):
+		state.template_indices[ArrayPopulation().template_key(template)] = key
+
+	allocator = IdAllocator(namespace=metadata['namespace'])
+	allocator.next_counter = metadata['next_counter']
+	set_allocator(allocator)
+
+	np.random.set_state(unpack_bytes(columns['numpy_random_state']))
+	random.setstate(unpack_bytes(columns['python_random_state']))
+
+	controller.checkpoint = state
+
+	return controller
+
+def sparse_matrix(network, order, num_hosts):
+	"""
+	This function rebuilds the rate matrix of a contact network, with its
+	rows and columns permuted into the current order of the hosts.
+	"""
+	from scipy import sparse
+
+	rates = sparse.csr_matrix((network['data'], network['indices'], \
+		network['indptr']), shape=(len(order), len(order))).tocoo()
+
+	return sparse.csr_matrix((rates.data, (order[rates.row], \
+		order[rates.col])), shape=(num_hosts, num_hosts))
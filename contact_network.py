@@ -0,0 +1,210 @@
+import itertools
+
+import networkx as nx
+import numpy as np
+
+from scipy import sparse
+
+# The source of the versions of contact networks, which are unique across
+# all of the networks so that a replaced network never reuses a version.
+_versions = itertools.count()
+
+class ContactNetwork(object):
+	"""
+	The ContactNetwork is a sparse network of contacts between the hosts of
+	an environment, with a contact rate on each edge. At each timestep, it
+	computes the force of infection on every naive host from the infectious
+	hosts that it is in contact with, and draws all of the transmission
+	events at once:
+
+	-	the force of infection on host j is the sum of rates[i, j] over the
+		infectious hosts i, and host j is infected with probability
+		1 - exp(-force of infection);
+	-	the source of each infection is one of the infectious contacts of the
+		infected host, chosen with probability proportional to its contact
+		rate.
+
+	The selected (source, target) pairs are then passed to Host.infect. Only
+	the rows of the infectious hosts are touched, so the cost of a timestep
+	scales with the number of contacts of the infectious hosts, rather than
+	with the number of hosts.
+
+	The Environment keeps the network in step with its hosts: hosts that are
+	added join the network without contacts, and the contacts of hosts that
+	are removed are dropped.
+
+	----------
+
+	ATTRIBUTES
+
+	- LIST: hosts
+		the hosts of the environment, in the order of the rows and columns
+		of the rate matrix.
+
+	- DICTIONARY: positions
+		the position of each host in hosts.
+
+	- SCIPY CSR MATRIX: rates
+		rates[i, j] is the rate at which host i contacts host j.
+
+	- INTEGER: version
+		a number that changes whenever the hosts or the rates change, so that
+		checkpoints know when to write the network again.
+
+	- RANDOM STATE: rng
+		the source of random numbers. Defaults to the numpy.random module.
+	"""
+
+	def __init__(self, environment, network, rate='rate'):
+		"""
+		The network is either a networkx graph, whose nodes are the hosts of
+		the environment (or their positions in environment.hosts), or a scipy
+		sparse matrix with one row and column per host of the environment.
+		The contact rate of an edge of a graph is read from the specified
+		edge attribute; edges without it have a rate of 1. Undirected graphs
+		give symmetric contact rates. Hosts that are not nodes of the graph
+		have no contacts.
+		"""
+		super(ContactNetwork, self).__init__()
+
+		self.environment = environment
+		self.hosts = list(environment.hosts)
+		self.positions = dict((host, i) for i, host in enumerate(self.hosts))
+		self.version = next(_versions)
+
+		self.rng = np.random
+
+		if isinstance(network, nx.Graph):
+			if all(node in self.positions for node in network.nodes()):
+				nodelist = self.hosts
+			else:
+				nodelist = range(len(self.hosts))
+
+			missing = [node for node in nodelist if node not in network]
+			if len(missing) > 0:
+				network = network.copy()
+				network.add_nodes_from(missing)
+
+			rates = nx.to_scipy_sparse_array(network, nodelist=nodelist, \
+				weight=rate, format='csr')
+		elif sparse.issparse(network):
+			rates = network
+		else:
+			raise TypeError('A networkx graph or a scipy sparse matrix must be '
+				'specified!')
+
+		if rates.shape != (len(self.hosts), len(self.hosts)):
+			raise ValueError('The network must have one node per host!')
+
+		self.rates = sparse.csr_matrix(rates, dtype=np.float64)
+
+	def __repr__(self):
+		return "ContactNetwork of %s hosts with %s contacts" % \
+			(len(self.hosts), self.rates.nnz)
+
+	def add_host(self, host):
+		"""
+		This method adds a host to the network, without any contacts. Hosts
+		that are already in the network are left unchanged.
+		"""
+		if host in self.positions:
+			return
+
+		self.positions[host] = len(self.hosts)
+		self.hosts.append(host)
+
+		rates = self.rates.copy()
+		rates.resize((len(self.hosts), len(self.hosts)))
+		self.rates = rates
+		self.version = next(_versions)
+
+	def remove_host(self, host):
+		"""
+		This method removes a host from the network, along with all of its
+		contacts.
+		"""
+		if host not in self.positions:
+			return
+
+		keep = np.ones(len(self.hosts), dtype=bool)
+		keep[self.positions[host]] = False
+
+		self.rates = self.rates[keep][:, keep].tocsr()
+		self.hosts = [other for other in self.hosts if other is not host]
+		self.positions = dict((other, i) for i, other in enumerate(self.hosts))
+		self.version = next(_versions)
+
+	def infectious_indices(self):
+		"""
+		This method returns the positions of the hosts that are infectious
+		and alive. Only the infected hosts of the environment are checked.
+		"""
+		indices = [self.positions[host] for host in self.environment.infected \
+			if host.is_infectious() and not host.is_dead()]
+
+		return np.array(sorted(indices), dtype=np.int64)
+
+	def draw_transmissions(self):
+		"""
+		This method draws the transmission events of one timestep.
+
+		Returns: two arrays with the positions of the source and the target
+		host of each transmission.
+		"""
+		sources = self.infectious_indices()
+		if len(sources) == 0:
+			empty = np.zeros(0, dtype=np.int64)
+			return empty, empty
+
+		# The force of infection on every host that is in contact with an
+		# infectious host.
+		contacts = self.rates[sources]
+		force = np.asarray(contacts.sum(axis=0)).ravel()
+		candidates = np.nonzero(force)[0]
+
+		infected = self.rng.random_sample(len(candidates)) < \
+			-np.expm1(-force[candidates])
+		naive = self.environment.naive
+		targets = np.array([target for target in candidates[infected] if \
+			self.hosts[target] in naive], dtype=np.int64)
+		if len(targets) == 0:
+			return np.zeros(0, dtype=np.int64), targets
+
+		# Choose the source of each infection in proportion to its contact
+		# rate, by inverting the cumulative rates within each column.
+		columns = contacts[:, targets].tocsc()
+		columns.sort_indices()
+		cumulative = np.cumsum(columns.data)
+		starts = columns.indptr[:-1]
+		ends = columns.indptr[1:]
+		offsets = np.concatenate([[0], cumulative])[starts]
+		totals = cumulative[ends - 1] - offsets
+
+		draws = offsets + self.rng.random_sample(len(targets)) * totals
+		chosen = np.searchsorted(cumulative, draws, side='right')
+		chosen = np.minimum(np.maximum(chosen, starts), ends - 1)
+
+		return sources[columns.indices[chosen]], targets
+
+	def transmit(self, bottleneck_mean=10, bottleneck_variance=2):
+		"""
+		This method draws the transmission events of one timestep, and makes
+		each of them happen with Host.infect.
+
+		Infections whose source has run out of viruses (e.g. to earlier
+		infections in the same timestep) do not happen.
+
+		Returns: the number of transmissions that happened.
+		"""
+		sources, targets = self.draw_transmissions()
+
+		num_transmissions = 0
+		for source, target in zip(sources, targets):
+			source_host = self.hosts[source]
+			if len(source_host.viruses) > 0:
+				source_host.infect(self.hosts[target], \
+					bottleneck_mean=bottleneck_mean, \
+					bottleneck_variance=bottleneck_variance)
+				num_transmissions += 1
+
+		return num_transmissions
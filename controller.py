@@ -1,35 +1,86 @@
-from id_generator import generate_id
+from id_generator import generate_id, start_run
+from genealogy import Genealogy
 from random import sample, choice
 from joblib import Parallel, delayed
 
 class Controller(object):
 	"""
 	The controller object is the overall manager for the viral simulation.
+
+	If a run namespace is specified (e.g. the run number), the IDs of all of 
+	the objects created during the run are allocated under that namespace.
+
+	If record_genealogy is True, every virus created in the controller's 
+	environments is recorded in a simulation-wide Genealogy, from which the 
+	ground-truth transmission tree can be exported after the run.
+
+	If a within_host_engine (e.g. a TauLeapingEngine) is specified, it 
+	advances the viruses of each infected host at every timestep, instead of 
+	one cycle of replication.
+
+	Hosts whose viruses are kept in an ArrayPopulation can be stepped in 
+	parallel worker processes, after calling enable_parallel_stepping.
+
+	In environments with a contact network, transmission happens at the end 
+	of every timestep, after replication.
 	"""
-	def __init__(self, environments=None):
+	def __init__(self, environments=None, namespace=None, keep_registry=False, \
+		record_genealogy=False, within_host_engine=None):
 		super(Controller, self).__init__()
+
+		if namespace is not None:
+			start_run(namespace, keep_registry=keep_registry)
+
+		self.genealogy = None
+		if record_genealogy:
+			self.genealogy = Genealogy()
+
+		self.within_host_engine = within_host_engine
+		self.parallel_stepper = None
+
+		self.checkpoint = None
 		
 		self.environments = []
 		self.current_time = 0
 
-	def create_environment(self, num_hosts=0):
+	def create_environment(self, num_hosts=0, array_population=False, \
+		batched_replication=False, deduplicate_genotypes=False):
 		from environment import Environment
-		environment = Environment(num_hosts=num_hosts)
+		environment = Environment(num_hosts=num_hosts, \
+			array_population=array_population, \
+			batched_replication=batched_replication, \
+			deduplicate_genotypes=deduplicate_genotypes)
+		environment.genealogy = self.genealogy
 
 		self.environments.append(environment)
-		# print('Creating environment %s' % environment.id[0:5])
+		# print('Creating environment %s' % environment.id)
 
-	def create_host(self, environment, immune_halftime=2):
+	def create_host(self, environment, immune_halftime=2, \
+		array_population=False, batched_replication=False, \
+		deduplicate_genotypes=False):
 		"""
 		This creates a host inside a specified environment.
+
+		If array_population is True, the host keeps its viruses in an 
+		ArrayPopulation rather than as a list of Virus objects. If 
+		batched_replication is also True, its progeny are generated in batches.
+		If deduplicate_genotypes is True, the host keeps its viruses in a 
+		GenotypePopulation.
 		"""
 		from host import Host
 
-		host = Host(environment=environment, immune_halftime=immune_halftime)
+		host = Host(environment=environment, immune_halftime=immune_halftime, \
+			array_population=array_population, \
+			batched_replication=batched_replication, \
+			deduplicate_genotypes=deduplicate_genotypes)
 
-	def create_hosts(self, environment, num_hosts):
+	def create_hosts(self, environment, num_hosts, array_population=False, \
+		batched_replication=False, deduplicate_genotypes=False):
 		for i in range(num_hosts):
-			self.create_host(environment=environment)
+			self.create_host(environment=environment, \
+				array_population=array_population, \
+				batched_replication=batched_replication, \
+				deduplicate_genotypes=deduplicate_genotypes)
 
 	def create_virus(self, host):
 		"""
@@ -47,14 +98,90 @@ class Controller(object):
 		"""		
 		self.current_time += 1
 
-		for environment in self.environments:
-			environment.current_time += 1
+		if self.parallel_stepper is not None:
+			for environment in self.environments:
+				environment.current_time += 1
+			self.parallel_stepper.step(self.environments)
 
-			for host in environment.infected_hosts():
-				host.allow_one_cycle_of_replication()
+		else:
+			for environment in self.environments:
+				environment.current_time += 1
+
+				for host in environment.infected_hosts():
+					if self.within_host_engine is None:
+						host.allow_one_cycle_of_replication()
+					else:
+						self.within_host_engine.advance(host)
+
+		for environment in self.environments:
+			environment.transmit()
 				
 		return self
 
+	def run_events(self, until=None, transmission_rate=None):
+		"""
+		This method runs the simulation with an event-driven EventScheduler 
+		rather than timestep by timestep, until no infected hosts remain or 
+		until the specified time. Hosts are infected along the contact 
+		networks of the environments or, in environments without one, by 
+		random mixing at the specified transmission rate.
+
+		Returns: the EventScheduler, which can be run further.
+		"""
+		from event_scheduler import EventScheduler
+
+		scheduler = EventScheduler(self, transmission_rate=transmission_rate)
+		scheduler.run(until=until)
+
+		return scheduler
+
+	def save_checkpoint(self, filename, incremental=True):
+		"""
+		This method writes the state of the simulation into a compact, 
+		columnar checkpoint file. After the first checkpoint, only the state 
+		that has changed since the previous checkpoint is written, unless 
+		incremental is False. See checkpoint.save_checkpoint for details.
+		"""
+		from checkpoint import save_checkpoint
+
+		return save_checkpoint(self, filename, incremental=incremental)
+
+	@classmethod
+	def load_checkpoint(cls, filename):
+		"""
+		This method returns a new Controller, restored from a checkpoint file 
+		(and from the checkpoints that it is based on).
+		"""
+		from checkpoint import load_checkpoint
+
+		return load_checkpoint(filename, controller_class=cls)
+
+	def enable_parallel_stepping(self, num_workers=None, seed=0):
+		"""
+		This method makes increment_timestep step the infected hosts in a pool 
+		of num_workers processes (by default, one per CPU). Each host draws 
+		from its own random number stream, derived from the seed, so a run is 
+		reproducible regardless of the number of workers.
+
+		All of the hosts must keep their viruses in an ArrayPopulation.
+		"""
+		from parallel_stepper import ParallelStepper
+
+		self.disable_parallel_stepping()
+		self.parallel_stepper = ParallelStepper(num_workers=num_workers, \
+			seed=seed, engine=self.within_host_engine)
+
+		return self.parallel_stepper
+
+	def disable_parallel_stepping(self):
+		"""
+		This method shuts down the worker processes, and makes 
+		increment_timestep step the hosts serially again.
+		"""
+		if self.parallel_stepper is not None:
+			self.parallel_stepper.close()
+			self.parallel_stepper = None
+
 	def get_hamming_distances(self, viruses):
 		"""
 		THis method returns a list of hamming distances for each virus in a 
@@ -64,6 +191,16 @@ class Controller(object):
 		
 		return distances
 
+	def get_pairwise_hamming_distances(self, viruses):
+		"""
+		This method returns the matrix of Hamming distances between all pairs 
+		of viruses in a list of viruses, computed from their mutation 
+		dictionaries rather than from their full sequences.
+		"""
+		from virus import pairwise_hamming_distances
+
+		return pairwise_hamming_distances(viruses)
+
 	def get_host_virus_population(self, environment):
 		"""
 		This method returns a list of the number of viruses in each host in 
@@ -78,15 +215,14 @@ class Controller(object):
 		This method counts the number of alive hosts that are infected with 
 		viruses.
 		"""
-		infected_hosts = [host for host in environment.hosts if \
-		host.is_infected() == True and host.is_dead() == False]
-
-		return len(infected_hosts)
+		# Dead hosts carry more viruses than their carrying capacity, so they 
+		# are all infected.
+		return len(environment.infected) - len(environment.dead)
 
 	def make_one_infection_happen(self, environment):
-		if len(environment.infected_hosts()) != 0:
-			infected_host = choice(environment.infected_hosts())
-			niave_host = choice(environment.naive_hosts())
+		if len(environment.infected) != 0:
+			infected_host = environment.random_infected_host()
+			niave_host = environment.random_naive_host()
 			infected_host.infect(niave_host)
 		else:
 			pass
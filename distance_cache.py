@@ -0,0 +1,205 @@
+from tempfile import mkstemp
+
+import hashlib
+import os
+
+import numpy as np
+
+class DistanceCache(object):
+	"""
+	The DistanceCache is a persistent, content-addressed cache of the edit
+	distance matrices computed by network_reconstructor, so that
+	reconstructions of the same sequences with different pruning rules or
+	thresholds do not recompute every pair-wise distance.
+
+	Each entry is keyed by a hash of the headers and sequences of a list of
+	SeqRecord objects, in order, and is stored in the cache directory as two
+	.npy files: the distance matrix, which is opened memory-mapped, and the
+	node order (the IDs of its rows and columns).
+
+	New entries are written to uniquely named temporary files in the cache
+	directory, which are renamed into place when they are committed and
+	removed if they are not, so that concurrent writers never share a file.
+
+	The total size of the entries is bounded by max_bytes. Reading an entry
+	marks it as the most recently used, by touching its files; when the cache
+	is over its size, the least recently used entries are removed first.
+
+	----------
+
+	ATTRIBUTES
+
+	- STRING: directory
+		the directory in which the entries are stored.
+
+	- INTEGER: max_bytes
+		the maximum total size of the entries, in bytes.
+	"""
+
+	def __init__(self, directory, max_bytes=2 ** 30):
+		super(DistanceCache, self).__init__()
+
+		self.directory = directory
+		self.max_bytes = max_bytes
+
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+
+	def __repr__(self):
+		return "DistanceCache in %s with %s entries (%s of %s bytes)" % \
+			(self.directory, len(self.keys()), self.num_bytes(), \
+			self.max_bytes)
+
+	def __contains__(self, key):
+		return all(os.path.exists(filename) for filename in self.filenames(key))
+
+	def key(self, records):
+		"""
+		This method returns the key of a list of SeqRecord objects: a hash of
+		their descriptions (i.e. their IDs and dates) and sequences, in order.
+		"""
+		digest = hashlib.sha1()
+		for record in records:
+			digest.update(record.description.encode('utf-8') + b'\n')
+			digest.update(str(record.seq).encode('ascii') + b'\n')
+
+		return digest.hexdigest()
+
+	def filenames(self, key):
+		"""
+		This method returns the files of the distance matrix and of the node
+		order of an entry.
+		"""
+		prefix = os.path.join(self.directory, key)
+
+		return prefix + '.distances.npy', prefix + '.nodes.npy'
+
+	def keys(self):
+		"""
+		This method returns the keys of the entries in the cache.
+		"""
+		return [filename[:-len('.distances.npy')] for filename in \
+			os.listdir(self.directory) if filename.endswith('.distances.npy') \
+			and filename[:-len('.distances.npy')] in self]
+
+	def entry_size(self, key):
+		return sum(os.path.getsize(filename) for filename in \
+			self.filenames(key))
+
+	def num_bytes(self):
+		return sum(self.entry_size(key) for key in self.keys())
+
+	def get(self, key, nodes=None):
+		"""
+		This method returns the distance matrix of an entry, memory-mapped
+		read-only with its stored dtype, and its node order, and marks the
+		entry as the most recently used. If the key is not present, None is
+		returned.
+
+		If nodes is specified, the stored node order is checked against it;
+		an entry whose node order differs is removed, and None is returned.
+		"""
+		if key not in self:
+			return None
+
+		distance_filename, node_filename = self.filenames(key)
+		stored_nodes = [str(node) for node in np.load(node_filename)]
+		if nodes is not None and stored_nodes != [str(node) for node in nodes]:
+			self.remove(key)
+			return None
+
+		distances = np.load(distance_filename, mmap_mode='r')
+		nodes = stored_nodes
+
+		for filename in self.filenames(key):
+			os.utime(filename, None)
+
+		return distances, nodes
+
+	def create(self, key, shape, dtype):
+		"""
+		This method returns a writable, memory-mapped distance matrix for a
+		new entry, so that a large matrix can be computed directly into the
+		cache. The entry is only added when it is committed with commit();
+		a matrix that is not committed must be given to discard().
+		"""
+		handle, filename = mkstemp(prefix=key + '.', suffix='.tmp', \
+			dir=self.directory)
+		os.close(handle)
+
+		try:
+			return np.lib.format.open_memmap(filename, mode='w+', \
+				dtype=dtype, shape=shape)
+		except BaseException:
+			os.remove(filename)
+			raise
+
+	def discard(self, distances):
+		"""
+		This method removes the temporary file of a matrix returned by
+		create() that has not been committed. It does nothing once the matrix
+		has been committed.
+		"""
+		if os.path.exists(distances.filename):
+			os.remove(distances.filename)
+
+	def commit(self, key, distances, nodes):
+		"""
+		This method adds an entry from a matrix returned by create(). Files
+		are renamed into place, so that an interrupted write never leaves
+		behind an entry that looks complete; the temporary files are removed
+		if the commit fails.
+		"""
+		distance_filename, node_filename = self.filenames(key)
+
+		handle, temporary_filename = mkstemp(prefix=key + '.', \
+			suffix='.tmp', dir=self.directory)
+		try:
+			with os.fdopen(handle, 'wb') as node_handle:
+				np.save(node_handle, np.array(nodes, dtype=str))
+			distances.flush()
+			os.replace(temporary_filename, node_filename)
+			os.replace(distances.filename, distance_filename)
+		finally:
+			if os.path.exists(temporary_filename):
+				os.remove(temporary_filename)
+			self.discard(distances)
+
+		self.evict(keep=key)
+
+	def put(self, key, distances, nodes):
+		"""
+		This method adds an entry from an in-memory distance matrix.
+		"""
+		stored = self.create(key, distances.shape, distances.dtype)
+		try:
+			stored[:] = distances
+			self.commit(key, stored, nodes)
+		finally:
+			self.discard(stored)
+
+	def remove(self, key):
+		for filename in self.filenames(key):
+			if os.path.exists(filename):
+				os.remove(filename)
+
+	def evict(self, keep=None):
+		"""
+		This method removes the least recently used entries until the total
+		size of the cache is no larger than max_bytes. The entry with the key
+		keep, if specified, is never removed.
+		"""
+		entries = []
+		for key in self.keys():
+			last_used = max(os.path.getmtime(filename) for filename in \
+				self.filenames(key))
+			entries.append((last_used, key, self.entry_size(key)))
+		entries.sort()
+
+		num_bytes = sum(size for last_used, key, size in entries)
+		for last_used, key, size in entries:
+			if num_bytes <= self.max_bytes:
+				break
+			if key != keep:
+				self.remove(key)
+				num_bytes -= size
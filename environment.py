@@ -4,6 +4,7 @@ from collections import defaultdict
 from numpy.random import normal, binomial
 from host import Host
 from id_generator import generate_id
+from indexed_set import IndexedSet
 import networkx as nx
 
 
@@ -21,40 +22,115 @@ class Environment(object):
 	a host to move from Environment to Environment. This allows one to 
 	simulate the spread of Viruses from one Environment to another, by means 
 	of Hosts moving between them.
+
+	The Environment keeps indexes of its infected, uninfected, naive and dead 
+	hosts as IndexedSets, which the hosts update whenever their viruses or 
+	their infection history change. Therefore, the hosts in each state can be 
+	listed, counted and drawn at random without scanning all of the hosts.
+
+	If a contact network is set with set_contact_network, transmission 
+	follows the contacts between hosts, and happens at every timestep. Hosts 
+	that are added or removed later join or leave the network.
 	"""
 
-	def __init__(self, num_hosts=0):
+	def __init__(self, num_hosts=0, array_population=False, \
+		batched_replication=False, deduplicate_genotypes=False):
 		"""Initialize the environment."""
 		super(Environment, self).__init__()
 
 		self.current_time = 0
 
-		self.id = generate_id()
+		self.genealogy = None
+
+		self.contact_network = None
+
+		self.id = generate_id(self)
 		
 		self.hosts = []
+
+		self.infected = IndexedSet()
+		self.uninfected = IndexedSet()
+		self.naive = IndexedSet()
+		self.dead = IndexedSet()
+
 		for i in range(num_hosts):
-			self.create_host()
+			self.create_host(array_population=array_population, \
+				batched_replication=batched_replication, \
+				deduplicate_genotypes=deduplicate_genotypes)
 
 	def __repr__(self):
-		return "Environment %s... with %s hosts." % \
-		(self.id[0:5], len(self.hosts))
+		return "Environment %s with %s hosts." % \
+		(str(self.id), len(self.hosts))
 
-	def create_host(self):
+	def create_host(self, array_population=False, batched_replication=False, \
+		deduplicate_genotypes=False):
 		from host import Host
 
-		h = Host(self)
+		h = Host(self, array_population=array_population, \
+			batched_replication=batched_replication, \
+			deduplicate_genotypes=deduplicate_genotypes)
 
 		return h
 
+	def set_contact_network(self, network, rate='rate'):
+		"""
+		This method sets the sparse network of contacts between the hosts of 
+		the environment, as a networkx graph (with the contact rates as the 
+		specified edge attribute) or as a scipy sparse matrix of contact 
+		rates. See ContactNetwork for details.
+		"""
+		from contact_network import ContactNetwork
+
+		self.contact_network = ContactNetwork(self, network, rate=rate)
+
+		return self.contact_network
+
+	def transmit(self):
+		"""
+		This method makes the transmission events of one timestep happen 
+		along the contact network, if there is one.
+
+		Returns: the number of transmissions.
+		"""
+		if self.contact_network is None:
+			return 0
+
+		return self.contact_network.transmit()
+
 	def add_host(self, host):
 		from host import Host
 
 		if isinstance(host, Host):
 			self.hosts.append(host)
-			# print('Adding host %s... to environment %s...' % (host.id[0:5], self.id[0:5]))
+			self.update_host_state(host)
+			if self.contact_network is not None:
+				self.contact_network.add_host(host)
+			# print('Adding host %s to environment %s' % (host.id, self.id))
 		else:
 			raise TypeError('A Host object must be specified!')
 
+	def update_host_state(self, host):
+		"""
+		This method updates the indexes of infected, uninfected, naive and 
+		dead hosts for one host.
+		"""
+		infected = len(host.viruses) > 0
+		states = [(self.infected, infected), (self.uninfected, not infected), \
+			(self.naive, not host.was_infected()), (self.dead, host.is_dead())]
+
+		for hosts, in_state in states:
+			if in_state:
+				hosts.add(host)
+			else:
+				hosts.discard(host)
+
+	def forget_host(self, host):
+		"""
+		This method removes a host from the indexes of host states.
+		"""
+		for hosts in (self.infected, self.uninfected, self.naive, self.dead):
+			hosts.discard(host)
+
 	def remove_host(self, host):
 		"""
 		This method removes a particular host from the environment.
@@ -63,23 +139,39 @@ class Environment(object):
 
 		if isinstance(host, Host):
 			self.hosts.pop(self.hosts.index(host))
-			print('Removing host %s... from environment %s' % (host.id[0:5], self.id[0:5]))
+			print('Removing host %s from environment %s' % (host.id, self.id))
 		elif type(host) == int:
-			self.hosts.pop(host)
+			host = self.hosts.pop(host)
 		else:
 			raise TypeError('A Host object or an integer must be specified!')
 
+		self.forget_host(host)
+		if self.contact_network is not None:
+			self.contact_network.remove_host(host)
+
 	def infected_hosts(self):
 		"""
-		This method 
+		This method returns a list of the hosts that carry viruses.
 		"""
-		infected_hosts = [host for host in self.hosts if len(host.viruses) > 0]
-		return infected_hosts
+		return list(self.infected)
 
 	def uninfected_hosts(self):
-		uninfected_hosts = [host for host in self.hosts if len(host.viruses) == 0]
-		return uninfected_hosts
+		return list(self.uninfected)
 
 	def naive_hosts(self):
-		naive_hosts = [host for host in self.hosts if host.was_infected() == False]
-		return naive_hosts
+		return list(self.naive)
+
+	def dead_hosts(self):
+		return list(self.dead)
+
+	def random_infected_host(self):
+		"""
+		This method returns an infected host, chosen uniformly at random.
+		"""
+		return self.infected.choice()
+
+	def random_naive_host(self):
+		"""
+		This method returns a naive host, chosen uniformly at random.
+		"""
+		return self.naive.choice()
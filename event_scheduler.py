@@ -0,0 +1,293 @@
+from heapq import heappush, heappop
+from itertools import count
+from math import floor
+
+import numpy as np
+
+from indexed_set import IndexedSet
+
+class EventScheduler(object):
+	"""
+	The EventScheduler runs a simulation as a sequence of events, in the
+	style of the Gibson-Bruck next-reaction method, instead of walking every
+	environment and host at every timestep. It keeps a priority queue with
+	the next event time of each of the following:
+
+	-	replication: each infected host replicates once per generation, at
+		integer times, starting one generation after it was infected. A host
+		that has cleared its viruses, or that has died, has no more
+		replication events.
+	-	transmission along a contact network: each infectious host i is a
+		channel, whose propensity is the sum of its contact rates to naive
+		hosts. When it fires, one of those naive hosts is infected, chosen in
+		proportion to its contact rate.
+	-	transmission by random mixing: in an environment without a contact
+		network, if a transmission_rate is specified, a single channel with
+		propensity transmission_rate * I * S / N infects a random naive host
+		from a random infectious host, where I, S and N are the numbers of
+		infectious, naive and all hosts.
+
+	Transmission times are continuous. As in Gibson & Bruck (2000), when the
+	propensity of a channel changes from a to a', its putative time t' is
+	rescaled to now + (a / a') * (t' - now) instead of being drawn again; a
+	channel whose propensity drops to zero is removed, and is given a fresh
+	exponential time when it becomes active again.
+
+	Events only touch the hosts that they involve (and, for contact networks,
+	the infectious contacts of a newly infected host). The environments'
+	current_time is the last generation that has started, so a host that is
+	infected between generations t and t + 1 first replicates at t + 1, as
+	with Controller.make_one_infection_happen and increment_timestep.
+
+	The run stops when no events remain, i.e. when no infected hosts remain.
+	"""
+
+	def __init__(self, controller, transmission_rate=None, \
+		bottleneck_mean=10, bottleneck_variance=2):
+		super(EventScheduler, self).__init__()
+
+		self.controller = controller
+		self.transmission_rate = transmission_rate
+		self.bottleneck_mean = bottleneck_mean
+		self.bottleneck_variance = bottleneck_variance
+
+		self.rng = np.random
+
+		self.time = float(controller.current_time)
+		self.num_events = 0
+
+		self.queue = []
+		self.counter = count()
+		self.scheduled = dict()
+		self.propensities = dict()
+
+		self.infectious = dict()
+		self.incoming_contacts = dict()
+		for environment in controller.environments:
+			self.infectious[environment] = IndexedSet()
+			if environment.contact_network is not None:
+				self.incoming_contacts[environment] = \
+					environment.contact_network.rates.tocsc()
+
+		for environment in controller.environments:
+			for host in list(environment.infected):
+				if not host.is_dead():
+					self.schedule(('replicate', host), \
+						controller.current_time + 1)
+				self.update_host(host)
+
+	def __repr__(self):
+		return "EventScheduler at time %s with %s pending events" % \
+			(self.time, len(self.scheduled))
+
+	def schedule(self, key, time):
+		"""
+		This method sets the next event time of a key, replacing any event
+		that is already scheduled for it.
+		"""
+		entry = (time, next(self.counter), key)
+		self.scheduled[key] = entry
+		heappush(self.queue, entry)
+
+	def unschedule(self, key):
+		self.scheduled.pop(key, None)
+		self.propensities.pop(key, None)
+
+	def peek(self):
+		"""
+		This method returns the next valid event without removing it, 
+		discarding the queue entries that have been replaced or unscheduled, 
+		or None if there is none.
+		"""
+		while len(self.queue) > 0:
+			entry = self.queue[0]
+			if self.scheduled.get(entry[2]) is entry:
+				return entry
+			heappop(self.queue)
+
+		return None
+
+	def pop(self):
+		entry = self.peek()
+		if entry is not None:
+			heappop(self.queue)
+			del self.scheduled[entry[2]]
+
+		return entry
+
+	def set_propensity(self, key, propensity):
+		"""
+		This method updates the propensity of a transmission channel, and
+		its next event time, following Gibson & Bruck.
+		"""
+		old_propensity = self.propensities.get(key, 0)
+
+		if propensity <= 0:
+			self.unschedule(key)
+		elif old_propensity > 0 and key in self.scheduled:
+			old_time = self.scheduled[key][0]
+			self.propensities[key] = propensity
+			self.schedule(key, self.time + (old_propensity / propensity) * \
+				(old_time - self.time))
+		else:
+			self.propensities[key] = propensity
+			self.schedule(key, self.time + self.rng.exponential(1.0 / \
+				propensity))
+
+	def is_infectious(self, host):
+		return len(host.viruses) > 0 and host.is_infectious() and \
+			not host.is_dead()
+
+	def contact_propensity(self, environment, host):
+		"""
+		This method returns the sum of the contact rates of a host to the
+		naive hosts of its environment.
+		"""
+		network = environment.contact_network
+		row = network.rates[network.positions[host]]
+		naive = environment.naive
+
+		return sum(rate for target, rate in zip(row.indices, row.data) if \
+			network.hosts[target] in naive)
+
+	def update_host(self, host):
+		"""
+		This method updates the infectiousness of a host, and the
+		transmission channels that depend on it.
+		"""
+		environment = host.environment
+		infectious = self.infectious[environment]
+
+		if self.is_infectious(host):
+			infectious.add(host)
+		else:
+			infectious.discard(host)
+
+		if environment.contact_network is not None:
+			propensity = 0
+			if host in infectious:
+				propensity = self.contact_propensity(environment, host)
+			self.set_propensity(('transmit', host), propensity)
+		else:
+			self.update_mixing(environment)
+
+	def update_mixing(self, environment):
+		if self.transmission_rate is None:
+			return
+
+		propensity = self.transmission_rate * \
+			len(self.infectious[environment]) * len(environment.naive) / \
+			float(len(environment.hosts))
+		self.set_propensity(('mix', environment), propensity)
+
+	def set_time(self, time):
+		"""
+		This method advances the clock, and the current time of the
+		controller and of its environments to the last generation that has
+		started.
+		"""
+		self.time = time
+		generation = int(floor(time))
+
+		self.controller.current_time = generation
+		for environment in self.controller.environments:
+			environment.current_time = generation
+
+	def replicate(self, host):
+		engine = self.controller.within_host_engine
+		if engine is None:
+			host.allow_one_cycle_of_replication()
+		else:
+			engine.advance(host)
+
+		if len(host.viruses) > 0 and not host.is_dead():
+			self.schedule(('replicate', host), self.time + 1)
+
+		self.update_host(host)
+
+	def infect(self, source, target):
+		"""
+		This method makes one transmission happen, schedules the first
+		replication of the newly infected host, and updates the channels
+		that depend on the two hosts.
+		"""
+		source.infect(target, bottleneck_mean=self.bottleneck_mean, \
+			bottleneck_variance=self.bottleneck_variance)
+
+		self.schedule(('replicate', target), floor(self.time) + 1)
+		self.update_host(source)
+		self.update_host(target)
+
+		environment = target.environment
+		if environment.contact_network is not None:
+			network = environment.contact_network
+			column = self.incoming_contacts[environment][:, \
+				network.positions[target]]
+			for position in column.indices:
+				contact = network.hosts[position]
+				if contact is not source:
+					self.update_host(contact)
+
+	def transmit_along_contacts(self, source):
+		environment = source.environment
+		network = environment.contact_network
+		row = network.rates[network.positions[source]]
+
+		naive = environment.naive
+		targets = [(target, rate) for target, rate in zip(row.indices, \
+			row.data) if network.hosts[target] in naive]
+		if len(targets) == 0:
+			self.update_host(source)
+			return
+
+		rates = np.array([rate for target, rate in targets])
+		chosen = self.rng.choice(len(targets), p=rates / rates.sum())
+
+		self.infect(source, network.hosts[targets[chosen][0]])
+
+	def transmit_by_mixing(self, environment):
+		source = self.infectious[environment].choice()
+		target = environment.random_naive_host()
+
+		self.infect(source, target)
+
+	def step(self):
+		"""
+		This method makes the next event happen.
+
+		Returns: False if there are no events left, and True otherwise.
+		"""
+		entry = self.pop()
+		if entry is None:
+			return False
+
+		time, order, (kind, subject) = entry
+		self.set_time(time)
+		self.propensities.pop((kind, subject), None)
+
+		if kind == 'replicate':
+			self.replicate(subject)
+		elif kind == 'transmit':
+			self.transmit_along_contacts(subject)
+		elif kind == 'mix':
+			self.transmit_by_mixing(subject)
+
+		self.num_events += 1
+
+		return True
+
+	def run(self, until=None):
+		"""
+		This method makes events happen until none are left (i.e. until no
+		infected hosts remain), or until the specified time.
+
+		Returns: the number of events that happened.
+		"""
+		num_events = self.num_events
+		while True:
+			entry = self.peek()
+			if entry is None or (until is not None and entry[0] > until):
+				break
+			self.step()
+
+		return self.num_events - num_events
@@ -0,0 +1,168 @@
+import gzip
+import os
+
+class FastaSink(object):
+	"""
+	The FastaSink streams sampled viruses to one FASTA file per segment, as
+	sampling happens, instead of holding every SeqRecord in memory until the
+	end of a run.
+
+	Records are formatted as text and kept in one buffer per segment; once
+	the buffers hold more than max_buffer_bytes characters in total, they are
+	appended to their files in a single write each. Memory use is therefore
+	bounded by max_buffer_bytes, whatever the number of sampled viruses.
+
+	The header of each record is "<virus id> <creation date>", which is the
+	convention that network_reconstructor.get_id and get_date expect.
+
+	----------
+
+	ATTRIBUTES
+
+	- STRING: filename_template
+		the template of the file names, which is formatted with the segment
+		number. If compress is True and the template does not end with
+		".gz", ".gz" is appended to it.
+
+	- BOOLEAN: compress
+		whether the files are gzip-compressed.
+
+	- INTEGER: max_buffer_bytes
+		the maximum number of characters buffered before a flush.
+
+	- INTEGER: line_width
+		the number of nucleotides per sequence line, as written by SeqIO.
+
+	- INTEGER: num_records
+		the number of viruses written so far, i.e. the number of records in
+		each segment file.
+	"""
+
+	def __init__(self, filename_template, compress=False, \
+		max_buffer_bytes=2 ** 20, line_width=60, overwrite=True):
+		"""
+		If overwrite is True, existing files are truncated when they are first
+		written to; otherwise, the records are appended to them.
+		"""
+		super(FastaSink, self).__init__()
+
+		if compress and not filename_template.endswith('.gz'):
+			filename_template = filename_template + '.gz'
+
+		self.filename_template = filename_template
+		self.compress = compress
+		self.max_buffer_bytes = max_buffer_bytes
+		self.line_width = line_width
+		self.overwrite = overwrite
+
+		self.buffers = dict()
+		self.num_buffered_bytes = 0
+		self.num_records = 0
+
+		self.opened = set()
+		self.handles = dict()
+
+	@classmethod
+	def for_run(cls, directory, run_number, **kwargs):
+		"""
+		This method returns a FastaSink that writes to the files that
+		reconstruct_n_networks.py reads, i.e.
+		"<directory>/Run <run_number> Simulation Segment <i> Sequences.fasta".
+		"""
+		template = os.path.join(directory, 'Run %s Simulation Segment ' % \
+			run_number + '%s Sequences.fasta')
+
+		return cls(template, **kwargs)
+
+	def __repr__(self):
+		return "FastaSink to %s with %s records (%s bytes buffered)" % \
+			(self.filename_template, self.num_records, \
+			self.num_buffered_bytes)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+	def filename(self, segment_number):
+		return self.filename_template % segment_number
+
+	def format_record(self, virus_id, date, sequence):
+		"""
+		This method returns the FASTA text of one record.
+		"""
+		width = self.line_width
+		lines = [sequence[i:i + width] for i in range(0, len(sequence), width)]
+
+		return '>%s %s\n%s\n' % (virus_id, date, '\n'.join(lines))
+
+	def write_record(self, segment_number, virus_id, date, sequence):
+		"""
+		This method buffers one record of one segment.
+		"""
+		text = self.format_record(virus_id, date, sequence)
+		self.buffers.setdefault(segment_number, []).append(text)
+		self.num_buffered_bytes += len(text)
+
+		if self.num_buffered_bytes > self.max_buffer_bytes:
+			self.flush()
+
+	def write_viruses(self, viruses):
+		"""
+		This method buffers every segment of a list of Virus objects.
+
+		Returns: the number of viruses written.
+		"""
+		for virus in viruses:
+			for segment_number, sequence in enumerate(virus.sequence()):
+				self.write_record(segment_number, virus.id, \
+					virus.creation_date, sequence)
+			self.num_records += 1
+
+		return len(viruses)
+
+	def get_handle(self, segment_number):
+		"""
+		This method returns the open file of a segment. Files are opened in
+		append mode, so a handle can be closed and reopened; gzip files are
+		then made of several gzip members, which gzip and SeqIO read as one
+		stream.
+		"""
+		if segment_number not in self.handles:
+			filename = self.filename(segment_number)
+			mode = 'a'
+			if self.overwrite and segment_number not in self.opened:
+				mode = 'w'
+			self.opened.add(segment_number)
+
+			if self.compress:
+				handle = gzip.open(filename, mode + 't')
+			else:
+				handle = open(filename, mode)
+			self.handles[segment_number] = handle
+
+		return self.handles[segment_number]
+
+	def flush(self):
+		"""
+		This method writes the buffered records of each segment to its file
+		in one write, and empties the buffers.
+		"""
+		for segment_number in sorted(self.buffers.keys()):
+			handle = self.get_handle(segment_number)
+			handle.write(''.join(self.buffers[segment_number]))
+			handle.flush()
+
+		self.buffers = dict()
+		self.num_buffered_bytes = 0
+
+	def close(self):
+		"""
+		This method flushes the buffered records and closes the files.
+		"""
+		self.flush()
+
+		for handle in self.handles.values():
+			handle.close()
+		self.handles = dict()
@@ -0,0 +1,287 @@
+from id_generator import as_id
+
+import networkx as nx
+import numpy as np
+
+def genealogy_of(host):
+	"""
+	This function returns the Genealogy that records the viruses created in a 
+	host, or None if the host's environment does not record one.
+	"""
+	if host is None or host.environment is None:
+		return None
+
+	return getattr(host.environment, 'genealogy', None)
+
+class AppendOnlyColumn(object):
+	"""
+	The AppendOnlyColumn is a NumPy-backed column that can only be appended 
+	to. Values appended one at a time are buffered in a list, and are moved 
+	into the array (whose capacity is doubled as needed) in bulk.
+	"""
+
+	def __init__(self, dtype, capacity=1024):
+		super(AppendOnlyColumn, self).__init__()
+
+		self.dtype = dtype
+		self.data = np.zeros(capacity, dtype=dtype)
+		self.size = 0
+
+		self.pending = []
+
+	def __len__(self):
+		return self.size + len(self.pending)
+
+	def reserve(self, size):
+		"""
+		This method makes sure that the array can hold at least size values.
+		"""
+		if size > len(self.data):
+			capacity = max(size, 2 * len(self.data))
+			data = np.zeros(capacity, dtype=self.dtype)
+			data[:self.size] = self.data[:self.size]
+			self.data = data
+
+	def append(self, value):
+		"""
+		This method appends a single value.
+		"""
+		self.pending.append(value)
+		if len(self.pending) >= 4096:
+			self.flush()
+
+	def extend(self, values):
+		"""
+		This method appends an array of values.
+		"""
+		self.flush()
+
+		values = np.asarray(values, dtype=self.dtype)
+		self.reserve(self.size + len(values))
+		self.data[self.size:self.size + len(values)] = values
+		self.size += len(values)
+
+	def flush(self):
+		"""
+		This method moves the buffered values into the array.
+		"""
+		if len(self.pending) > 0:
+			pending = self.pending
+			self.pending = []
+			self.extend(pending)
+
+	def values(self):
+		"""
+		This method returns a read-only view of the values in the column.
+		"""
+		self.flush()
+
+		values = self.data[:self.size]
+		values.flags.writeable = False
+
+		return values
+
+class Genealogy(object):
+	"""
+	The Genealogy is a simulation-wide, append-only record of every virus that 
+	is created, written as the viruses are created. It allows the full 
+	ground-truth transmission tree to be exported after a run, without keeping 
+	the Virus objects of extinct lineages in memory.
+
+	----------
+
+	ATTRIBUTES
+
+	- APPEND-ONLY COLUMNS: ids, parents, hosts, creation_times
+		one entry per virus. The parent of a founder virus is -1.
+
+	- APPEND-ONLY COLUMNS: mutation_ids, mutation_segments, 
+	  mutation_positions, mutation_letters
+		the segment-mutation deltas: one entry per mutation that happened 
+		when a virus was created (i.e. relative to its parent). Letters are 
+		stored as ASCII codes.
+
+	----------
+
+	MAIN METHODS
+
+	- record:
+		a method that records a batch of new viruses.
+
+	- transmission_tree:
+		a method that exports the parent-to-child tree of all viruses, or of 
+		a set of (e.g. sampled) viruses and their ancestors.
+
+	- mutations:
+		a method that reconstructs the mutation dictionaries of a virus from 
+		the deltas of its lineage.
+	"""
+
+	def __init__(self):
+		super(Genealogy, self).__init__()
+
+		self.ids = AppendOnlyColumn(np.int64)
+		self.parents = AppendOnlyColumn(np.int64)
+		self.hosts = AppendOnlyColumn(np.int64)
+		self.creation_times = AppendOnlyColumn(np.int64)
+
+		self.mutation_ids = AppendOnlyColumn(np.int64)
+		self.mutation_segments = AppendOnlyColumn(np.int64)
+		self.mutation_positions = AppendOnlyColumn(np.int64)
+		self.mutation_letters = AppendOnlyColumn(np.uint8)
+
+		self.sort_order = None
+
+	def __repr__(self):
+		return "Genealogy of %s viruses" % len(self)
+
+	def __len__(self):
+		return len(self.ids)
+
+	def record(self, ids, parents, hosts, creation_times, mutations=None):
+		"""
+		This method records a batch of new viruses.
+
+		INPUTS:
+		-	ids, parents, hosts, creation_times: arrays with one entry per 
+			virus. Parents of founder viruses must be -1.
+		-	mutations: a tuple of arrays (virus ID, segment, position, letter 
+			code) of the mutations that happened when the viruses were 
+			created.
+		"""
+		self.ids.extend(ids)
+		self.parents.extend(parents)
+		self.hosts.extend(hosts)
+		self.creation_times.extend(creation_times)
+
+		if mutations is not None:
+			self.mutation_ids.extend(mutations[0])
+			self.mutation_segments.extend(mutations[1])
+			self.mutation_positions.extend(mutations[2])
+			self.mutation_letters.extend(mutations[3])
+
+		self.sort_order = None
+
+	def record_virus(self, virus, parent_segments=None):
+		"""
+		This method records a single Virus object at the time it is created. 
+
+		If the parent's segments are specified, only the mutations that 
+		differ from them are recorded; otherwise, all of the virus' mutations 
+		are recorded.
+		"""
+		if virus.parent is None:
+			self.parents.append(-1)
+		else:
+			self.parents.append(virus.parent)
+		self.ids.append(virus.id)
+		self.hosts.append(virus.host.id)
+		self.creation_times.append(virus.creation_date)
+
+		for segment_number, segment in enumerate(virus.segments):
+			if parent_segments is None:
+				parent_mutations = dict()
+			elif parent_segments[segment_number] is segment:
+				continue
+			else:
+				parent_mutations = parent_segments[segment_number].mutations
+
+			for position, letter in segment.mutations.items():
+				if parent_mutations.get(position) != letter:
+					self.mutation_ids.append(virus.id)
+					self.mutation_segments.append(segment_number)
+					self.mutation_positions.append(position)
+					self.mutation_letters.append(ord(letter))
+
+		self.sort_order = None
+
+	def index_of(self, virus_ids):
+		"""
+		This method returns the row index of each of the specified virus IDs. 
+		A KeyError is raised if any of them has not been recorded.
+		"""
+		ids = self.ids.values()
+		if self.sort_order is None:
+			self.sort_order = np.argsort(ids, kind='mergesort')
+
+		virus_ids = np.asarray(virus_ids, dtype=np.int64)
+		sorted_ids = ids[self.sort_order]
+		positions = np.searchsorted(sorted_ids, virus_ids)
+		positions = np.minimum(positions, len(sorted_ids) - 1)
+
+		if len(sorted_ids) == 0 or np.any(sorted_ids[positions] != virus_ids):
+			raise KeyError('A virus ID has not been recorded!')
+
+		return self.sort_order[positions]
+
+	def ancestors(self, virus_id):
+		"""
+		This method returns the IDs of the ancestors of a virus, starting with 
+		its parent and ending with its founder.
+		"""
+		parents = self.parents.values()
+
+		ancestors = []
+		parent = parents[self.index_of([virus_id])[0]]
+		while parent != -1:
+			ancestors.append(as_id(parent))
+			parent = parents[self.index_of([parent])[0]]
+
+		return ancestors
+
+	def mutations(self, virus_id, num_segments=2):
+		"""
+		This method reconstructs the mutation dictionaries of a virus (in the 
+		format of Virus.mutations) by applying the deltas recorded along its 
+		lineage, from its founder down to the virus itself.
+		"""
+		lineage = [virus_id] + self.ancestors(virus_id)
+
+		mutation_ids = self.mutation_ids.values()
+		mutations = [dict() for i in range(num_segments)]
+		for lineage_id in reversed(lineage):
+			for row in np.nonzero(mutation_ids == lineage_id)[0]:
+				segment_number = self.mutation_segments.values()[row]
+				position = int(self.mutation_positions.values()[row])
+				letter = chr(self.mutation_letters.values()[row])
+				mutations[segment_number][position] = letter
+
+		return mutations
+
+	def transmission_tree(self, virus_ids=None):
+		"""
+		This method exports the ground-truth transmission tree as a directed 
+		graph, with an edge of weight 1 from each virus to each of its 
+		progeny. Nodes are named by the string form of the virus IDs (as in 
+		the sampled FASTA files), and carry the host and date of creation.
+
+		If virus_ids is specified, the tree only contains those viruses and 
+		their ancestors.
+		"""
+		ids = self.ids.values()
+		parents = self.parents.values()
+		hosts = self.hosts.values()
+		times = self.creation_times.values()
+
+		if virus_ids is None:
+			rows = np.arange(len(ids))
+		else:
+			rows = set()
+			frontier = set(self.index_of(list(virus_ids)))
+			while len(frontier) > 0:
+				rows.update(frontier)
+				frontier_parents = [parents[row] for row in frontier if \
+					parents[row] != -1]
+				frontier = set(self.index_of(frontier_parents)) - rows
+			rows = np.array(sorted(rows), dtype=np.int64)
+
+		tree = nx.DiGraph()
+		for row in rows:
+			tree.add_node(str(as_id(ids[row])), host=str(as_id(hosts[row])), \
+				date=int(times[row]))
+		for row in rows:
+			if parents[row] != -1:
+				tree.add_edge(str(as_id(parents[row])), str(as_id(ids[row])), \
+					weight=1)
+
+		return tree
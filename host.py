@@ -2,7 +2,10 @@ from random import random, randint, choice, sample
 from datetime import datetime
 from joblib import Parallel, delayed
 from numpy.random import normal, binomial
+import numpy as np
 from id_generator import generate_id
+from population import ArrayPopulation, GenotypePopulation
+from indexed_set import IndexedSet
 from time import time
 import ctypes
 
@@ -36,15 +39,25 @@ class Host(object):
 	sample everything from the host, or it can sample a subset of viruses. The 
 	number of viruses that are sampled at each sampling event can be 
 	configured by subclassing the Sampler class.
+
+	By default, the viruses present in the Host are kept as Virus objects in 
+	an IndexedSet, which allows them to be added, removed and drawn at random 
+	in constant time. If array_population is True, they are instead kept in an 
+	ArrayPopulation, which stores them as NumPy arrays and only creates Virus 
+	objects when they are sampled. If batched_replication is also True, the 
+	progeny of each replication cycle are generated with 
+	ArrayPopulation.generate_progeny_batched. If deduplicate_genotypes is 
+	True, they are kept in a GenotypePopulation, which stores each distinct 
+	genotype once with the number of particles that carry it.
 	"""
 
-	def __init__(self, environment, immune_halftime=2):
+	def __init__(self, environment, immune_halftime=2, array_population=False, \
+		batched_replication=False, deduplicate_genotypes=False):
 		super(Host, self).__init__()
 
-		self.id = generate_id()
+		self.id = generate_id(self)
 
 		self.environment = None
-		self.set_environment(environment)
 
 		self.infection_history = dict()
 
@@ -52,12 +65,54 @@ class Host(object):
 
 		self.max_viruses = 5000
 
-		self.viruses = []
+		if batched_replication and not (array_population or \
+			deduplicate_genotypes):
+			raise ValueError('Batched replication requires an array population!')
+
+		self.batched_replication = batched_replication
+
+		self.rng = np.random
+
+		# The version is incremented whenever the viruses or the infection 
+		# history of the host change, e.g. for incremental checkpoints.
+		self.version = 0
+
+		if deduplicate_genotypes:
+			self.viruses = GenotypePopulation(host=self)
+		elif array_population:
+			self.viruses = ArrayPopulation(host=self)
+		else:
+			self.viruses = IndexedSet()
+
+		self.set_environment(environment)
 
 	def __repr__(self):
 		return "Host %s infected with %s viruses" % (self.id, \
 			len(self.viruses))
 
+	def set_rng(self, rng):
+		"""
+		This method sets the source of random numbers (e.g. a NumPy 
+		RandomState) that is used for the replication and immune removal of 
+		the host's viruses. It only covers an ArrayPopulation; viruses that 
+		are kept as Virus objects draw from the random module.
+		"""
+		self.rng = rng
+		if isinstance(self.viruses, ArrayPopulation):
+			self.viruses.rng = rng
+
+	def update_state(self):
+		"""
+		This method updates the indexes of infected, naive and dead hosts that 
+		are kept by the host's environment, and the version of the host. It 
+		must be called whenever the viruses or the infection history of the 
+		host change.
+		"""
+		self.version += 1
+
+		if self.environment is not None:
+			self.environment.update_host_state(self)
+
 	def is_infectious(self):
 		"""
 		The host is infectious if it is currently carrying more than 0.1 of 
@@ -74,14 +129,21 @@ class Host(object):
 		else:
 			return False
 
-	def immune_removal_probability(self):
-		time_difference = self.timespan_of_infection()
+	def immune_removal_probability(self, time=None):
+		time_difference = self.timespan_of_infection(time)
 		p = float(time_difference) / (self.immune_halftime + time_difference)
 
 		return p
 
-	def timespan_of_infection(self):
-		current_time = self.environment.current_time
+	def timespan_of_infection(self, time=None):
+		"""
+		This method returns the time since the last infection, at the 
+		specified time or, by default, at the current time of the environment.
+		"""
+		if time is None:
+			current_time = self.environment.current_time
+		else:
+			current_time = time
 		last_infection_time = max(self.infection_history.keys())
 		time_difference = current_time - last_infection_time
 
@@ -91,8 +153,11 @@ class Host(object):
 		"""
 		This method precomputes the number of progeny to be made.
 		"""
+		if isinstance(self.viruses, ArrayPopulation):
+			return self.viruses.num_progeny_made()
+
 		rand_number = randint(0, len(self.viruses))
-		parents = sample(self.viruses, rand_number) # the viruses to replicate
+		parents = self.viruses.sample(rand_number) # the viruses to replicate
 
 		made = sum(virus.burst_size() for virus in parents)
 
@@ -110,7 +175,7 @@ class Host(object):
 		n = num_progeny_made
 
 		if n > 0:
-			removed = binomial(n, p)
+			removed = self.rng.binomial(n, p)
 
 		else:
 			removed = 0
@@ -131,9 +196,17 @@ class Host(object):
 		generates n progeny from them. The number of progeny that actually 
 		comes out may be slightly bigger than the n specified. This is ok.
 		"""
+		if isinstance(self.viruses, ArrayPopulation):
+			if self.batched_replication:
+				return self.viruses.generate_progeny_batched(num_viruses, \
+					self.environment.current_time)
+			else:
+				return self.viruses.generate_progeny(num_viruses, \
+					self.environment.current_time)
+
 		progeny = []
 		while len(progeny) < num_viruses:
-			parent = choice(self.viruses)
+			parent = self.viruses.choice()
 			progeny.extend(parent.generate_progeny())
 
 		# progeny = []
@@ -148,7 +221,7 @@ class Host(object):
 		p = self.immune_removal_probability()
 		n = len(self.viruses)
 
-		removed = binomial(n, p)
+		removed = self.rng.binomial(n, p)
 
 		return removed
 
@@ -170,10 +243,7 @@ class Host(object):
 
 			# print("%s progeny generated in host %s." % (len(progeny), self.id
 				# [0:5]))
-			parents_to_remove = sample(self.viruses, \
-				self.num_parental_removed())
-			for virus in parents_to_remove:
-				self.remove_virus(virus)
+			self.remove_random_viruses(self.num_parental_removed())
 
 			self.add_viruses(progeny)
 
@@ -203,7 +273,7 @@ class Host(object):
 			rand_number = randint(0, len(self.viruses))
 			# # print('Replicating %s viruses.' % rand_number)
 			
-			viruses_to_replicate = sample(self.viruses, rand_number)
+			viruses_to_replicate = self.viruses.sample(rand_number)
 
 			viruses_generated = []
 			for virus in viruses_to_replicate:
@@ -246,7 +316,7 @@ class Host(object):
 		# # print('Removing %s viruses out of %s viruses from host %s.' % (
 			# num_viruses_to_remove, len(self.viruses), id(self)))
 
-		viruses_to_remove = sample(self.viruses, num_viruses_to_remove)
+		viruses_to_remove = self.viruses.sample(num_viruses_to_remove)
 		for virus in viruses_to_remove:
 			self.remove_virus(virus)
 
@@ -286,11 +356,7 @@ class Host(object):
 		# # print('Transmission %s viruses out of %s viruses from host %s to 
 			# host %s.' % (num_viruses, len(self.viruses), id(self), id(
 				# other_host)))
-		viruses_to_transmit = sample(self.viruses, num_viruses)
-
-		for virus in viruses_to_transmit:
-			virus.host = other_host
-			self.remove_virus(virus)
+		viruses_to_transmit = self.remove_random_viruses(num_viruses)
 
 		other_host.add_viruses(viruses_to_transmit)
 
@@ -299,11 +365,11 @@ class Host(object):
 		This method moves the Host from one environment to another.
 		"""
 		self.environment.remove_host(self)
-		environment.add_host(self)
 		self.set_environment(environment)
 
 	def set_infection_history(self, time, source_host):
-		self.infection_history[time] = source_host\
+		self.infection_history[time] = source_host
+		self.update_state()
 
 	def was_infected(self):
 		if len(self.infection_history.keys()) > 0:
@@ -337,14 +403,49 @@ class Host(object):
 		"""
 		if not isinstance(virus, Virus):
 			raise TypeError('A Virus object must be specified!')
+		elif isinstance(self.viruses, ArrayPopulation):
+			self.viruses.add_virus(virus)
 		elif virus not in self.viruses:
-			self.viruses.append(virus)
+			virus.host = self
+			self.viruses.add(virus)
+
+		self.update_state()
 
 	def add_viruses(self, viruses):
 		"""
 		This method takes in a list of viruses and appends it to the 
 		current list of viruses.
-		"""
+
+		The viruses may also be passed in as a detached ArrayPopulation (as 
+		returned by remove_random_viruses or generate_viral_progeny). The 
+		particles of a GenotypePopulation are merged by count into another 
+		GenotypePopulation, and copied one row per particle into an 
+		ArrayPopulation.
+		"""
+		if isinstance(viruses, ArrayPopulation):
+			if isinstance(self.viruses, GenotypePopulation):
+				self.viruses.extend(viruses)
+				self.update_state()
+				return
+			elif isinstance(self.viruses, ArrayPopulation):
+				if isinstance(viruses, GenotypePopulation):
+					viruses = viruses.particles()
+				self.viruses.extend(viruses)
+				self.update_state()
+				return
+			else:
+				viruses = viruses.views(host=self)
+		elif isinstance(self.viruses, ArrayPopulation):
+			from virus import Virus
+
+			viruses = list(viruses)
+			if not all(isinstance(virus, Virus) for virus in viruses):
+				raise TypeError('A Virus object must be specified!')
+
+			self.viruses.add_viruses(viruses)
+			self.update_state()
+			return
+
 		for virus in viruses:
 			self.add_virus(virus)
 
@@ -368,12 +469,36 @@ class Host(object):
 		from virus import Virus
 
 		if isinstance(virus, Virus):
-			self.viruses.pop(self.viruses.index(virus))
+			self.viruses.remove(virus)
 		elif type(virus) == int:
-			self.viruses.pop(virus)
+			self.viruses.remove(self.viruses[virus])
 		else:
 			raise TypeError('A Virus object or an integer must be specified!')
 
+		self.update_state()
+
+	def remove_random_viruses(self, num_viruses):
+		"""
+		This method removes num_viruses viruses, chosen at random, from the 
+		host, and returns them.
+
+		If the host keeps its viruses in an ArrayPopulation, the removed 
+		viruses are returned as a detached ArrayPopulation; otherwise, they are 
+		returned as a list of Virus objects.
+		"""
+		if isinstance(self.viruses, ArrayPopulation):
+			viruses = self.viruses.take_random(num_viruses)
+			self.update_state()
+
+			return viruses
+
+		viruses = self.viruses.sample(num_viruses)
+		for virus in viruses:
+			self.viruses.remove(virus)
+		self.update_state()
+
+		return viruses
+
 	def remove_viruses(self, viruses):
 		"""
 		This method takes in an iterable of viruses, and removes them from the 
@@ -381,4 +506,4 @@ class Host(object):
 		"""
 
 		for virus in viruses:
-			host.remove_virus(virus)
\ No newline at end of file
+			self.remove_virus(virus)
\ No newline at end of file
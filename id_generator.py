@@ -1,13 +1,169 @@
 from random import random
 from datetime import datetime
+from weakref import WeakValueDictionary
 
 import hashlib
+import numpy as np
 
-def generate_id():
+# IDs are 64-bit integers: the high bits hold the namespace of the run, and 
+# the low bits hold a counter that is incremented for every new ID. One bit 
+# is left unused, so that IDs fit in a signed 64-bit integer (e.g. in NumPy 
+# arrays).
+NAMESPACE_BITS = 23
+COUNTER_BITS = 40
+
+class CompactId(int):
+	"""
+	A CompactId is an integer ID, as allocated by an IdAllocator. It behaves 
+	like an ordinary integer, but its string form is "<namespace>-<counter>", 
+	which is stable for a given run and short enough for FASTA headers and 
+	graph node names.
+	"""
+
+	def __str__(self):
+		return '%d-%d' % (self.namespace(), self.counter())
+
+	def __repr__(self):
+		return str(self)
+
+	def namespace(self):
+		return int(self) >> COUNTER_BITS
+
+	def counter(self):
+		return int(self) & (2 ** COUNTER_BITS - 1)
+
+class IdAllocator(object):
+	"""
+	The IdAllocator hands out compact, counter-based 64-bit IDs under a run 
+	namespace. IDs allocated by one allocator are unique; IDs allocated by 
+	allocators with different namespaces never collide.
+
+	If keep_registry is True, the allocator also keeps a registry from each ID 
+	to the object that it was allocated for. The registry holds weak 
+	references, so it does not keep objects alive.
+	"""
+
+	def __init__(self, namespace=0, keep_registry=False):
+		super(IdAllocator, self).__init__()
+
+		if type(namespace) != int:
+			raise TypeError('An integer namespace must be specified!')
+		elif namespace < 0 or namespace >= 2 ** NAMESPACE_BITS:
+			raise ValueError('The namespace must be between 0 and %s!' % \
+				(2 ** NAMESPACE_BITS - 1))
+
+		self.namespace = namespace
+		self.next_counter = 0
+
+		self.registry = None
+		if keep_registry:
+			self.registry = WeakValueDictionary()
+
+	def __repr__(self):
+		return "IdAllocator %s with %s IDs allocated" % (self.namespace, \
+			self.next_counter)
+
+	def make_id(self, counter):
+		"""
+		This method returns the ID with the specified counter value in this 
+		allocator's namespace.
+		"""
+		if counter >= 2 ** COUNTER_BITS:
+			raise OverflowError('The ID counter of this namespace is exhausted!')
+
+		return CompactId((self.namespace << COUNTER_BITS) | counter)
+
+	def allocate(self, obj=None):
+		"""
+		This method returns a new ID. If an object is specified and the 
+		allocator keeps a registry, the object is registered under the ID.
+		"""
+		new_id = self.make_id(self.next_counter)
+		self.next_counter += 1
+
+		if obj is not None:
+			self.register(new_id, obj)
+
+		return new_id
+
+	def allocate_many(self, num_ids):
+		"""
+		This method returns a NumPy array of num_ids new, consecutive IDs.
+		"""
+		first_id = self.make_id(self.next_counter)
+		self.make_id(self.next_counter + num_ids)
+		self.next_counter += num_ids
+
+		return np.arange(first_id, first_id + num_ids, dtype=np.int64)
+
+	def register(self, object_id, obj):
+		"""
+		This method registers an object under an ID, if the allocator keeps a 
+		registry.
+		"""
+		if self.registry is not None:
+			self.registry[int(object_id)] = obj
+
+	def lookup(self, object_id):
+		"""
+		This method returns the object registered under an ID, or None if 
+		there is none (or if the object no longer exists).
+		"""
+		if self.registry is None:
+			return None
+
+		return self.registry.get(int(object_id))
+
+# The allocator used by generate_id.
+_allocator = IdAllocator()
+
+def get_allocator():
+	"""
+	This function returns the allocator that is currently used by generate_id.
+	"""
+	return _allocator
+
+def set_allocator(allocator):
+	"""
+	This function sets the allocator that is used by generate_id.
+	"""
+	global _allocator
+
+	if not isinstance(allocator, IdAllocator):
+		raise TypeError('An IdAllocator object must be specified!')
+	else:
+		_allocator = allocator
+
+def start_run(namespace, keep_registry=False):
+	"""
+	This function starts allocating IDs for a new run under the specified 
+	namespace (e.g. the run number), and returns the new allocator.
+	"""
+	allocator = IdAllocator(namespace=namespace, keep_registry=keep_registry)
+	set_allocator(allocator)
+
+	return allocator
+
+def as_id(value):
+	"""
+	This function converts an integer (e.g. read from a NumPy array of IDs) 
+	back into a CompactId.
+	"""
+	return CompactId(int(value))
+
+def generate_id(obj=None):
+	"""
+	This method returns a new unique ID from the current allocator. If an 
+	object is specified, it is registered under the ID (if the allocator keeps 
+	a registry).
+	"""
+	return _allocator.allocate(obj)
+
+def generate_hash_id():
 	"""
-	This method sets the ID of the virus to be a unique string based on
-	the string representation of the current time and a randomly chosen
-	number.
+	This method returns a unique string based on the string representation of 
+	the current time and a randomly chosen number. It is the original ID 
+	scheme, kept for compatibility with older data.
 	"""
 	random_number = str(random())
 	current_time = str(datetime.now())
@@ -15,8 +171,8 @@ def generate_id():
 	unique_string = random_number + current_time
 
 	unique_id = hashlib.new('sha512')
-	unique_id.update(unique_string)
+	unique_id.update(unique_string.encode('utf-8'))
 	
 	id = unique_id.hexdigest()
 
-	return id
\ No newline at end of file
+	return id
@@ -0,0 +1,248 @@
+from network_reconstructor import get_id, get_date, get_dates, \
+	encode_records, compute_distance_matrix, compute_pwi_matrix, \
+	count_distances, median_threshold_from_counts
+
+import networkx as nx
+import numpy as np
+
+class IncrementalReconstructor(object):
+	"""
+	The IncrementalReconstructor maintains the graph of one segment that
+	standard_processing would build from all of the sequences seen so far,
+	as batches of new sequences arrive (e.g. daily surveillance data),
+	without recomputing the distances between all pairs of sequences.
+
+	standard_processing keeps, for each sink, the correctly timed edges that
+	have the maximum weight into that sink, if that weight is no lower than
+	the median threshold. The maximum weight into a sink does not depend on
+	the threshold, so for each sink, the reconstructor keeps:
+
+	-	the smallest edit distance from a correctly timed source, and
+	-	the sources at that distance.
+
+	Along with the histogram of correctly timed edit distances, from which
+	the threshold is computed exactly with median_threshold_from_counts.
+
+	When a batch arrives, only the distances between the new sequences and
+	the existing ones, and among the new sequences, are computed. New
+	sources can only lower (or tie) the best distance into an existing sink.
+
+	----------
+
+	ATTRIBUTES
+
+	- INTEGER: segment
+		the segment number, which is recorded on each edge.
+
+	- INTEGER: length
+		the length of the sequences, or None until the first batch.
+
+	- LIST: ids
+		the IDs of the sequences, in the order in which they arrived.
+
+	- NUMPY ARRAY: counts
+		the histogram of the edit distances of the correctly timed edges.
+
+	- NUMPY ARRAY: best_distances
+		the smallest edit distance from a correctly timed source into each
+		sink, or length + 1 if the sink has no correctly timed source.
+
+	- LIST: best_sources
+		the indices of the sources at the smallest distance into each sink.
+	"""
+
+	def __init__(self, segment, block_size=1000):
+		super(IncrementalReconstructor, self).__init__()
+
+		self.segment = segment
+		self.block_size = block_size
+
+		self.length = None
+		self.num_sequences = 0
+
+		self.ids = []
+		self.date_strings = []
+		self.positions = dict()
+
+		# The encoded sequences and dates are stored in arrays that grow by
+		# doubling; only their first num_sequences rows are in use.
+		self.encoded = np.zeros((0, 0), dtype=np.uint8)
+		self.dates = np.zeros(0, dtype=np.int64)
+
+		self.counts = None
+		self.best_distances = np.zeros(0, dtype=np.int64)
+		self.best_sources = []
+
+	def __repr__(self):
+		return "IncrementalReconstructor of segment %s with %s sequences" % \
+			(self.segment, self.num_sequences)
+
+	def __len__(self):
+		return self.num_sequences
+
+	def reserve(self, num_sequences):
+		"""
+		This method makes room for num_sequences sequences in the encoded
+		sequence and date arrays.
+		"""
+		capacity = len(self.dates)
+		if num_sequences <= capacity:
+			return
+
+		capacity = max(num_sequences, 2 * capacity)
+
+		encoded = np.zeros((capacity, self.length), dtype=np.uint8)
+		encoded[:self.num_sequences] = self.encoded[:self.num_sequences]
+		self.encoded = encoded
+
+		dates = np.zeros(capacity, dtype=np.int64)
+		dates[:self.num_sequences] = self.dates[:self.num_sequences]
+		self.dates = dates
+
+		best_distances = np.zeros(capacity, dtype=np.int64)
+		best_distances[:self.num_sequences] = \
+			self.best_distances[:self.num_sequences]
+		self.best_distances = best_distances
+
+	def offer(self, distances, source_indices, sink_indices, valid):
+		"""
+		This method updates the best sources of the sinks in a block of the
+		distance matrix (rows are sources, columns are sinks), of which only
+		the valid entries are correctly timed edges.
+
+		Returns: the set of sink indices whose best sources changed.
+		"""
+		affected = set()
+		if len(source_indices) == 0 or len(sink_indices) == 0:
+			return affected
+
+		no_source = self.length + 1
+		masked = np.where(valid, distances, no_source)
+		block_best = masked.min(axis=0)
+
+		candidates = np.nonzero((block_best < no_source) & (block_best <= \
+			self.best_distances[sink_indices]))[0]
+		for k in candidates:
+			sink = sink_indices[k]
+			sources = source_indices[masked[:, k] == block_best[k]].tolist()
+			if block_best[k] < self.best_distances[sink]:
+				self.best_distances[sink] = block_best[k]
+				self.best_sources[sink] = sources
+			else:
+				self.best_sources[sink].extend(sources)
+			affected.add(sink)
+
+		return affected
+
+	def add_records(self, records):
+		"""
+		This method adds a batch of new SeqRecord objects. The distances from
+		the existing sequences to the new ones and back, and among the new
+		ones, are computed one block of block_size existing sequences at a
+		time.
+
+		Returns: the IDs of the sinks whose best sources changed.
+		"""
+		if len(records) == 0:
+			return []
+
+		ids = [get_id(record) for record in records]
+		if len(set(ids)) < len(ids) or any(id in self.positions for id in ids):
+			raise ValueError('The IDs of the sequences must be unique!')
+
+		new_encoded = encode_records(records)
+		if self.length is None:
+			self.length = new_encoded.shape[1]
+			self.encoded = np.zeros((0, self.length), dtype=np.uint8)
+			self.counts = np.zeros(self.length + 1, dtype=np.int64)
+		elif new_encoded.shape[1] != self.length:
+			raise ValueError('The input sequences must be of equal length.')
+
+		length = self.length
+		new_dates = get_dates(records)
+
+		num_old = self.num_sequences
+		num_new = len(records)
+		new_indices = np.arange(num_old, num_old + num_new)
+
+		self.reserve(num_old + num_new)
+		self.encoded[new_indices] = new_encoded
+		self.dates[new_indices] = new_dates
+		self.best_distances[new_indices] = length + 1
+		self.best_sources.extend([] for i in range(num_new))
+
+		affected = set()
+		for start in range(0, num_old, self.block_size):
+			old_indices = np.arange(start, min(start + self.block_size, \
+				num_old))
+			old_dates = self.dates[old_indices]
+
+			distances = compute_distance_matrix(self.encoded[old_indices], \
+				new_encoded)
+
+			# Edges from the existing sequences into the new ones...
+			self.counts += count_distances(distances, old_dates, new_dates, \
+				length)
+			affected |= self.offer(distances, old_indices, new_indices, \
+				old_dates[:, None] <= new_dates[None, :])
+
+			# ... and from the new sequences into the existing ones.
+			self.counts += count_distances(distances.T, new_dates, old_dates, \
+				length)
+			affected |= self.offer(distances.T, new_indices, old_indices, \
+				new_dates[:, None] <= old_dates[None, :])
+
+		# Edges among the new sequences.
+		distances = compute_distance_matrix(new_encoded)
+		valid = new_dates[:, None] <= new_dates[None, :]
+		np.fill_diagonal(valid, False)
+		self.counts += count_distances(distances, new_dates, new_dates, \
+			length, exclude_diagonal=True)
+		affected |= self.offer(distances, new_indices, new_indices, valid)
+
+		for id, record in zip(ids, records):
+			self.positions[id] = len(self.ids)
+			self.ids.append(id)
+			self.date_strings.append(get_date(record))
+		self.num_sequences += num_new
+
+		return [self.ids[sink] for sink in sorted(affected)]
+
+	def threshold(self):
+		"""
+		This method returns the current median PWI threshold, as computed by
+		standard_processing over all of the sequences seen so far.
+		"""
+		if self.num_sequences == 0:
+			return 0.0
+
+		return median_threshold_from_counts(self.counts, \
+			self.num_sequences ** 2, self.length)
+
+	def graph(self):
+		"""
+		This method returns the current transmission graph of the segment,
+		which has the same nodes and edges as the graph that
+		standard_processing would return for all of the sequences seen so
+		far. It is built from the best sources of each sink, in time linear
+		in the number of sequences and edges.
+		"""
+		graph = nx.DiGraph()
+		for id, date in zip(self.ids, self.date_strings):
+			graph.add_node(id, date=date)
+
+		if self.num_sequences == 0:
+			return graph
+
+		threshold = self.threshold()
+		best_distances = self.best_distances[:self.num_sequences]
+		weights = compute_pwi_matrix(best_distances, self.length)
+
+		for sink in np.nonzero((best_distances <= self.length) & \
+			(weights >= threshold))[0]:
+			for source in self.best_sources[sink]:
+				graph.add_edge(self.ids[source], self.ids[sink], \
+					segment=self.segment, distance=int(best_distances[sink]), \
+					weight=float(weights[sink]))
+
+		return graph
@@ -0,0 +1,87 @@
+from random import choice, sample
+
+class IndexedSet(object):
+	"""
+	The IndexedSet is a container of unique objects that supports insertion, 
+	removal, membership tests and uniform random draws in constant time. 
+
+	Items are kept in a list, and a dictionary maps each item to its position 
+	in the list. An item is removed by moving the last item of the list into 
+	its position, so the order of the items is not preserved.
+
+	The IndexedSet can be indexed and iterated over like a list.
+	"""
+
+	def __init__(self, items=None):
+		super(IndexedSet, self).__init__()
+
+		self.items = []
+		self.positions = dict()
+
+		if items is not None:
+			self.extend(items)
+
+	def __repr__(self):
+		return "IndexedSet of %s items" % len(self.items)
+
+	def __len__(self):
+		return len(self.items)
+
+	def __iter__(self):
+		return iter(self.items)
+
+	def __contains__(self, item):
+		return item in self.positions
+
+	def __getitem__(self, index):
+		return self.items[index]
+
+	def add(self, item):
+		"""
+		This method adds an item to the set, if it is not already present.
+		"""
+		if item not in self.positions:
+			self.positions[item] = len(self.items)
+			self.items.append(item)
+
+	def extend(self, items):
+		"""
+		This method adds each item in an iterable of items to the set.
+		"""
+		for item in items:
+			self.add(item)
+
+	def remove(self, item):
+		"""
+		This method removes an item from the set. A ValueError is raised if 
+		the item is not present.
+		"""
+		if item not in self.positions:
+			raise ValueError('The item is not present!')
+
+		position = self.positions.pop(item)
+		last_item = self.items.pop()
+
+		if position < len(self.items):
+			self.items[position] = last_item
+			self.positions[last_item] = position
+
+	def discard(self, item):
+		"""
+		This method removes an item from the set, if it is present.
+		"""
+		if item in self.positions:
+			self.remove(item)
+
+	def choice(self):
+		"""
+		This method returns an item chosen uniformly at random.
+		"""
+		return choice(self.items)
+
+	def sample(self, num_items):
+		"""
+		This method returns a list of num_items items, chosen uniformly at 
+		random without replacement.
+		"""
+		return sample(self.items, num_items)
@@ -1,9 +1,13 @@
 from Bio import SeqIO
-from numpy import median
 from random import sample, choice
 from copy import deepcopy
+from tempfile import mkstemp
 
 import networkx as nx
+import os
+import numpy as np
+
+from scipy import sparse
 
 def compute_edit_distance(string1, string2):
 	"""
@@ -51,7 +55,92 @@ def add_nodes_from_records(graph, records):
 		# print id, date
 		graph.add_node(id, date=date)
 
-def add_edges_from_records(graph, records, segment):
+def encode_records(records):
+	"""
+	This function encodes the sequences of a list of SeqRecord objects into a 
+	NumPy uint8 matrix, with one row per record and one column per position. 
+	Each sequence is encoded exactly once, so that all of the pair-wise 
+	distances can be computed from the matrix in one batched call.
+
+	All of the sequences must be of equal length.
+	"""
+	lengths = set(len(record.seq) for record in records)
+	if len(lengths) > 1:
+		raise ValueError('The input sequences must be of equal length.')
+
+	length = lengths.pop() if len(lengths) == 1 else 0
+	encoded = np.zeros((len(records), length), dtype=np.uint8)
+	for n, record in enumerate(records):
+		sequence = str(record.seq).encode('ascii')
+		encoded[n] = np.frombuffer(sequence, dtype=np.uint8)
+
+	return encoded
+
+def compute_distance_matrix(encoded, other=None):
+	"""
+	This function computes the matrix of Hamming (edit) distances between the 
+	rows of an encoded sequence matrix (see the "encode_records" function 
+	above), and the rows of another encoded matrix if one is specified.
+
+	For each letter of the alphabet, the number of positions at which a pair 
+	of sequences share that letter is computed as a matrix product of 0/1 
+	indicator matrices. Summing over all letters gives the number of 
+	identical positions, and the distance is the remainder. Each sum is an 
+	integer no larger than the sequence length, so float32 products are 
+	exact.
+
+	Returns: an integer matrix of shape (len(encoded), len(other)).
+	"""
+	if other is None:
+		other = encoded
+
+	length = encoded.shape[1]
+	if other.shape[1] != length:
+		raise ValueError('The input sequences must be of equal length.')
+
+	matches = np.zeros((encoded.shape[0], other.shape[0]), dtype=np.float32)
+	for letter in np.union1d(np.unique(encoded), np.unique(other)):
+		indicator1 = (encoded == letter).astype(np.float32)
+		indicator2 = (other == letter).astype(np.float32)
+		matches += indicator1.dot(indicator2.T)
+
+	distances = length - np.rint(matches).astype(np.int64)
+
+	return distances
+
+def compute_pwi_matrix(distances, length):
+	"""
+	This function converts a matrix of edit distances into a matrix of 
+	pair-wise identities (PWI), using the same formula as the edge weights in 
+	the add_edges_from_records function.
+	"""
+	weights = 1 - distances / float(length)
+
+	return weights
+
+def cached_distance_matrix(records, cache=None):
+	"""
+	This function returns the matrix of edit distances between a list of 
+	SeqRecord objects. If a DistanceCache is specified, the matrix is read 
+	from it when the same records have been seen before (memory-mapped, with 
+	its stored dtype), and is added to it otherwise.
+	"""
+	if cache is None:
+		return compute_distance_matrix(encode_records(records))
+
+	key = cache.key(records)
+	ids = [get_id(record) for record in records]
+	entry = cache.get(key, nodes=ids)
+	if entry is not None:
+		return entry[0]
+
+	encoded = encode_records(records)
+	distances = compute_distance_matrix(encoded)
+	cache.put(key, distances.astype(distance_dtype(encoded.shape[1])), ids)
+
+	return distances
+
+def add_edges_from_records(graph, records, segment, cache=None):
 	"""
 	This function will construct a fully connected graph between all pairs of nodes,
 	for a particular segment, and will compute the pair-wise identity (PWI) for each
@@ -60,15 +149,22 @@ def add_edges_from_records(graph, records, segment):
 	It takes in a graph, a list of SeqRecord objects, and an integer number.
 
 	Basically, it will create a segment transmission graph.
+
+	The distances are computed for all pairs at once using the 
+	"compute_distance_matrix" function, or read from a DistanceCache if one 
+	is specified.
 	"""
-	for n1, record1 in enumerate(records):
-		for n2, record2 in enumerate(records):
-			if n1 != n2:
-				edit_distance = compute_edit_distance(record1.seq, record2.seq)
-				weight = 1 - float(edit_distance) / len(record1.seq)
+	distances = cached_distance_matrix(records, cache=cache)
+	length = len(records[0].seq) if len(records) > 0 else 0
+	weights = compute_pwi_matrix(distances, length)
 
-				graph.add_edge(get_id(record1), get_id(record2), segment=segment, \
-					distance=edit_distance, weight=weight)
+	ids = [get_id(record) for record in records]
+	for n1, id1 in enumerate(ids):
+		for n2, id2 in enumerate(ids):
+			if n1 != n2:
+				graph.add_edge(id1, id2, segment=segment, \
+					distance=int(distances[n1, n2]), \
+					weight=float(weights[n1, n2]))
 
 def remove_edges_below_threshold(graph, threshold):
 	"""
@@ -114,28 +210,413 @@ def remove_edges_not_max(graph):
 					graph.remove_edge(sourcenode, sinknode)
 
 
-def standard_processing(seqrecords, segment):
+def standard_processing(seqrecords, segment, block_size=None, filename=None, \
+	cache=None):
 	"""
 	Treat this function as a script that does the standard processing of the data.
 	See comments below to make sense of it.
+
+	If a block_size is specified, the processing is done in the tiled mode 
+	of the "blocked_processing" function below, which never holds the full 
+	distance matrix in memory.
+
+	If a DistanceCache is specified, the distance matrix is reused from 
+	earlier runs on the same sequences.
 	"""
+	if block_size is not None:
+		return blocked_processing(seqrecords, segment, block_size=block_size, \
+			filename=filename, cache=cache)
 
 	# Initialize a graph
 	graph = nx.DiGraph()
 	# Add in nodes
 	add_nodes_from_records(graph, seqrecords)
-	# Add in edges between nodes
-	add_edges_from_records(graph, seqrecords, segment)
-	# Remove incorrectly timed edges
-	remove_incorrectly_timed_edges(graph)
-	# Remove edges below median PWI. This potentially helps separate two 
-	# infections
-	matrix_values = nx.adjacency_matrix(graph).flat
-	remove_edges_below_threshold(graph, median(matrix_values))
-	# Remove edges that are non-maximum.
-	remove_edges_not_max(graph)
+	if len(seqrecords) == 0:
+		return graph
+
+	# Compute the distances between all pairs of nodes. The pruning steps 
+	# below are applied to this matrix, and only the edges that are kept are 
+	# added to the graph.
+	ids = [get_id(record) for record in seqrecords]
+	dates = get_dates(seqrecords)
+	distances = cached_distance_matrix(seqrecords, cache=cache)
+	num_sequences = len(seqrecords)
+	length = len(seqrecords[0].seq)
+
+	# Remove edges below median PWI, over the edges that are correctly timed 
+	# (the others count as 0). This potentially helps separate two infections
+	counts = count_distances(distances, dates, dates, length, \
+		exclude_diagonal=True)
+	threshold = median_threshold_from_counts(counts, num_sequences ** 2, \
+		length)
+
+	# Remove incorrectly timed edges, edges below the threshold, and edges 
+	# that are non-maximum.
+	prune_distance_matrix(graph, ids, segment, distances, dates, length, \
+		threshold)
+
+	return graph
+
+######## The following functions pertain to the tiled (out-of-core) mode of the      ########
+######## standard processing, for sequence sets whose distance matrix does not fit   ########
+######## in memory.                                                                   ########
+
+def get_dates(records):
+	"""
+	This function returns the creation dates of a list of SeqRecord objects as 
+	a NumPy integer array.
+	"""
+	dates = np.array([int(get_date(record)) for record in records], \
+		dtype=np.int64)
+
+	return dates
+
+def distance_dtype(length):
+	"""
+	This function returns the smallest unsigned integer type that can store 
+	the edit distances between sequences of the specified length.
+	"""
+	if length < 2 ** 16:
+		return np.uint16
+	else:
+		return np.uint32
+
+def count_distances(distances, source_dates, sink_dates, length, \
+	exclude_diagonal=False):
+	"""
+	This function counts how often each edit distance occurs in a block of the 
+	distance matrix (rows are sources, columns are sinks), among the edges 
+	that are correctly timed. See the "remove_incorrectly_timed_edges" 
+	function above.
+
+	Returns: an array of length (length + 1), in which the value at position d 
+	is the number of correctly timed edges with an edit distance of d.
+	"""
+	valid = source_dates[:, None] <= sink_dates[None, :]
+	if exclude_diagonal:
+		np.fill_diagonal(valid, False)
+
+	counts = np.bincount(distances[valid].astype(np.int64), \
+		minlength=length + 1)
+
+	return counts
+
+def median_threshold_from_counts(counts, num_entries, length):
+	"""
+	This function computes the median PWI threshold used in standard_processing 
+	from a histogram of edit distances (see the "count_distances" function 
+	above), without building the adjacency matrix.
+
+	The adjacency matrix has num_entries (N x N) entries. Correctly timed 
+	edges contribute their weight; the diagonal and incorrectly timed edges 
+	contribute 0. Because PWI values are determined by the integer edit 
+	distance, the histogram gives the exact median.
+	"""
+	# Weights in ascending order: 0 for the missing edges, then decreasing 
+	# edit distances.
+	num_missing = num_entries - counts.sum()
+	distances = np.arange(length, -1, -1)
+	values = np.concatenate([[0.0], compute_pwi_matrix(distances, length)])
+	value_counts = np.concatenate([[num_missing], counts[::-1]])
+	cumulative_counts = np.cumsum(value_counts)
+
+	def value_at(rank):
+		return values[np.searchsorted(cumulative_counts, rank, side='right')]
+
+	if num_entries % 2 == 1:
+		return value_at(num_entries // 2)
+	else:
+		return (value_at(num_entries // 2 - 1) + value_at(num_entries // 2)) / 2
+
+def compute_distance_matrix_blocked(encoded, dates, filename, block_size=1000, \
+	distances=None):
+	"""
+	This function computes the full matrix of edit distances between the rows 
+	of an encoded sequence matrix one tile at a time, streaming each tile into 
+	a memory-mapped file on disk. Only the upper triangle of tiles is 
+	computed; each tile is mirrored into the lower triangle.
+
+	While the tiles are computed, the histogram of correctly timed edit 
+	distances is accumulated, so that the median threshold can be computed 
+	without a second pass over the matrix.
+
+	If distances is specified, the matrix is written into it (e.g. a 
+	memory-mapped matrix created by a DistanceCache) instead of into a new 
+	file.
+
+	Returns: a tuple of (memory-mapped distance matrix, distance histogram).
+	"""
+	num_sequences, length = encoded.shape
+
+	if distances is None:
+		distances = np.memmap(filename, dtype=distance_dtype(length), \
+			mode='w+', shape=(num_sequences, num_sequences))
+	counts = np.zeros(length + 1, dtype=np.int64)
+
+	for start1 in range(0, num_sequences, block_size):
+		rows = slice(start1, min(start1 + block_size, num_sequences))
+		for start2 in range(start1, num_sequences, block_size):
+			columns = slice(start2, min(start2 + block_size, num_sequences))
+
+			block = compute_distance_matrix(encoded[rows], encoded[columns])
+			distances[rows, columns] = block
+			counts += count_distances(block, dates[rows], dates[columns], \
+				length, exclude_diagonal=(start1 == start2))
+
+			if start1 != start2:
+				distances[columns, rows] = block.T
+				counts += count_distances(block.T, dates[columns], \
+					dates[rows], length)
+
+	distances.flush()
+
+	return distances, counts
+
+def count_distances_blocked(distances, dates, length, block_size=1000):
+	"""
+	This function accumulates the histogram of correctly timed edit distances 
+	of a full distance matrix (e.g. one read from a DistanceCache), reading 
+	it in blocks of block_size rows.
+	"""
+	num_sequences = len(dates)
+	counts = np.zeros(length + 1, dtype=np.int64)
+
+	for start in range(0, num_sequences, block_size):
+		rows = np.arange(start, min(start + block_size, num_sequences))
+		valid = dates[rows][:, None] <= dates[None, :]
+		valid[np.arange(len(rows)), rows] = False
+		counts += np.bincount(np.asarray(distances[rows])[valid].astype( \
+			np.int64), minlength=length + 1)
+
+	return counts
+
+def prune_distance_block(distances, source_dates, sink_dates, sink_indices, \
+	length, threshold):
+	"""
+	This function applies the pruning steps of standard_processing to a block 
+	of the distance matrix, in which each row holds the distances from all of 
+	the sources to one sink. The steps are:
+
+	1. Remove incorrectly timed edges, and edges from a node to itself.
+	2. Remove edges with a weight below the threshold.
+	3. Remove edges that are not the maximum weight into their sink.
+
+	The weight decreases with the edit distance, so the steps are applied to 
+	the distances in their stored (narrow) dtype: the threshold becomes a 
+	maximum distance, and the maximum weight the minimum distance. Weights 
+	are only computed for the edges that are kept.
+
+	Returns: a tuple of arrays (sources, sinks, distances, weights) for the 
+	edges that are kept.
+	"""
+	num_sinks = len(sink_indices)
+
+	# The largest edit distance whose weight is no lower than the threshold, 
+	# using the same formula as the weights themselves.
+	allowed = np.nonzero(compute_pwi_matrix(np.arange(length + 1), length) \
+		>= threshold)[0]
+
+	if len(source_dates) == 0 or num_sinks == 0 or len(allowed) == 0:
+		empty = np.zeros(0, dtype=np.int64)
+		return empty, empty, empty, np.zeros(0)
+
+	distances = np.asarray(distances)
+
+	valid = source_dates[None, :] <= sink_dates[:, None]
+	valid[np.arange(num_sinks), sink_indices] = False
+	valid &= distances <= allowed.max()
+
+	masked_distances = np.where(valid, distances, \
+		np.iinfo(distances.dtype).max).astype(distances.dtype)
+	min_distances = masked_distances.min(axis=1)
+	keep = valid & (masked_distances == min_distances[:, None])
+
+	sinks, sources = np.nonzero(keep)
+	kept_distances = distances[sinks, sources]
+
+	return sources, sink_indices[sinks], kept_distances, \
+		compute_pwi_matrix(kept_distances, length)
+
+def add_edges_from_arrays(graph, ids, segment, sources, sinks, distances, \
+	weights):
+	"""
+	This function adds the edges described by arrays of source and sink 
+	indices (into the list of ids) to a graph, with the same edge attributes 
+	as the add_edges_from_records function.
+	"""
+	for source, sink, distance, weight in zip(sources, sinks, distances, \
+		weights):
+		graph.add_edge(ids[source], ids[sink], segment=segment, \
+			distance=int(distance), weight=float(weight))
+
+def prune_distance_matrix(graph, ids, segment, distances, dates, length, \
+	threshold, block_size=1000):
+	"""
+	This function applies the "prune_distance_block" function to a full, 
+	symmetric distance matrix in blocks of block_size sinks, and adds the 
+	edges that are kept to the graph. Only one block of weights and masks 
+	is held in memory at a time.
+	"""
+	num_sequences = len(ids)
+
+	# The distance matrix is symmetric, so row j holds the distances from 
+	# every source into sink j.
+	for start in range(0, num_sequences, block_size):
+		sink_indices = np.arange(start, min(start + block_size, num_sequences))
+		edges = prune_distance_block(distances[sink_indices], dates, \
+			dates[sink_indices], sink_indices, length, threshold)
+		add_edges_from_arrays(graph, ids, segment, *edges)
+
+def blocked_processing(seqrecords, segment, block_size=1000, filename=None, \
+	cache=None):
+	"""
+	This function is the tiled equivalent of standard_processing, for sequence 
+	sets whose N x N distance matrix does not fit in memory. It returns the 
+	same graph as standard_processing.
+
+	1. The distance matrix is streamed, one tile at a time, into a 
+	   memory-mapped file (a temporary file if no filename is specified).
+	2. The median threshold is computed from the histogram of distances 
+	   accumulated in step 1.
+	3. The matrix is read back in blocks of block_size sinks, and each block 
+	   is pruned with the "prune_distance_block" function.
+
+	Only the pruned edges are added to the graph.
+
+	If a DistanceCache is specified, the distance matrix is computed directly 
+	into the cache in step 1, or, if the same records have been seen before, 
+	read back from it memory-mapped, in which case step 1 only accumulates 
+	the histogram.
+	"""
+	remove_file = filename is None and cache is None
+	if remove_file:
+		handle, filename = mkstemp(suffix='.distances')
+		os.close(handle)
+
+	try:
+		graph = nx.DiGraph()
+		add_nodes_from_records(graph, seqrecords)
+
+		ids = [get_id(record) for record in seqrecords]
+		dates = get_dates(seqrecords)
+		encoded = encode_records(seqrecords)
+		num_sequences, length = encoded.shape
+
+		key = None
+		entry = None
+		if cache is not None:
+			key = cache.key(seqrecords)
+			entry = cache.get(key, nodes=ids)
+
+		if entry is not None:
+			distances = entry[0]
+			counts = count_distances_blocked(distances, dates, length, \
+				block_size=block_size)
+		else:
+			stored = None
+			if cache is not None:
+				stored = cache.create(key, (num_sequences, num_sequences), \
+					distance_dtype(length))
+			try:
+				distances, counts = compute_distance_matrix_blocked(encoded, \
+					dates, filename, block_size=block_size, distances=stored)
+				if cache is not None:
+					cache.commit(key, distances, ids)
+			finally:
+				if stored is not None:
+					cache.discard(stored)
+		threshold = median_threshold_from_counts(counts, num_sequences ** 2, \
+			length)
+
+		prune_distance_matrix(graph, ids, segment, distances, dates, length, \
+			threshold, block_size=block_size)
+
+		del distances
+
+	finally:
+		if remove_file:
+			os.remove(filename)
+
 	return graph
 
+def graph_to_sparse(graph, positions):
+	"""
+	This function returns the edges of a graph as two sparse matrices in the 
+	node order given by the positions dictionary: one with a 1 for each edge 
+	(its votes), and one with the edge weights.
+	"""
+	num_nodes = len(positions)
+	edges = list(graph.edges(data=True))
+
+	sources = np.array([positions[edge[0]] for edge in edges], dtype=np.int64)
+	sinks = np.array([positions[edge[1]] for edge in edges], dtype=np.int64)
+	weights = np.array([edge[2].get('weight', 1) for edge in edges], \
+		dtype=np.float64)
+
+	votes = sparse.csr_matrix((np.ones(len(edges), dtype=np.int64), \
+		(sources, sinks)), shape=(num_nodes, num_nodes))
+	weights = sparse.csr_matrix((weights, (sources, sinks)), \
+		shape=(num_nodes, num_nodes))
+
+	return votes, weights
+
+def consensus_graph(graphs, min_segments=None):
+	"""
+	This function takes in any number of per-segment graphs, and does the 
+	following:
+
+	1. Removes edges that are present in fewer than min_segments graphs. By 
+	   default, min_segments is the number of graphs, i.e. only the edges 
+	   present in every graph are kept.
+	2. Sums up the weights of each edge that is kept over the graphs in which 
+	   it is present.
+
+	The graphs are converted to sparse matrices over the union of their 
+	nodes, so the votes and weights of all edges are summed in vectorized 
+	form, in time linear in the number of edges.
+
+	Returns: a graph of the same type as the first graph, with all of the 
+	nodes of the graphs. Each edge has the attributes of the first graph in 
+	which it is present, with the summed weight.
+	"""
+	if len(graphs) == 0:
+		raise ValueError('At least one graph must be specified!')
+	if min_segments is None:
+		min_segments = len(graphs)
+
+	G_all = graphs[0].__class__()
+	for graph in graphs:
+		for node, attributes in graph.nodes(data=True):
+			if node not in G_all:
+				G_all.add_node(node, **attributes)
+
+	nodes = list(G_all.nodes())
+	positions = dict((node, i) for i, node in enumerate(nodes))
+
+	total_votes = sparse.csr_matrix((len(nodes), len(nodes)), dtype=np.int64)
+	total_weights = sparse.csr_matrix((len(nodes), len(nodes)))
+	for graph in graphs:
+		votes, weights = graph_to_sparse(graph, positions)
+		total_votes = total_votes + votes
+		total_weights = total_weights + weights
+
+	total_votes = total_votes.tocoo()
+	kept = total_votes.data >= min_segments
+	sources = total_votes.row[kept]
+	sinks = total_votes.col[kept]
+	weights = np.asarray(total_weights[sources, sinks]).ravel()
+
+	for source, sink, weight in zip(sources, sinks, weights):
+		edge = (nodes[source], nodes[sink])
+		for graph in graphs:
+			if graph.has_edge(*edge):
+				attributes = dict(graph.get_edge_data(*edge))
+				break
+		attributes['weight'] = float(weight)
+		G_all.add_edge(edge[0], edge[1], **attributes)
+
+	return G_all
+
 def add_two_graph_overlapping_edges(G0, G1):
 	"""
 	This function takes in two graphs, and does the following:
@@ -143,24 +624,11 @@ def add_two_graph_overlapping_edges(G0, G1):
 	1. Removes edges not present in both graphs.
 	2. Sums up the weights for each edge that is present in both graphs.
 
+	See the "consensus_graph" function above, for any number of graphs.
+
 	Returns: G_all, a graph of the same type as G0.
 	"""
-	G_all = G0.copy()
-	G_all.edges(data=True)
-	for edge in G_all.edges():
-		if edge not in G1.edges():
-			G_all.remove_edge(edge[0], edge[1])
-
-		if edge in G1.edges():
-			other_edge_index = G1.edges().index(edge)
-			other_edge = G1.edges(data=True)[other_edge_index]
-
-			edge_index = G_all.edges().index(edge)
-			edge = G_all.edges(data=True)[edge_index]
-
-			edge[2]['weight'] += other_edge[2]['weight']
-			
-	return G_all
+	return consensus_graph([G0, G1])
 
 ######## The following functions pertain to measuring accuracy of edge reconstruction ########
 
@@ -258,8 +726,8 @@ def permute_edges(G):
     """
     
     # Grab nodes and edges data from passed in graph.
-    edges = G.edges(data=True)
-    nodes = G.nodes()
+    edges = list(G.edges(data=True))
+    nodes = list(G.nodes())
     num_of_edges = len(edges)
 
     
@@ -268,7 +736,7 @@ def permute_edges(G):
     new_graph.remove_edges_from(edges)
     
     
-    while len(new_graph.edges()) < len(G.edges()):
+    while new_graph.number_of_edges() < num_of_edges:
         # Randomly choose an edge and its attributes
         edge = choice(edges)
         attributes = edge[2]
@@ -280,8 +748,8 @@ def permute_edges(G):
         
         # If the edge is not already present in the new graph,
         # add it to the graph with the chosen edge's attributes.
-        if (node1, node2) not in new_graph.edges():
-            new_graph.add_edge(node1, node2, attributes)
+        if not new_graph.has_edge(node1, node2):
+            new_graph.add_edge(node1, node2, **attributes)
             edges.pop(index)
     
     return new_graph
@@ -0,0 +1,219 @@
+from multiprocessing import Pool, cpu_count
+
+import numpy as np
+
+from id_generator import IdAllocator, get_allocator, set_allocator, \
+	NAMESPACE_BITS, COUNTER_BITS
+from population import ArrayPopulation, GenotypePopulation
+from genealogy import Genealogy
+
+# IDs that are allocated inside a worker process are temporary: they are
+# allocated under this reserved namespace, and are replaced by IDs from the
+# allocator of the main process when the results come back.
+WORKER_NAMESPACE = 2 ** NAMESPACE_BITS - 1
+
+def host_rng(seed, timestep, environment_index, host_index):
+	"""
+	This function returns the random number source of one host at one
+	timestep. It only depends on the seed and on the position of the host, so
+	the draws of a host do not depend on how the hosts are sharded across
+	worker processes.
+	"""
+	sequence = np.random.SeedSequence([seed, timestep, environment_index, \
+		host_index])
+
+	return np.random.RandomState(sequence.generate_state(4))
+
+def export_host(host, seed, environment_index, host_index, engine=None):
+	"""
+	This function packs everything that is needed to step a host into a
+	compact tuple: the scalar parameters of the host, the templates and the
+	NumPy arrays of its population. No Virus objects are created.
+	"""
+	if not isinstance(host.viruses, ArrayPopulation):
+		raise ValueError('Parallel stepping requires an array population!')
+
+	population = host.viruses
+	timestep = host.environment.current_time
+	parameters = dict(
+		immune_halftime=host.immune_halftime,
+		max_viruses=host.max_viruses,
+		infection_time=max(host.infection_history.keys()),
+		current_time=timestep,
+		batched_replication=host.batched_replication,
+		deduplicate_genotypes=isinstance(population, GenotypePopulation),
+		record_genealogy=host.environment.genealogy is not None,
+		rng=host_rng(seed, timestep, environment_index, host_index))
+
+	return (parameters, population.templates, population.template_keys, \
+		population.to_arrays(), engine)
+
+def step_host(state):
+	"""
+	This function steps one exported host, and returns the arrays of its
+	population, the number of temporary IDs that were allocated, and the
+	genealogy records of the progeny (or None).
+
+	It runs in a worker process; it can also be called directly.
+	"""
+	from environment import Environment
+	from host import Host
+
+	parameters, templates, template_keys, arrays, engine = state
+
+	# The IDs of the stand-in environment and host, and of the progeny, are 
+	# all temporary, so that the allocator of the main process is untouched.
+	allocator = get_allocator()
+	set_allocator(IdAllocator(namespace=WORKER_NAMESPACE))
+	try:
+		environment = Environment()
+		environment.current_time = parameters['current_time']
+		if parameters['record_genealogy']:
+			environment.genealogy = Genealogy()
+
+		host = Host(environment, immune_halftime=parameters['immune_halftime'], \
+			array_population=True, \
+			batched_replication=parameters['batched_replication'], \
+			deduplicate_genotypes=parameters['deduplicate_genotypes'])
+		host.max_viruses = parameters['max_viruses']
+		host.set_infection_history(parameters['infection_time'], None)
+
+		host.viruses.templates = templates
+		host.viruses.template_keys = template_keys
+		host.viruses.load_arrays(arrays)
+		host.set_rng(parameters['rng'])
+
+		temporary_allocator = IdAllocator(namespace=WORKER_NAMESPACE)
+		set_allocator(temporary_allocator)
+
+		if engine is None:
+			host.allow_one_cycle_of_replication()
+		else:
+			engine.advance(host)
+	finally:
+		set_allocator(allocator)
+
+	records = None
+	genealogy = environment.genealogy
+	if genealogy is not None:
+		records = dict((column, getattr(genealogy, column).values().copy()) \
+			for column in ('ids', 'parents', 'creation_times', 'mutation_ids', \
+			'mutation_segments', 'mutation_positions', 'mutation_letters'))
+
+	return host.viruses.to_arrays(), temporary_allocator.next_counter, records
+
+def replace_temporary_ids(ids, new_ids):
+	"""
+	This function returns a copy of an array of IDs, in which the temporary
+	IDs with counter i are replaced by new_ids[i].
+	"""
+	ids = np.array(ids, dtype=np.int64)
+	temporary = (ids >> COUNTER_BITS) == WORKER_NAMESPACE
+	ids[temporary] = new_ids[ids[temporary] & (2 ** COUNTER_BITS - 1)]
+
+	return ids
+
+def import_host(host, result):
+	"""
+	This function writes the result of step_host back into a host. The
+	temporary IDs are replaced by new IDs from the current allocator, and the
+	genealogy records are added to the genealogy of the environment.
+	"""
+	arrays, num_allocated, records = result
+	new_ids = get_allocator().allocate_many(num_allocated)
+
+	for column in ('ids', 'parents', 'mutation_ids'):
+		arrays[column] = replace_temporary_ids(arrays[column], new_ids)
+	host.viruses.load_arrays(arrays)
+	host.update_state()
+
+	genealogy = host.environment.genealogy
+	if records is not None and genealogy is not None:
+		ids = replace_temporary_ids(records['ids'], new_ids)
+		genealogy.record(ids, replace_temporary_ids(records['parents'], \
+			new_ids), np.full(len(ids), host.id, dtype=np.int64), \
+			records['creation_times'], mutations=( \
+			replace_temporary_ids(records['mutation_ids'], new_ids), \
+			records['mutation_segments'], records['mutation_positions'], \
+			records['mutation_letters']))
+
+class ParallelStepper(object):
+	"""
+	The ParallelStepper steps the infected hosts of a Controller in a pool of
+	worker processes. Hosts are independent within a timestep, so each host
+	is exported in a compact form (the NumPy arrays of its ArrayPopulation),
+	stepped in a worker, and written back.
+
+	Each host draws its random numbers from its own stream, seeded by the
+	seed, the timestep and the position of the host in the controller's
+	environments; new IDs are assigned in the main process, in host order.
+	Therefore, a run is reproducible for a given seed, regardless of the
+	number of workers.
+
+	----------
+
+	ATTRIBUTES
+
+	- INTEGER: num_workers
+		the number of worker processes. If it is 1, the hosts are stepped in
+		the main process, without a pool.
+
+	- INTEGER: seed
+		the seed of the random number streams of the hosts.
+
+	- OBJECT: engine
+		an optional within-host engine (e.g. a TauLeapingEngine) that is
+		used instead of one cycle of replication.
+	"""
+
+	def __init__(self, num_workers=None, seed=0, engine=None):
+		super(ParallelStepper, self).__init__()
+
+		self.num_workers = num_workers
+		self.seed = seed
+		self.engine = engine
+
+		self.pool = None
+
+	def __repr__(self):
+		return "ParallelStepper with %s workers" % self.num_workers
+
+	def get_pool(self):
+		if self.pool is None:
+			self.pool = Pool(processes=self.num_workers)
+
+		return self.pool
+
+	def close(self):
+		"""
+		This method shuts down the worker processes.
+		"""
+		if self.pool is not None:
+			self.pool.close()
+			self.pool.join()
+			self.pool = None
+
+	def step(self, environments):
+		"""
+		This method steps all of the infected hosts in a list of environments
+		by one timestep.
+		"""
+		hosts = []
+		states = []
+		for environment_index, environment in enumerate(environments):
+			for host_index, host in enumerate(environment.hosts):
+				if len(host.viruses) > 0:
+					hosts.append(host)
+					states.append(export_host(host, self.seed, \
+						environment_index, host_index, engine=self.engine))
+
+		if self.num_workers == 1:
+			results = [step_host(state) for state in states]
+		else:
+			num_workers = self.num_workers or cpu_count()
+			chunksize = max(1, len(states) // (4 * num_workers))
+			results = self.get_pool().map(step_host, states, \
+				chunksize=chunksize)
+
+		for host, result in zip(hosts, results):
+			import_host(host, result)
@@ -0,0 +1,1125 @@
+from copy import copy
+from random import choice
+from id_generator import as_id, generate_id, get_allocator
+from genealogy import genealogy_of
+
+import numpy as np
+
+def allocate_virus_ids(num_ids):
+	"""
+	This function returns a NumPy array of num_ids new, unique integer virus
+	IDs from the current ID allocator.
+	"""
+	return get_allocator().allocate_many(num_ids)
+
+def choose_new_letter(letter, rng=None):
+	"""
+	This function chooses a new letter from ATGC that is different from the
+	letter passed into the function. It is identical to the function used in
+	Segment.mutate, but the letter can also be drawn from a NumPy random
+	number source.
+	"""
+	possible_letters = sorted(set(['A', 'T', 'G', 'C']).difference(set(letter)))
+	if rng is None:
+		new_letter = choice(possible_letters)
+	else:
+		new_letter = possible_letters[rng.randint(len(possible_letters))]
+
+	return new_letter
+
+# Lookup table from the ASCII code of a nucleotide to its index in "ATGC".
+_NUCLEOTIDES = np.frombuffer(b'ATGC', dtype=np.uint8)
+_NUCLEOTIDE_INDICES = np.zeros(256, dtype=np.int64)
+_NUCLEOTIDE_INDICES[_NUCLEOTIDES] = np.arange(4)
+
+def draw_parents(num_viruses, burst_minimums, burst_maximums, rng=np.random, \
+	weights=None):
+	"""
+	This function draws parents uniformly at random, with replacement, from 
+	the candidates whose burst size ranges are given, along with a burst size 
+	for each parent. Parents are drawn until the total burst size reaches 
+	num_viruses, exactly as in Host.generate_viral_progeny, but the draws are 
+	made in batches rather than one parent at a time.
+
+	If weights are specified, each candidate is drawn with probability 
+	proportional to its weight instead.
+
+	Returns: a tuple of arrays (parents, burst sizes).
+	"""
+	parents = np.zeros(0, dtype=np.int64)
+	burst_sizes = np.zeros(0, dtype=np.int64)
+	total = 0
+
+	while total < num_viruses:
+		num_draws = int(np.ceil(float(num_viruses - total) / \
+			max(burst_minimums.min(), 1)))
+		if weights is None:
+			new_parents = rng.randint(0, len(burst_minimums), size=num_draws)
+		else:
+			new_parents = rng.choice(len(burst_minimums), size=num_draws, \
+				p=weights)
+		new_burst_sizes = rng.randint(burst_minimums[new_parents], \
+			burst_maximums[new_parents] + 1)
+
+		parents = np.concatenate([parents, new_parents])
+		burst_sizes = np.concatenate([burst_sizes, new_burst_sizes])
+		total = burst_sizes.sum()
+
+	# Keep the parents up to (and including) the first one at which the total 
+	# burst size reaches num_viruses.
+	num_parents = np.searchsorted(np.cumsum(burst_sizes), num_viruses) + 1
+	num_parents = min(num_parents, len(parents))
+
+	return parents[:num_parents], burst_sizes[:num_parents]
+
+def draw_mutation_positions(num_positions, length, rng=np.random):
+	"""
+	This function draws, for each entry of num_positions, that many distinct 
+	positions uniformly at random within range(0, length), as in 
+	Segment.mutate.
+
+	Entries of 1 (by far the most common non-zero case) are drawn in a single 
+	call; the rare entries of 2 or more are drawn one at a time, without 
+	replacement.
+
+	Returns: a tuple of arrays (entry index, position).
+	"""
+	singles = np.nonzero(num_positions == 1)[0]
+	owners = [singles]
+	positions = [rng.randint(0, length, size=len(singles))]
+
+	for owner in np.nonzero(num_positions > 1)[0]:
+		owners.append(np.full(num_positions[owner], owner, dtype=np.int64))
+		positions.append(rng.choice(length, num_positions[owner], \
+			replace=False))
+
+	return np.concatenate(owners), np.concatenate(positions)
+
+class ArrayPopulation(object):
+	"""
+	The ArrayPopulation is an array-backed alternative to the list of Virus
+	objects held by a Host. Rather than storing one Virus object (with its
+	own ID string, list of Segment objects and copied attributes) per viral
+	particle, it stores the population as a struct of NumPy arrays, with one
+	entry per virus.
+
+	Everything that is shared by all of the descendants of a virus - the
+	seed sequences and substitution rates of the segments, the burst size
+	range and the replication time - is stored once, in a "template" Virus
+	object. Virus objects are only materialized (as "views") when a caller
+	asks for them, e.g. when the Sampler samples viruses from a Host.
+
+	----------
+
+	ATTRIBUTES
+
+	- HOST: host
+		the Host object that the population lives in. This is None for
+		detached populations, such as newly generated progeny or viruses in
+		transit between two hosts.
+
+	- LIST OF VIRUS OBJECTS: templates
+		the template viruses, without mutations.
+
+	- NUMPY ARRAYS: ids, parents, creation_dates, template_indices
+		one entry per virus. The parent of a founder virus is -1. Particles
+		copied from a GenotypePopulation share the ID of their genotype.
+
+	- NUMPY ARRAYS: mutation_ids, mutation_segments, mutation_positions,
+	  mutation_letters
+		the mutation table, with one entry per (virus, segment, position) that
+		differs from the template's seed sequence. Letters are stored as ASCII
+		codes.
+
+	- RANDOM STATE: rng
+		the source of random numbers. Defaults to the numpy.random module.
+
+	----------
+
+	MAIN METHODS
+
+	- generate_progeny:
+		a method that returns a detached population of progeny, generated in
+		the same way as Host.generate_viral_progeny.
+
+	- generate_progeny_batched:
+		a method that generates the same distribution of progeny as
+		generate_progeny, but makes all of the random draws for a generation
+		in a few NumPy calls.
+
+	- take:
+		a method that removes a set of viruses, and returns them as a detached
+		population.
+
+	- extend:
+		a method that adds the viruses of a detached population.
+
+	- views:
+		a method that materializes Virus objects for a set of viruses.
+	"""
+
+	# The per-virus and per-mutation arrays that hold the state of the
+	# population (apart from its templates).
+	columns = ('ids', 'parents', 'creation_dates', 'template_indices', \
+		'mutation_ids', 'mutation_segments', 'mutation_positions', \
+		'mutation_letters')
+
+	def __init__(self, host=None):
+		super(ArrayPopulation, self).__init__()
+
+		self.host = host
+
+		self.rng = np.random
+
+		self.templates = []
+		self.template_keys = dict()
+
+		self.ids = np.zeros(0, dtype=np.int64)
+		self.parents = np.zeros(0, dtype=np.int64)
+		self.creation_dates = np.zeros(0, dtype=np.int64)
+		self.template_indices = np.zeros(0, dtype=np.int64)
+
+		self.mutation_ids = np.zeros(0, dtype=np.int64)
+		self.mutation_segments = np.zeros(0, dtype=np.int64)
+		self.mutation_positions = np.zeros(0, dtype=np.int64)
+		self.mutation_letters = np.zeros(0, dtype=np.uint8)
+
+	def __repr__(self):
+		return "ArrayPopulation of %s viruses" % len(self)
+
+	def __len__(self):
+		return len(self.ids)
+
+	def __iter__(self):
+		"""
+		Iterating over the population materializes a Virus view for every
+		virus in it. This exists for compatibility with code written for a
+		list of viruses; it should not be used on large populations.
+		"""
+		for index in range(len(self)):
+			yield self.view(index)
+
+	def __contains__(self, virus):
+		return bool(np.any(self.ids == virus.id))
+
+	def detached(self):
+		"""
+		This method returns an empty population that shares its templates
+		(and random number source) with this population, but that does not
+		live in a host.
+		"""
+		population = type(self)()
+		population.rng = self.rng
+		population.templates = self.templates
+		population.template_keys = self.template_keys
+
+		return population
+
+	def to_arrays(self):
+		"""
+		This method returns the state of the population (apart from its 
+		templates) as a dictionary of NumPy arrays, e.g. to send it to another 
+		process or to write it to disk.
+		"""
+		return dict((column, getattr(self, column)) for column in self.columns)
+
+	def load_arrays(self, arrays):
+		"""
+		This method replaces the state of the population with the arrays 
+		returned by to_arrays. The templates are left unchanged.
+		"""
+		for column in self.columns:
+			setattr(self, column, np.asarray(arrays[column]))
+
+	def template_key(self, virus):
+		"""
+		This method returns the key that identifies the template of a virus:
+		its class, seed sequences, substitution rates, burst size range and
+		replication time.
+		"""
+		segments = tuple((segment.segment_number, segment.substitution_rate, \
+			segment.seed_sequence) for segment in virus.segments)
+
+		return (type(virus), segments, tuple(virus.burst_size_range), \
+			virus.replication_time)
+
+	def add_template(self, virus):
+		"""
+		This method returns the index of the template matching a virus,
+		adding a new template (a copy of the virus without mutations) if
+		there is none.
+		"""
+		key = self.template_key(virus)
+
+		if key not in self.template_keys:
+			template = copy(virus)
+			template.host = None
+			template.parent = None
+			template.segments = []
+			for segment in virus.segments:
+				template_segment = copy(segment)
+				template_segment.mutations = dict()
+				template.segments.append(template_segment)
+
+			self.template_keys[key] = len(self.templates)
+			self.templates.append(template)
+
+		return self.template_keys[key]
+
+	def add_virus(self, virus):
+		"""
+		This method adds a Virus object to the population as a new row. If the
+		virus does not already have an integer ID, it is given one.
+		"""
+		self.add_viruses([virus])
+
+	def add_viruses(self, viruses):
+		"""
+		This method adds a list of Virus objects to the population as new
+		rows, with a single extend. Viruses without an integer ID are given
+		one; viruses whose ID is already present (or repeated in the list)
+		are skipped, as in add_virus.
+		"""
+		present = set(self.ids.tolist())
+
+		ids = []
+		parents = []
+		creation_dates = []
+		template_indices = []
+		mutations = []
+
+		for virus in viruses:
+			if not isinstance(virus.id, (int, np.integer)):
+				virus.id = generate_id(virus)
+
+			if virus.id in present:
+				continue
+			present.add(virus.id)
+
+			ids.append(virus.id)
+			parents.append(-1 if virus.parent is None else virus.parent)
+			creation_dates.append(virus.creation_date)
+			template_indices.append(self.add_template(virus))
+
+			mutations.extend((virus.id, segment_number, position, letter) for \
+				segment_number, segment in enumerate(virus.segments) for \
+				position, letter in segment.mutations.items())
+
+		if len(ids) == 0:
+			return
+
+		population = self.detached()
+		population.ids = np.array(ids, dtype=np.int64)
+		population.parents = np.array(parents, dtype=np.int64)
+		population.creation_dates = np.array(creation_dates, dtype=np.int64)
+		population.template_indices = np.array(template_indices, \
+			dtype=np.int64)
+
+		population.mutation_ids = np.array([mutation[0] for mutation in \
+			mutations], dtype=np.int64)
+		population.mutation_segments = np.array([mutation[1] for mutation in \
+			mutations], dtype=np.int64)
+		population.mutation_positions = np.array([mutation[2] for mutation in \
+			mutations], dtype=np.int64)
+		population.mutation_letters = np.array([ord(mutation[3]) for mutation \
+			in mutations], dtype=np.uint8)
+
+		self.extend(population)
+
+	def extend(self, other):
+		"""
+		This method appends all of the viruses in another population to this
+		population.
+		"""
+		if other.templates is self.templates:
+			template_indices = other.template_indices
+		else:
+			mapping = np.array([self.add_template(template) for template in \
+				other.templates], dtype=np.int64)
+			template_indices = mapping[other.template_indices]
+
+		# The mutations of a virus are stored once per ID, so those of IDs
+		# that are already present (i.e. particles of the same genotype) are
+		# not added again.
+		new_mutations = ~np.isin(other.mutation_ids, self.ids)
+
+		self.ids = np.concatenate([self.ids, other.ids])
+		self.parents = np.concatenate([self.parents, other.parents])
+		self.creation_dates = np.concatenate([self.creation_dates, \
+			other.creation_dates])
+		self.template_indices = np.concatenate([self.template_indices, \
+			template_indices])
+
+		self.mutation_ids = np.concatenate([self.mutation_ids, \
+			other.mutation_ids[new_mutations]])
+		self.mutation_segments = np.concatenate([self.mutation_segments, \
+			other.mutation_segments[new_mutations]])
+		self.mutation_positions = np.concatenate([self.mutation_positions, \
+			other.mutation_positions[new_mutations]])
+		self.mutation_letters = np.concatenate([self.mutation_letters, \
+			other.mutation_letters[new_mutations]])
+
+	def random_indices(self, num_viruses):
+		"""
+		This method returns the row indices of num_viruses viruses, chosen
+		uniformly at random without replacement.
+		"""
+		if num_viruses > len(self):
+			raise ValueError('Cannot choose more viruses than are present.')
+
+		return self.rng.choice(len(self), num_viruses, replace=False)
+
+	def select(self, indices):
+		"""
+		This method returns a detached copy of the viruses at the specified
+		row indices.
+		"""
+		indices = np.asarray(indices, dtype=np.int64)
+
+		population = self.detached()
+		population.ids = self.ids[indices]
+		population.parents = self.parents[indices]
+		population.creation_dates = self.creation_dates[indices]
+		population.template_indices = self.template_indices[indices]
+
+		selected = np.isin(self.mutation_ids, population.ids)
+		population.mutation_ids = self.mutation_ids[selected]
+		population.mutation_segments = self.mutation_segments[selected]
+		population.mutation_positions = self.mutation_positions[selected]
+		population.mutation_letters = self.mutation_letters[selected]
+
+		return population
+
+	def remove_indices(self, indices):
+		"""
+		This method removes the viruses at the specified row indices, along
+		with their rows in the mutation table (unless other particles with
+		the same ID remain).
+		"""
+		keep = np.ones(len(self.ids), dtype=bool)
+		keep[np.asarray(indices, dtype=np.int64)] = False
+
+		removed_ids = np.setdiff1d(self.ids[~keep], self.ids[keep])
+
+		self.ids = self.ids[keep]
+		self.parents = self.parents[keep]
+		self.creation_dates = self.creation_dates[keep]
+		self.template_indices = self.template_indices[keep]
+
+		keep_mutations = ~np.isin(self.mutation_ids, removed_ids)
+		self.mutation_ids = self.mutation_ids[keep_mutations]
+		self.mutation_segments = self.mutation_segments[keep_mutations]
+		self.mutation_positions = self.mutation_positions[keep_mutations]
+		self.mutation_letters = self.mutation_letters[keep_mutations]
+
+	def take(self, indices):
+		"""
+		This method removes the viruses at the specified row indices from the
+		population, and returns them as a detached population.
+		"""
+		taken = self.select(indices)
+		self.remove_indices(indices)
+
+		return taken
+
+	def take_random(self, num_viruses):
+		"""
+		This method removes num_viruses viruses, chosen uniformly at random
+		without replacement, and returns them as a detached population.
+		"""
+		return self.take(self.random_indices(num_viruses))
+
+	def burst_sizes(self, indices):
+		"""
+		This method returns a burst size for each of the viruses at the
+		specified row indices, chosen uniformly from their burst size ranges.
+		"""
+		templates = self.template_indices[np.asarray(indices, dtype=np.int64)]
+		minimums = np.array([template.burst_size_range[0] for template in \
+			self.templates], dtype=np.int64)[templates]
+		maximums = np.array([template.burst_size_range[1] for template in \
+			self.templates], dtype=np.int64)[templates]
+
+		return self.rng.randint(minimums, maximums + 1)
+
+	def num_progeny_made(self):
+		"""
+		This method precomputes the number of progeny to be made, in the same
+		way as Host.num_progeny_made.
+		"""
+		num_parents = self.rng.randint(0, len(self) + 1)
+		parents = self.random_indices(num_parents)
+
+		return int(self.burst_sizes(parents).sum())
+
+	def mutations(self, index):
+		"""
+		This method returns a list of dictionaries that record the mutations
+		of each segment of the virus at the specified row index, in the same
+		format as Virus.mutations.
+		"""
+		template = self.templates[self.template_indices[index]]
+		mutations = [dict() for segment in template.segments]
+
+		rows = np.nonzero(self.mutation_ids == self.ids[index])[0]
+		for row in rows:
+			segment_number = self.mutation_segments[row]
+			position = int(self.mutation_positions[row])
+			mutations[segment_number][position] = chr(self.mutation_letters[row])
+
+		return mutations
+
+	def inherited_mutation_rows(self, parent_ids):
+		"""
+		This method returns the rows of the mutation table belonging to each
+		of the specified parents, in order, along with the number of rows
+		belonging to each parent.
+		"""
+		order = np.argsort(self.mutation_ids, kind='mergesort')
+		sorted_ids = self.mutation_ids[order]
+
+		starts = np.searchsorted(sorted_ids, parent_ids, side='left')
+		ends = np.searchsorted(sorted_ids, parent_ids, side='right')
+		counts = ends - starts
+
+		offsets = np.repeat(starts - np.cumsum(counts) + counts, counts)
+		rows = order[offsets + np.arange(counts.sum())]
+
+		return rows, counts
+
+	def make_progeny(self, parent_rows, creation_date, new_mutations):
+		"""
+		This method writes a detached population of progeny in bulk.
+
+		INPUTS:
+		-	parent_rows: the row index of the parent of each progeny.
+		-	creation_date: the creation date of the progeny.
+		-	new_mutations: a tuple of arrays (progeny index, segment, position,
+			letter code) of the mutations that happened during replication.
+			These take precedence over the mutations inherited from the
+			parent at the same position.
+		"""
+		parent_rows = np.asarray(parent_rows, dtype=np.int64)
+		num_progeny = len(parent_rows)
+
+		progeny = self.detached()
+		progeny.ids = allocate_virus_ids(num_progeny)
+		progeny.parents = self.ids[parent_rows]
+		progeny.creation_dates = np.full(num_progeny, creation_date, \
+			dtype=np.int64)
+		progeny.template_indices = self.template_indices[parent_rows]
+
+		rows, counts = self.inherited_mutation_rows(progeny.parents)
+		children, segments, positions, letters = [np.asarray(column) for \
+			column in new_mutations]
+
+		mutation_ids = np.concatenate([np.repeat(progeny.ids, counts), \
+			progeny.ids[children.astype(np.int64)]])
+		mutation_segments = np.concatenate([self.mutation_segments[rows], \
+			segments.astype(np.int64)])
+		mutation_positions = np.concatenate([self.mutation_positions[rows], \
+			positions.astype(np.int64)])
+		mutation_letters = np.concatenate([self.mutation_letters[rows], \
+			letters.astype(np.uint8)])
+
+		# Keep only the last row for each (virus, segment, position), so that
+		# new mutations replace inherited ones.
+		if len(children) > 0:
+			order = np.lexsort((np.arange(len(mutation_ids)), \
+				mutation_positions, mutation_segments, mutation_ids))
+			keys = np.stack([mutation_ids[order], mutation_segments[order], \
+				mutation_positions[order]])
+			is_last = np.ones(len(order), dtype=bool)
+			is_last[:-1] = np.any(keys[:, 1:] != keys[:, :-1], axis=0)
+			keep = np.sort(order[is_last])
+
+			mutation_ids = mutation_ids[keep]
+			mutation_segments = mutation_segments[keep]
+			mutation_positions = mutation_positions[keep]
+			mutation_letters = mutation_letters[keep]
+
+		progeny.mutation_ids = mutation_ids
+		progeny.mutation_segments = mutation_segments
+		progeny.mutation_positions = mutation_positions
+		progeny.mutation_letters = mutation_letters
+
+		genealogy = genealogy_of(self.host)
+		if genealogy is not None:
+			genealogy.record(progeny.ids, progeny.parents, \
+				np.full(num_progeny, self.host.id, dtype=np.int64), \
+				progeny.creation_dates, mutations=( \
+				progeny.ids[children.astype(np.int64)], segments, positions, \
+				letters))
+
+		return progeny
+
+	def generate_progeny(self, num_viruses, creation_date):
+		"""
+		This method randomly samples from the current pool of viruses, and
+		generates at least num_viruses progeny from them, in the same way as
+		Host.generate_viral_progeny. Each progeny is mutated in the same way as
+		Segment.mutate, but no Virus or Segment objects are created.
+
+		Returns: a detached population of progeny.
+		"""
+		if len(self) == 0:
+			return self.detached()
+
+		parent_rows = []
+		while len(parent_rows) < num_viruses:
+			parent = self.rng.randint(len(self))
+			parent_rows.extend([parent] * self.burst_sizes([parent])[0])
+
+		new_mutations = ([], [], [], [])
+		parent_mutations = dict()
+		for child, parent in enumerate(parent_rows):
+			template = self.templates[self.template_indices[parent]]
+			for segment_number, segment in enumerate(template.segments):
+				p = float(segment.substitution_rate) / 365
+				num_positions = self.rng.binomial(segment.length, p)
+				if num_positions == 0:
+					continue
+
+				if parent not in parent_mutations:
+					parent_mutations[parent] = self.mutations(parent)
+				mutations = parent_mutations[parent][segment_number]
+
+				positions = self.rng.choice(segment.length, num_positions, \
+					replace=False)
+				for position in positions:
+					letter = mutations.get(position, \
+						segment.seed_sequence[position])
+
+					new_mutations[0].append(child)
+					new_mutations[1].append(segment_number)
+					new_mutations[2].append(position)
+					new_mutations[3].append(ord(choose_new_letter(letter, \
+						rng=self.rng)))
+
+		return self.make_progeny(parent_rows, creation_date, new_mutations)
+
+	def seed_codes(self, template_index, segment_number):
+		"""
+		This method returns the seed sequence of a template segment as an
+		array of ASCII codes.
+		"""
+		segment = self.templates[template_index].segments[segment_number]
+		return segment.seed_sequence.ascii_codes()
+
+	def current_letters(self, parent_ids, template_indices, segments, \
+		positions):
+		"""
+		This method returns the ASCII codes of the letters that the specified
+		parents carry at the specified (segment, position) pairs: the mutated
+		letter if the position is in the mutation table, and the seed letter
+		otherwise.
+		"""
+		letters = np.zeros(len(parent_ids), dtype=np.uint8)
+
+		for template_index in np.unique(template_indices):
+			template = self.templates[template_index]
+			for segment_number in range(len(template.segments)):
+				selected = (template_indices == template_index) & \
+					(segments == segment_number)
+				seed = self.seed_codes(template_index, segment_number)
+				letters[selected] = seed[positions[selected]]
+
+		rows, counts = self.inherited_mutation_rows(parent_ids)
+		owners = np.repeat(np.arange(len(parent_ids)), counts)
+		matches = (self.mutation_segments[rows] == segments[owners]) & \
+			(self.mutation_positions[rows] == positions[owners])
+		letters[owners[matches]] = self.mutation_letters[rows[matches]]
+
+		return letters
+
+	def generate_progeny_batched(self, num_viruses, creation_date):
+		"""
+		This method is the batched equivalent of generate_progeny. For a whole
+		generation, it draws
+
+		-	the parents and their burst sizes,
+		-	the number of mutations in each segment of each progeny,
+		-	the mutated positions, and
+		-	the new letters,
+
+		in a few NumPy calls, and then writes all of the progeny in bulk. The
+		progeny follow the same distributions as those of generate_progeny.
+
+		Returns: a detached population of progeny.
+		"""
+		if len(self) == 0:
+			return self.detached()
+
+		minimums = np.array([template.burst_size_range[0] for template in \
+			self.templates], dtype=np.int64)[self.template_indices]
+		maximums = np.array([template.burst_size_range[1] for template in \
+			self.templates], dtype=np.int64)[self.template_indices]
+
+		parents, burst_sizes = draw_parents(num_viruses, minimums, maximums, \
+			rng=self.rng)
+		parent_rows = np.repeat(parents, burst_sizes)
+		child_templates = self.template_indices[parent_rows]
+
+		children = [np.zeros(0, dtype=np.int64)]
+		segments = [np.zeros(0, dtype=np.int64)]
+		positions = [np.zeros(0, dtype=np.int64)]
+		for template_index in np.unique(child_templates):
+			template = self.templates[template_index]
+			template_children = np.nonzero(child_templates == template_index)[0]
+
+			for segment_number, segment in enumerate(template.segments):
+				p = float(segment.substitution_rate) / 365
+				num_positions = self.rng.binomial(segment.length, p, \
+					size=len(template_children))
+
+				owners, segment_positions = draw_mutation_positions( \
+					num_positions, segment.length, rng=self.rng)
+
+				children.append(template_children[owners])
+				segments.append(np.full(len(owners), segment_number, \
+					dtype=np.int64))
+				positions.append(segment_positions)
+
+		children = np.concatenate(children)
+		segments = np.concatenate(segments)
+		positions = np.concatenate(positions).astype(np.int64)
+
+		# Each new letter is chosen uniformly from the three letters that are 
+		# different from the parent's current letter.
+		letters = self.current_letters(self.ids[parent_rows[children]], \
+			child_templates[children], segments, positions)
+		shifts = self.rng.randint(1, 4, size=len(children))
+		new_letters = _NUCLEOTIDES[(_NUCLEOTIDE_INDICES[letters] + shifts) % 4]
+
+		return self.make_progeny(parent_rows, creation_date, \
+			(children, segments, positions, new_letters))
+
+	def view(self, index, host=None):
+		"""
+		This method materializes a Virus object for the virus at the specified
+		row index. The view is a copy; changes made to it are not written back
+		to the population.
+		"""
+		template = self.templates[self.template_indices[index]]
+
+		virus = copy(template)
+		virus.id = as_id(self.ids[index])
+		if self.parents[index] == -1:
+			virus.parent = None
+		else:
+			virus.parent = as_id(self.parents[index])
+		virus.creation_date = int(self.creation_dates[index])
+		virus.host = self.host if host is None else host
+
+		virus.segments = []
+		for segment, mutations in zip(template.segments, self.mutations(index)):
+			view_segment = copy(segment)
+			view_segment.mutations = mutations
+			virus.segments.append(view_segment)
+
+		return virus
+
+	def views(self, indices=None, host=None):
+		"""
+		This method materializes Virus objects for the viruses at the
+		specified row indices, or for all viruses if no indices are specified.
+		"""
+		if indices is None:
+			indices = range(len(self))
+
+		return [self.view(index, host=host) for index in indices]
+
+class GenotypePopulation(ArrayPopulation):
+	"""
+	The GenotypePopulation is a genotype-deduplicated ArrayPopulation. Most
+	progeny are genetically identical to their parent, so rather than storing
+	one row per viral particle, it stores one row per genotype (i.e. per set
+	of segment mutation maps, as created by replication), along with the
+	number of particles that carry it. Memory and time then scale with the
+	genetic diversity of the population rather than with its viral load.
+
+	Replication, immune removal, transmission bottlenecks and sampling all
+	act on the counts, through multinomial and (multivariate)
+	hypergeometric draws that follow the same distributions as drawing
+	individual particles.
+
+	Particles of the same genotype are indistinguishable: they share the ID
+	and creation date of the virus that founded the genotype, and only the
+	founding virus of each genotype is recorded in the Genealogy.
+
+	----------
+
+	ATTRIBUTES
+
+	- NUMPY ARRAY: counts
+		the number of particles of each genotype, in addition to the
+		attributes of ArrayPopulation.
+	"""
+
+	columns = ArrayPopulation.columns + ('counts',)
+
+	def __init__(self, host=None):
+		super(GenotypePopulation, self).__init__(host=host)
+
+		self.counts = np.zeros(0, dtype=np.int64)
+
+	def __repr__(self):
+		return "GenotypePopulation of %s viruses in %s genotypes" % \
+			(len(self), self.num_genotypes())
+
+	def __len__(self):
+		return int(self.counts.sum())
+
+	def __iter__(self):
+		for index in range(self.num_genotypes()):
+			for i in range(self.counts[index]):
+				yield self.view(index)
+
+	def num_genotypes(self):
+		"""
+		This method returns the number of distinct genotypes.
+		"""
+		return len(self.ids)
+
+	def row_counts(self, population):
+		"""
+		This method returns the particle counts of the rows of another
+		population. Rows that were added without counts (e.g. by add_virus,
+		or from an ArrayPopulation) hold one particle each.
+		"""
+		counts = getattr(population, 'counts', None)
+		if counts is None or len(counts) != len(population.ids):
+			counts = np.ones(len(population.ids), dtype=np.int64)
+
+		return counts
+
+	def extend(self, other):
+		"""
+		This method adds all of the viruses in another population. The counts
+		of genotypes that are already present are increased; new genotypes
+		are appended.
+		"""
+		counts = self.row_counts(other)
+
+		common, rows, other_rows = np.intersect1d(self.ids, other.ids, \
+			return_indices=True)
+		self.counts[rows] += counts[other_rows]
+
+		new_rows = np.ones(len(other.ids), dtype=bool)
+		new_rows[other_rows] = False
+		if np.any(new_rows):
+			new_genotypes = ArrayPopulation.select(other, np.nonzero(new_rows)[0])
+			super(GenotypePopulation, self).extend(new_genotypes)
+			self.counts = np.concatenate([self.counts, counts[new_rows]])
+
+	def select(self, indices):
+		population = super(GenotypePopulation, self).select(indices)
+		population.counts = self.counts[np.asarray(indices, dtype=np.int64)]
+
+		return population
+
+	def remove_indices(self, indices):
+		keep = np.ones(self.num_genotypes(), dtype=bool)
+		keep[np.asarray(indices, dtype=np.int64)] = False
+		counts = self.counts[keep]
+
+		super(GenotypePopulation, self).remove_indices(indices)
+		self.counts = counts
+
+	def random_indices(self, num_viruses):
+		"""
+		This method draws num_viruses particles uniformly at random without
+		replacement, and returns the genotype row of each of them, in random
+		order. Rows are repeated once per particle drawn from them.
+		"""
+		drawn = self.draw_counts(num_viruses)
+		rows = np.repeat(np.arange(self.num_genotypes()), drawn)
+
+		return self.rng.permutation(rows)
+
+	def draw_counts(self, num_viruses):
+		"""
+		This method draws num_viruses particles uniformly at random without
+		replacement, and returns the number drawn from each genotype. This is
+		a multivariate hypergeometric draw, made one genotype at a time.
+		"""
+		if num_viruses > len(self):
+			raise ValueError('Cannot choose more viruses than are present.')
+
+		drawn = np.zeros(self.num_genotypes(), dtype=np.int64)
+		remaining_sample = num_viruses
+		remaining_total = len(self)
+
+		for row in range(self.num_genotypes()):
+			if remaining_sample == 0:
+				break
+
+			good = self.counts[row]
+			bad = remaining_total - good
+			if bad == 0:
+				drawn[row] = remaining_sample
+			else:
+				drawn[row] = self.rng.hypergeometric(good, bad, remaining_sample)
+
+			remaining_sample -= drawn[row]
+			remaining_total -= good
+
+		return drawn
+
+	def particles(self):
+		"""
+		This method returns a detached ArrayPopulation with one row per
+		particle, i.e. with the row of each genotype repeated by its count, so
+		that the particles can be added to a host that does not keep counts.
+		"""
+		population = ArrayPopulation()
+		population.rng = self.rng
+		population.templates = self.templates
+		population.template_keys = self.template_keys
+
+		rows = np.repeat(np.arange(self.num_genotypes()), self.counts)
+		population.ids = self.ids[rows]
+		population.parents = self.parents[rows]
+		population.creation_dates = self.creation_dates[rows]
+		population.template_indices = self.template_indices[rows]
+
+		population.mutation_ids = self.mutation_ids
+		population.mutation_segments = self.mutation_segments
+		population.mutation_positions = self.mutation_positions
+		population.mutation_letters = self.mutation_letters
+
+		return population
+
+	def take_random(self, num_viruses):
+		drawn = self.draw_counts(num_viruses)
+		rows = np.nonzero(drawn)[0]
+
+		taken = self.select(rows)
+		taken.counts = drawn[rows]
+
+		self.counts = self.counts - drawn
+		self.remove_indices(np.nonzero(self.counts == 0)[0])
+
+		return taken
+
+	def burst_size_ranges(self):
+		"""
+		This method returns the minimum and maximum burst size of each
+		genotype.
+		"""
+		minimums = np.array([template.burst_size_range[0] for template in \
+			self.templates], dtype=np.int64)[self.template_indices]
+		maximums = np.array([template.burst_size_range[1] for template in \
+			self.templates], dtype=np.int64)[self.template_indices]
+
+		return minimums, maximums
+
+	def num_progeny_made(self):
+		num_parents = self.rng.randint(0, len(self) + 1)
+		drawn = self.draw_counts(num_parents)
+
+		minimums, maximums = self.burst_size_ranges()
+		made = 0
+		for row in np.nonzero(drawn)[0]:
+			made += self.rng.randint(minimums[row], maximums[row] + 1, \
+				size=drawn[row]).sum()
+
+		return int(made)
+
+	def make_progeny(self, parent_rows, creation_date, new_mutations):
+		progeny = super(GenotypePopulation, self).make_progeny(parent_rows, \
+			creation_date, new_mutations)
+		progeny.counts = np.ones(len(progeny.ids), dtype=np.int64)
+
+		return progeny
+
+	def draw_mutation_counts(self, template_index, num_children):
+		"""
+		This method draws the number of mutations in each segment of
+		num_children progeny of a template, conditional on each progeny
+		carrying at least one mutation.
+
+		The positions of all segments are treated as one run of Bernoulli
+		trials. The segment and position of the first mutation are drawn
+		from their conditional distribution; positions before it carry no
+		mutation, and positions after it are drawn unconditionally.
+
+		Returns: an integer matrix of shape (num_children, num_segments).
+		"""
+		segments = self.templates[template_index].segments
+		lengths = np.array([segment.length for segment in segments])
+		rates = np.array([float(segment.substitution_rate) / 365 for segment \
+			in segments])
+
+		# Probability that each segment carries at least one mutation, and
+		# that the first mutation falls in each segment.
+		any_mutation = 1 - (1 - rates) ** lengths
+		none_before = np.concatenate([[1], np.cumprod(1 - any_mutation)[:-1]])
+		first = none_before * any_mutation
+		first_segments = self.rng.choice(len(segments), size=num_children, \
+			p=first / first.sum())
+
+		# Position of the first mutation within its segment, by inverting the
+		# CDF of the geometric distribution truncated to the segment.
+		p = rates[first_segments]
+		u = self.rng.random_sample(num_children)
+		offsets = np.floor(np.log1p(-u * any_mutation[first_segments]) / \
+			np.log1p(-p)).astype(np.int64)
+		offsets = np.minimum(offsets, lengths[first_segments] - 1)
+
+		counts = np.zeros((num_children, len(segments)), dtype=np.int64)
+		rows = np.arange(num_children)
+		counts[rows, first_segments] = 1 + self.rng.binomial( \
+			lengths[first_segments] - offsets - 1, p)
+		for segment_number in range(len(segments)):
+			after = first_segments < segment_number
+			counts[after, segment_number] = self.rng.binomial( \
+				lengths[segment_number], rates[segment_number], size=after.sum())
+
+		return counts
+
+	def generate_progeny(self, num_viruses, creation_date):
+		"""
+		This method generates at least num_viruses progeny, following the
+		same distribution as ArrayPopulation.generate_progeny, but acting on
+		the genotype counts:
+
+		1.	Parents are drawn with probability proportional to the counts of
+			their genotypes.
+		2.	For each genotype, the number of progeny that carry at least one
+			mutation is drawn from a binomial distribution. The mutations of
+			those progeny are drawn conditional on there being at least one,
+			and each of them becomes a new genotype.
+		3.	The remaining progeny are added to the counts of their parents'
+			genotypes.
+
+		Returns: a detached GenotypePopulation of progeny.
+		"""
+		if len(self) == 0:
+			return self.detached()
+
+		minimums, maximums = self.burst_size_ranges()
+		weights = self.counts / float(self.counts.sum())
+		parents, burst_sizes = draw_parents(num_viruses, minimums, maximums, \
+			rng=self.rng, weights=weights)
+		num_children = np.bincount(parents, weights=burst_sizes, \
+			minlength=self.num_genotypes()).astype(np.int64)
+
+		return self.progeny_from_counts(num_children, creation_date)
+
+	def no_mutation_probabilities(self):
+		"""
+		This method returns the probability that a progeny of each genotype
+		carries no mutation.
+		"""
+		no_mutation = np.ones(len(self.templates))
+		for template_index, template in enumerate(self.templates):
+			for segment in template.segments:
+				p = float(segment.substitution_rate) / 365
+				no_mutation[template_index] *= (1 - p) ** segment.length
+
+		return no_mutation[self.template_indices]
+
+	def progeny_from_counts(self, num_children, creation_date):
+		"""
+		This method generates num_children[row] progeny of the genotype at
+		each row. The progeny that carry at least one mutation become new
+		genotypes; the others are returned as clones of their parents.
+
+		Returns: a detached GenotypePopulation of progeny.
+		"""
+		num_children = np.asarray(num_children, dtype=np.int64)
+		num_mutated = self.rng.binomial(num_children, \
+			1 - self.no_mutation_probabilities())
+
+		progeny = self.mutated_progeny(num_mutated, creation_date)
+
+		num_unmutated = num_children - num_mutated
+		rows = np.nonzero(num_unmutated)[0]
+		unmutated = self.select(rows)
+		unmutated.counts = num_unmutated[rows]
+		progeny.extend(unmutated)
+
+		return progeny
+
+	def mutated_progeny(self, num_mutated, creation_date):
+		"""
+		This method generates num_mutated[row] progeny of the genotype at
+		each row, each of which carries at least one new mutation.
+
+		Returns: a detached GenotypePopulation with one genotype per progeny.
+		"""
+		mutated_parents = np.repeat(np.arange(self.num_genotypes()), \
+			num_mutated)
+		mutated_templates = self.template_indices[mutated_parents]
+		children = [np.zeros(0, dtype=np.int64)]
+		segments = [np.zeros(0, dtype=np.int64)]
+		positions = [np.zeros(0, dtype=np.int64)]
+		for template_index in np.unique(mutated_templates):
+			template = self.templates[template_index]
+			template_children = np.nonzero(mutated_templates == \
+				template_index)[0]
+			counts = self.draw_mutation_counts(template_index, \
+				len(template_children))
+
+			for segment_number, segment in enumerate(template.segments):
+				owners, segment_positions = draw_mutation_positions( \
+					counts[:, segment_number], segment.length, rng=self.rng)
+
+				children.append(template_children[owners])
+				segments.append(np.full(len(owners), segment_number, \
+					dtype=np.int64))
+				positions.append(segment_positions)
+
+		children = np.concatenate(children)
+		segments = np.concatenate(segments)
+		positions = np.concatenate(positions).astype(np.int64)
+
+		letters = self.current_letters(self.ids[mutated_parents[children]], \
+			mutated_templates[children], segments, positions)
+		shifts = self.rng.randint(1, 4, size=len(children))
+		new_letters = _NUCLEOTIDES[(_NUCLEOTIDE_INDICES[letters] + shifts) % 4]
+
+		return self.make_progeny(mutated_parents, creation_date, \
+			(children, segments, positions, new_letters))
+
+	def grow(self, num_children, num_removed, creation_date):
+		"""
+		This method adds num_children[row] progeny to, and removes
+		num_removed[row] particles from, the genotype at each row, in place.
+		Unmutated progeny are added to the counts of their parents, so that
+		only the mutated progeny create new rows.
+		"""
+		num_children = np.asarray(num_children, dtype=np.int64)
+		num_mutated = self.rng.binomial(num_children, \
+			1 - self.no_mutation_probabilities())
+
+		progeny = None
+		if np.any(num_mutated):
+			progeny = self.mutated_progeny(num_mutated, creation_date)
+
+		self.counts = self.counts + num_children - num_mutated - num_removed
+		if not np.all(self.counts):
+			self.remove_indices(np.nonzero(self.counts == 0)[0])
+
+		if progeny is not None:
+			ArrayPopulation.extend(self, progeny)
+			self.counts = np.concatenate([self.counts, progeny.counts])
+
+	def generate_progeny_batched(self, num_viruses, creation_date):
+		"""
+		The progeny of a GenotypePopulation are always generated in batches.
+		"""
+		return self.generate_progeny(num_viruses, creation_date)
+
+	def views(self, indices=None, host=None):
+		"""
+		This method materializes one Virus object per particle of the
+		genotypes at the specified row indices, or of all genotypes if no
+		indices are specified.
+		"""
+		if indices is None:
+			indices = range(self.num_genotypes())
+
+		return [self.view(index, host=host) for index in indices for i in \
+			range(self.counts[index])]
@@ -1,6 +1,7 @@
 from environment import Environment
 from random import sample, randint
 from numpy.random import normal, binomial
+import numpy as np
 from Bio import SeqIO
 from Bio.SeqRecord import SeqRecord
 from Bio.Seq import Seq
@@ -30,7 +31,7 @@ class Sampler(object):
 	viruses present. In other words, we are assuming perfect sequencing of the 
 	sampled virus population.
 	"""
-	def __init__(self, environment):
+	def __init__(self, environment, sink=None):
 		super(Sampler, self).__init__() 
 		self.sampled_viruses = []
 		self.environment = environment
@@ -39,6 +40,26 @@ class Sampler(object):
 
 		self.sampled_hosts = []
 
+		# An optional FastaSink, to which sampled viruses are streamed.
+		self.sink = sink
+
+		self.rng = np.random
+
+	def set_sink(self, sink):
+		"""
+		This method sets the FastaSink to which the sequences of sampled 
+		viruses are written as they are sampled. Setting it to None stops 
+		the streaming.
+		"""
+		self.sink = sink
+
+	def close(self):
+		"""
+		This method flushes and closes the sink, if there is one.
+		"""
+		if self.sink is not None:
+			self.sink.close()
+
 
 	def sample_viruses(self, host, mean=10, stdev=2):
 		"""
@@ -57,9 +78,13 @@ class Sampler(object):
 				the host and a list of the sampled viruses 
 			-	if the Host is not infectious, we will return a tuple 
 				containing the host and an empty list.
+
+		If the Sampler has a sink, the sampled viruses are also streamed to 
+		its per-segment FASTA files.
 		"""
 		# Check that host is a Host type
 		from host import Host
+		from population import ArrayPopulation
 
 		if isinstance(host, Host):
 			# Check if the host is infectious
@@ -67,14 +92,10 @@ class Sampler(object):
 
 				# Guarantee that the number of viruses sampled is fewer than 
 				# the number of viruses present in the host.
-				num_viruses = len(host.viruses) + 1
-				while num_viruses > len(host.viruses):
-					num_viruses = int(normal(mean, stdev))
+				num_viruses = self.draw_sample_sizes([len(host.viruses)], \
+					mean, stdev)[0]
 
-				# Sample viruses from the host, and remove them from the host.
-				sampled_viruses = sample(host.viruses, num_viruses)
-				host.remove_viruses(sampled_viruses)
-				return (host, sampled_viruses)
+				return (host, self.remove_sample(host, num_viruses))
 
 			if not host.is_infectious():
 				return (host, [])
@@ -82,6 +103,74 @@ class Sampler(object):
 		else:
 			raise TypeError("A Host object must be specified")
 
+	def draw_sample_sizes(self, loads, mean=10, stdev=2):
+		"""
+		This method draws the number of viruses to sample from each of a 
+		number of hosts with the specified viral loads, all at once. Each 
+		size is int(Normal(mean, stdev)), truncated to the viral load of its 
+		host: sizes that exceed it are drawn again, as in sample_viruses, but 
+		only the rejected sizes are redrawn at each round. Negative sizes are 
+		set to 0.
+		"""
+		loads = np.asarray(loads, dtype=np.int64)
+		sizes = np.zeros(len(loads), dtype=np.int64)
+
+		rejected = np.arange(len(loads))
+		while len(rejected) > 0:
+			sizes[rejected] = self.rng.normal(mean, stdev, \
+				size=len(rejected)).astype(np.int64)
+			rejected = rejected[sizes[rejected] > loads[rejected]]
+
+		return np.maximum(sizes, 0)
+
+	def remove_sample(self, host, num_viruses):
+		"""
+		This method removes num_viruses viruses, chosen at random, from a host 
+		in one bulk removal, and returns them as a list of Virus objects. 
+		Virus objects are only materialized for the sampled viruses.
+		"""
+		from population import ArrayPopulation
+
+		sampled_viruses = host.remove_random_viruses(num_viruses)
+		if isinstance(sampled_viruses, ArrayPopulation):
+			sampled_viruses = sampled_viruses.views(host=host)
+		if self.sink is not None:
+			self.sink.write_viruses(sampled_viruses)
+
+		return sampled_viruses
+
+	def sample_environment(self, fraction=0.1, mean=10, stdev=2):
+		"""
+		This method runs one round of a surveillance campaign over the whole 
+		environment: each host is contacted with probability fraction, and 
+		viruses are sampled from each contacted host that is infectious, 
+		following the same rules as sample_viruses.
+
+		Only the infected hosts of the environment are visited; the sample 
+		sizes of all of the contacted hosts are drawn at once with 
+		draw_sample_sizes, and the viruses are removed from each host in bulk.
+
+		Returns: a list of (host, sampled viruses) tuples, one per contacted 
+		infectious host.
+		"""
+		if fraction < 0 or fraction > 1:
+			raise ValueError('The fraction must be between 0 and 1!')
+
+		# Contacting an uninfected host yields no viruses, so only the 
+		# infected hosts need to be drawn.
+		infected = self.environment.infected_hosts()
+		contacted = self.rng.random_sample(len(infected)) < fraction
+		hosts = [host for host, is_contacted in zip(infected, contacted) if \
+			is_contacted and host.is_infectious()]
+
+		sizes = self.draw_sample_sizes([len(host.viruses) for host in hosts], \
+			mean, stdev)
+
+		samples = [(host, self.remove_sample(host, num_viruses)) for host, \
+			num_viruses in zip(hosts, sizes)]
+
+		return samples
+
 	# def SampleVirusesFromEnvironment(self, environment, n):
 	# 	"""
 	# 	This method takes in an Environment and samples n viruses from 
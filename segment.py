@@ -1,6 +1,51 @@
 from random import choice, random, randint, sample
-from sequence import Sequence
+from sequence import Sequence, count_differences
+from copy import copy
+from functools import lru_cache
 from numpy.random import binomial
+from sequence_cache import SequenceCache
+
+import numpy as np
+
+# The number of pairs of seed sequences whose Hamming distances are cached. 
+# Seeds are shared by all of the descendants of a virus, so there are usually 
+# only a handful of distinct pairs; the cap bounds the cache when there are 
+# many founders.
+SEED_DISTANCE_CACHE_SIZE = 4096
+
+# The cache of computed segment sequences. Entries are keyed by the Segment 
+# object and its version, which Segment.mutate increments, so a segment that 
+# is changed in place never serves a stale sequence. All of the computed 
+# sequences live in this cache, so its cap bounds their memory.
+sequence_cache = SequenceCache()
+
+def seed_distance(sequence1, sequence2):
+	"""
+	This function returns the Hamming distance between two seed Sequence 
+	objects of equal length. Distances between different seeds are computed 
+	once, from their packed bytes, and then cached.
+	"""
+	if sequence1 is sequence2 or sequence1 == sequence2:
+		return 0
+
+	# The distance is symmetric, so each pair is cached once, in a canonical 
+	# order. The cache is keyed by the packed bytes rather than the Sequence 
+	# objects, so that it does not keep the seeds alive.
+	packed1 = sequence1.packed.tobytes()
+	packed2 = sequence2.packed.tobytes()
+	if packed2 < packed1:
+		packed1, packed2 = packed2, packed1
+
+	return _packed_distance(packed1, packed2)
+
+@lru_cache(maxsize=SEED_DISTANCE_CACHE_SIZE)
+def _packed_distance(packed1, packed2):
+	"""
+	This function returns the Hamming distance between two packed sequences, 
+	given as bytes. Only the most recently used pairs are cached.
+	"""
+	return count_differences(np.frombuffer(packed1, dtype=np.uint8), \
+		np.frombuffer(packed2, dtype=np.uint8))
 
 class Segment(object):
 	"""
@@ -22,14 +67,29 @@ class Segment(object):
 		a floating point number that describes the mutation rate of the virus.
 		The units of this number are: substitutions per site per year.
 
+	- INTEGER: version
+		the number of times that the segment has been mutated in place. The 
+		segment's computed sequence is cached in the module's sequence_cache 
+		under (segment, version).
+
 	----------
 
 	MAIN METHODS 
 
 	- Mutate: 
 		a method that mutates the segment according to its mutation rate.
+
+	- Replicate:
+		a method that returns the segment to be given to a progeny virus. 
 		This method is called upon by the Virus object each time it 
-		replicates.
+		replicates. Segments are shared between parent and progeny until a 
+		mutation actually happens (copy-on-write), so a segment must not be 
+		mutated in place once it may be shared.
+
+	- hamming_distance:
+		a method that computes the Hamming distance to another segment from 
+		the mutation dictionaries of both segments, without computing either 
+		sequence.
 
 	The other methods written in this class are helper methods or syntactic 
 	sugar for reducing the number of lines of code, to help with readability.
@@ -47,7 +107,9 @@ class Segment(object):
 
 		self.mutations = dict()
 
-		self.length = len(self.compute_sequence())
+		self.version = 0
+
+		self.length = len(self.seed_sequence)
 
 		self.substitution_rate = None
 		self.set_substitution_rate(substitution_rate)
@@ -85,29 +147,119 @@ class Segment(object):
 	def compute_sequence(self):
 		"""
 		This method computes the segment's sequence by comparing the seed 
-		sequence with the mutation dictionary.
+		sequence with the mutation dictionary. 
+
+		The sequence is computed by patching the mutated positions into a 
+		copy of the seed sequence, and is then cached in the module's 
+		sequence_cache, which holds at most sequence_cache.max_bytes 
+		nucleotides.
 		"""
-		sequence = ''
+		key = (self, self.version)
 
-		for i, letter in enumerate(self.seed_sequence.__repr__()):
-			if i in self.mutations.keys():
-				sequence += self.mutations[i]
-			else:
-				sequence += letter
+		sequences = sequence_cache.get(key)
+		if sequences is None:
+			sequences = [self.patch_sequence(self.seed_sequence.sequence, \
+				self.mutations)]
+			sequence_cache.put(key, sequences)
+
+		return sequences[0]
+
+	def patch_sequence(self, sequence, mutations):
+		"""
+		This method returns a copy of a sequence, with the letters at the 
+		positions in the mutations dictionary replaced.
+		"""
+		letters = list(sequence)
+		for position, letter in mutations.items():
+			letters[position] = letter
+
+		return ''.join(letters)
+
+	def hamming_distance(self, other):
+		"""
+		This method computes the Hamming distance between this segment and 
+		another segment of the same length.
+
+		Only the positions present in either mutation dictionary can differ 
+		from the distance between the two seed sequences, so the cost is 
+		proportional to the number of mutations rather than to the length of 
+		the segment.
+
+		INPUTS:
+		-	other: the Segment object to compare against.
+		"""
+		if not isinstance(other, Segment):
+			raise TypeError('A Segment object must be specified!')
+
+		seed1 = self.seed_sequence
+		seed2 = other.seed_sequence
+
+		if len(seed1) != len(seed2):
+			raise ValueError('The two segments must be of equal length.')
+
+		distance = seed_distance(seed1, seed2)
+
+		positions = set(self.mutations.keys()).union(other.mutations.keys())
+		for position in positions:
+			letter1 = self.mutations.get(position, seed1[position])
+			letter2 = other.mutations.get(position, seed2[position])
+
+			# Replace the seed-to-seed difference at this position with the 
+			# difference between the mutated letters.
+			if letter1 != letter2:
+				distance += 1
+			if seed1[position] != seed2[position]:
+				distance -= 1
 
-		return sequence
+		return distance
 
-	def mutate(self):
+	def num_positions_to_mutate(self):
+		"""
+		This method uses the length of the segment and the segment's mutation 
+		rate to draw the number of positions that will be mutated in one 
+		replication.
+		"""
+		n = self.length
+		p = float(self.substitution_rate) / 365
+
+		return binomial(n,p)
+
+	def replicate(self):
+		"""
+		This method returns the segment that a progeny virus inherits. 
+
+		Most replications do not mutate a segment, in which case the segment 
+		itself is returned and shared between the parent and the progeny. 
+		Otherwise, a shallow copy is returned that shares the seed sequence, 
+		and only the mutation dictionary is copied before it is changed.
+		"""
+		num_positions = self.num_positions_to_mutate()
+
+		if num_positions == 0:
+			return self
+
+		segment = copy(self)
+		segment.mutate(num_positions=num_positions)
+
+		return segment
+
+	def mutate(self, num_positions=None):
 		"""
 		This method uses the length of the segment and the segment's mutation 
 		rate to identify the number of positions that will be mutated. It then
 		chooses that many positions at random, and records the mutation in the
 		segment's mutation dictionary.
+
+		If num_positions is specified, exactly that many positions are mutated.
+
+		The mutation dictionary is replaced by a new one rather than changed in 
+		place, so that segments that share a dictionary are not affected.
 		"""
-		n = self.length
-		p = float(self.substitution_rate) / 365
+		if num_positions is None:
+			num_positions = self.num_positions_to_mutate()
 
-		num_positions = binomial(n,p)
+		if num_positions == 0:
+			return
 
 		def choose_positions(start, end, num_positions):
 			"""
@@ -124,8 +276,7 @@ class Segment(object):
 			"""
 			return sample(range(start, end), num_positions)
 
-		positions = choose_positions(0, len(self.compute_sequence()), \
-			num_positions)
+		positions = choose_positions(0, self.length, num_positions)
 
 		def choose_new_letter(letter):
 			"""
@@ -141,13 +292,27 @@ class Segment(object):
 
 			return new_letter
 
+		mutations = dict(self.mutations)
+		new_letters = dict()
 		for position in positions:
-			if position in self.mutations.keys():
-				letter = self.mutations[position]
+			if position in mutations.keys():
+				letter = mutations[position]
 			else:
-				letter = self.seed_sequence.sequence[position]
+				letter = self.seed_sequence[position]
+
+			mutations[position] = choose_new_letter(letter)
+			new_letters[position] = mutations[position]
+
+		self.mutations = mutations
 
-			self.mutations[position] = choose_new_letter(letter)
+		# The cached sequence of the previous version, if any, is patched and 
+		# stored under the new version.
+		sequences = sequence_cache.get((self, self.version))
+		sequence_cache.discard((self, self.version))
+		self.version += 1
+		if sequences is not None:
+			sequence_cache.put((self, self.version), \
+				[self.patch_sequence(sequences[0], new_letters)])
 
 			# Note: this mutational simulation process allows the virus to 
 			# back-mutate. In this case, we consider the back-mutation to
@@ -1,4 +1,87 @@
-from random import choice, random, randint, sample
+import numpy as np
+
+# Each nucleotide is stored as a 2-bit code, four to a byte, with the first
+# nucleotide in the two highest bits of the first byte.
+LETTERS = 'ACGT'
+
+# Lookup tables between 2-bit codes and ASCII codes.
+ASCII_CODES = np.frombuffer(LETTERS.encode('ascii'), dtype=np.uint8)
+NUCLEOTIDE_CODES = np.full(256, 255, dtype=np.uint8)
+NUCLEOTIDE_CODES[ASCII_CODES] = np.arange(len(LETTERS), dtype=np.uint8)
+
+def pack_codes(codes):
+	"""
+	This function packs an array of 2-bit nucleotide codes, or a matrix with
+	one sequence of codes per row, into bytes, four nucleotides to a byte.
+	Rows are padded with zero bits to a whole number of bytes.
+	"""
+	codes = np.asarray(codes, dtype=np.uint8)
+	bits = np.stack([codes >> 1, codes & 1], axis=-1)
+	bits = bits.reshape(codes.shape[:-1] + (2 * codes.shape[-1],))
+
+	return np.packbits(bits, axis=-1)
+
+def unpack_codes(packed, length):
+	"""
+	This function unpacks the first length nucleotides of a packed array (or
+	of each row of a packed matrix) into 2-bit nucleotide codes.
+	"""
+	packed = np.asarray(packed, dtype=np.uint8)
+	bits = np.unpackbits(packed, axis=-1)[..., :2 * length]
+	bits = bits.reshape(packed.shape[:-1] + (length, 2))
+
+	return (bits[..., 0] << 1) | bits[..., 1]
+
+def encode_letters(sequence):
+	"""
+	This function returns the 2-bit codes of the letters of a string. A
+	ValueError is raised if the string contains letters other than ACGT.
+	"""
+	letters = np.frombuffer(sequence.encode('ascii'), dtype=np.uint8)
+	codes = NUCLEOTIDE_CODES[letters]
+	if np.any(codes == 255):
+		raise ValueError('The sequence must only contain the letters ACGT!')
+
+	return codes
+
+def count_differences(packed1, packed2):
+	"""
+	This function returns the number of positions at which two packed
+	sequences of equal length differ, without unpacking them: a position
+	differs if either bit of its 2-bit code differs. The zero padding never
+	differs.
+	"""
+	different = np.bitwise_xor(packed1, packed2)
+	different = (different | (different >> 1)) & 0x55
+
+	return int(np.unpackbits(different).sum())
+
+def random_packed(num_sequences, length, rng=np.random):
+	"""
+	This function draws num_sequences random sequences of the specified
+	length, with independent and uniformly distributed letters, as a matrix
+	of packed bytes with one row per sequence. Every 2-bit code of a random
+	byte is uniform, so the bytes are drawn directly, and only the padding
+	bits of the last byte of each row are cleared.
+	"""
+	num_bytes = (length + 3) // 4
+	packed = rng.randint(0, 256, size=(num_sequences, num_bytes)).astype( \
+		np.uint8)
+
+	num_padding_bits = 8 * num_bytes - 2 * length
+	if num_padding_bits > 0:
+		packed[:, -1] &= (0xFF << num_padding_bits) & 0xFF
+
+	return packed
+
+def generate_sequences(num_sequences, length, rng=np.random):
+	"""
+	This function generates num_sequences random Sequence objects of the
+	specified length in one bulk draw.
+	"""
+	packed = random_packed(num_sequences, length, rng=rng)
+
+	return [Sequence.from_packed(row, length) for row in packed]
 
 class Sequence(object):
 	"""
@@ -12,43 +95,157 @@ class Sequence(object):
 	Note that when a virus replicates, the full sequence object is not copied 
 	for each of its segments; rather, each segment only keeps track of the 
 	mutations that have happened.
+
+	The sequence is stored packed, with 2 bits per nucleotide, i.e. a quarter
+	of the memory of a string. Single letters are read directly from the
+	packed bytes; the string is only built when it is asked for, and is then
+	kept along with the hash until the sequence is changed.
+
+	Only the letters ACGT can be packed, so other letters (e.g. ambiguity
+	codes such as N) are rejected with a ValueError.
+
+	----------
+
+	ATTRIBUTES
+
+	- NUMPY UINT8 ARRAY: packed
+		the packed sequence, four nucleotides to a byte.
+
+	- INTEGER: length
+		the number of nucleotides in the sequence.
+
+	- STRING: cached_string, INTEGER: cached_hash
+		the string and the hash of the sequence, or None until they are first
+		asked for.
 	"""
 	def __init__(self, length=1000, sequence=None):
 		"""
-		Initialize the sequence with a random sequence of length 10 if 
-		sequence is not specified.
+		Initialize the sequence with a random sequence of the specified length
+		if sequence is not specified.
 
 		Otherwise, initialize sequence with a sequence that is specified. 
 		"""
 		super(Sequence, self).__init__()
 
-		self.sequence = None
+		self.packed = None
+		self.length = None
+		self.clear_cache()
 
-		if sequence == None:
-			self.sequence = self.generate_sequence(length)
+		if sequence is None:
+			self.generate_sequence(length)
 		else:
-			self.sequence = None
 			self.set_sequence(sequence)
 
+	@classmethod
+	def from_packed(cls, packed, length):
+		"""
+		This method returns a Sequence that stores the specified packed bytes,
+		without copying them.
+		"""
+		sequence = cls.__new__(cls)
+		sequence.packed = np.asarray(packed, dtype=np.uint8)
+		sequence.length = length
+		sequence.clear_cache()
+
+		return sequence
+
+	def clear_cache(self):
+		"""
+		This method discards the cached string and hash, which must be done
+		whenever the packed bytes are changed.
+		"""
+		self.cached_string = None
+		self.cached_hash = None
+
 	def __repr__(self):
 		return self.sequence
-		
-	def generate_sequence(self, length):
+
+	def __str__(self):
+		return self.sequence
+
+	def __len__(self):
+		return self.length
+
+	def __getitem__(self, position):
+		"""
+		This method returns the letter at a position, read from its byte.
+		"""
+		if position < 0:
+			position += self.length
+		if position < 0 or position >= self.length:
+			raise IndexError('The position is out of range!')
+
+		code = (int(self.packed[position >> 2]) >> \
+			(6 - 2 * (position & 3))) & 3
+
+		return LETTERS[code]
+
+	def __eq__(self, other):
+		if not isinstance(other, Sequence):
+			return NotImplemented
+
+		return self.length == other.length and \
+			np.array_equal(self.packed, other.packed)
+
+	def __ne__(self, other):
+		equal = self.__eq__(other)
+		if equal is NotImplemented:
+			return equal
+
+		return not equal
+
+	def __hash__(self):
+		if self.cached_hash is None:
+			self.cached_hash = hash((self.length, self.packed.tobytes()))
+
+		return self.cached_hash
+
+	@property
+	def sequence(self):
+		"""
+		The sequence as a string.
+		"""
+		if self.cached_string is None:
+			self.cached_string = self.ascii_codes().tobytes().decode('ascii')
+
+		return self.cached_string
+
+	def codes(self):
+		"""
+		This method returns the 2-bit codes (0 to 3, for ACGT) of the
+		nucleotides as a NumPy array, which can be used in place of ASCII codes
+		by the distance functions of network_reconstructor.
+		"""
+		return unpack_codes(self.packed, self.length)
+
+	def ascii_codes(self):
+		"""
+		This method returns the ASCII codes of the nucleotides as a NumPy
+		array.
+		"""
+		return ASCII_CODES[self.codes()]
+
+	def generate_sequence(self, length, rng=np.random):
 		"""
 		This method will generate a sequence, and set the Sequence object's 
 		sequence to that sequence.
 		"""
-		sequence = ''
-		for i in range(length):
-			letter = choice(['A', 'T', 'G', 'C'])
-			sequence += letter
-		return sequence
+		self.packed = random_packed(1, length, rng=rng)[0]
+		self.length = length
+		self.clear_cache()
 
 	def set_sequence(self, sequence):
-		"""Setter method for a segment's sequence."""
-
-		if isinstance(seuqence, str):
-			self.sequence = sequence
+		"""
+		Setter method for a segment's sequence. A ValueError is raised if a
+		string contains letters other than ACGT.
+		"""
+		if isinstance(sequence, Sequence):
+			self.packed = sequence.packed
+			self.length = sequence.length
+		elif isinstance(sequence, str):
+			self.packed = pack_codes(encode_letters(sequence))
+			self.length = len(sequence)
 		else:
 			raise TypeError('A string must be specified!')
 
+		self.clear_cache()
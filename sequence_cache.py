@@ -0,0 +1,106 @@
+from collections import OrderedDict
+
+class SequenceCache(object):
+	"""
+	The SequenceCache is a least-recently-used (LRU) cache of materialized 
+	viral sequences, with a cap on the total number of nucleotides (bytes) 
+	that it holds. When the cap is exceeded, the least recently used entries 
+	are evicted first.
+
+	----------
+
+	ATTRIBUTES
+
+	- INTEGER: max_bytes
+		the maximum number of nucleotides held by the cache.
+
+	- INTEGER: num_bytes
+		the number of nucleotides currently held by the cache.
+
+	- FUNCTION: on_evict
+		an optional function that is called with the key and the value of 
+		every entry that is evicted.
+	"""
+
+	def __init__(self, max_bytes=100 * 2 ** 20, on_evict=None):
+		super(SequenceCache, self).__init__()
+
+		self.max_bytes = max_bytes
+		self.num_bytes = 0
+
+		self.on_evict = on_evict
+
+		self.entries = OrderedDict()
+
+	def __repr__(self):
+		return "SequenceCache with %s entries (%s of %s bytes)" % \
+			(len(self.entries), self.num_bytes, self.max_bytes)
+
+	def __len__(self):
+		return len(self.entries)
+
+	def __contains__(self, key):
+		return key in self.entries
+
+	def discard(self, key):
+		"""
+		This method removes the entry stored under a key, if there is one, 
+		without calling on_evict.
+		"""
+		if key in self.entries:
+			self.num_bytes -= self.size_of(self.entries.pop(key))
+
+	def size_of(self, sequences):
+		"""
+		This method returns the number of nucleotides in a list of sequences.
+		"""
+		return sum(len(sequence) for sequence in sequences)
+
+	def get(self, key):
+		"""
+		This method returns the sequences stored under a key, and marks them as 
+		the most recently used. If the key is not present, None is returned.
+		"""
+		if key not in self.entries:
+			return None
+
+		sequences = self.entries.pop(key)
+		self.entries[key] = sequences
+
+		return sequences
+
+	def put(self, key, sequences):
+		"""
+		This method stores a list of sequences under a key, and then evicts 
+		the least recently used entries until the cache is within its cap. 
+		Lists of sequences that are larger than the cap are not stored.
+		"""
+		if key in self.entries:
+			self.num_bytes -= self.size_of(self.entries.pop(key))
+
+		size = self.size_of(sequences)
+		if size > self.max_bytes:
+			return
+
+		self.entries[key] = sequences
+		self.num_bytes += size
+
+		while self.num_bytes > self.max_bytes:
+			self.evict()
+
+	def evict(self):
+		"""
+		This method evicts the least recently used entry.
+		"""
+		key, sequences = self.entries.popitem(last=False)
+		self.num_bytes -= self.size_of(sequences)
+
+		if self.on_evict is not None:
+			self.on_evict(key, sequences)
+
+	def clear(self):
+		"""
+		This method evicts all entries.
+		"""
+		while len(self.entries) > 0:
+			self.evict()
@@ -0,0 +1,185 @@
+import numpy as np
+
+from population import GenotypePopulation
+
+class TauLeapingEngine(object):
+	"""
+	The TauLeapingEngine advances the within-host dynamics of a Host in 
+	continuous time, using tau-leaping rather than one replication cycle per 
+	generation. It acts on the genotype counts of a GenotypePopulation, so 
+	that the cost of a leap scales with the number of genotypes, not with the 
+	number of viral particles.
+
+	Over a leap of length tau, for each genotype g with x_g particles:
+
+	-	the number of particles cleared by the immune system is 
+		Binomial(x_g, 1 - S), where S = exp(-integral of clearance_rate over 
+		the leap) is the probability of surviving the leap,
+	-	the number of progeny that are born and survive during the leap is 
+		Poisson(x_g * S * (exp(birth_rate_g * tau) - 1)), so that the 
+		expected number of particles at the end of the leap is exact for any 
+		tau, and
+	-	the progeny are split into unmutated clones and mutated progeny, each 
+		of which founds a new genotype, with the same mutation distribution 
+		as in replication.
+
+	The rates are chosen so that the expected growth over each generation 
+	matches that of Host.allow_one_cycle_of_replication: on average, half of 
+	the particles replicate, and a fraction immune_removal_probability() of 
+	the parents and of the progeny is cleared, evaluated at the time at the 
+	end of the generation. Therefore, over the generation (t - 1, t],
+
+		birth_rate_g = log(1 + mean_burst_size_g / 2)
+		clearance_rate = -log(1 - immune_removal_probability(t))
+
+	i.e. the clearance rate is constant within each generation, and steps up 
+	from one generation to the next.
+
+	The survival of each generation is then exactly that of the discrete 
+	model, and the expected births match Host.num_progeny_leftover. The 
+	discrete model does, however, round the progeny up to whole bursts (see 
+	Host.generate_viral_progeny), which the engine does not, so at small 
+	viral loads the discrete model grows faster than the engine.
+
+	The step size is adapted with the method of Cao, Gillespie & Petzold 
+	(2006): tau is the largest step over which the expected change, and the 
+	standard deviation of the change, of every genotype count are bounded by 
+	epsilon times that count (or by one particle, for small counts). Leaps 
+	do not cross the boundaries between generations, so the clearance rate 
+	is constant over each leap.
+
+	----------
+
+	ATTRIBUTES
+
+	- FLOAT: epsilon
+		the accuracy knob. Smaller values give smaller leaps, which are more 
+		accurate and slower; as epsilon goes to 0, the engine approaches an 
+		exact stochastic simulation. Values between 0.01 and 0.05 are 
+		typical. Since the expected counts are exact for any leap, larger 
+		values (up to about 0.5) mainly coarsen the timing of new mutations 
+		and the variance of the counts.
+
+	- FLOAT: max_step
+		the largest leap that is ever taken, in generations.
+	"""
+
+	def __init__(self, epsilon=0.03, max_step=1.0):
+		super(TauLeapingEngine, self).__init__()
+
+		if not 0 < epsilon < 1:
+			raise ValueError('epsilon must be between 0 and 1!')
+
+		self.epsilon = epsilon
+		self.max_step = max_step
+
+	def __repr__(self):
+		return "TauLeapingEngine with epsilon %s" % self.epsilon
+
+	def birth_rates(self, population):
+		"""
+		This method returns the per-particle birth rate of each genotype.
+		"""
+		minimums, maximums = population.burst_size_ranges()
+		mean_burst_sizes = (minimums + maximums) / 2.0
+
+		return np.log1p(mean_burst_sizes / 2.0)
+
+	def generation_end(self, time):
+		"""
+		This method returns the end of the generation that contains the 
+		specified time, i.e. the integer t such that t - 1 <= time < t.
+		"""
+		return np.floor(time) + 1
+
+	def clearance_rate(self, host, time):
+		"""
+		This method returns the per-particle immune clearance rate of the host 
+		at the specified time, which is set by the immune removal probability 
+		at the end of its generation.
+		"""
+		p = host.immune_removal_probability(self.generation_end(time))
+
+		return -np.log1p(-p)
+
+	def cumulative_clearance(self, host, start, end):
+		"""
+		This method returns the integral of the clearance rate of the host 
+		between the specified times, generation by generation. Over a whole 
+		generation, it is -log(1 - immune_removal_probability(t)), so the 
+		probability of surviving the generation is that of 
+		Host.num_parental_removed.
+		"""
+		total = 0.0
+		time = start
+		while time < end:
+			step_end = min(end, self.generation_end(time))
+			total += (step_end - time) * self.clearance_rate(host, time)
+			time = step_end
+
+		return total
+
+	def select_step(self, counts, birth_rates, clearance_rate):
+		"""
+		This method returns the largest leap that keeps the relative change of 
+		every genotype count within epsilon.
+		"""
+		counts = counts.astype(float)
+		bounds = np.maximum(self.epsilon * counts, 1)
+		means = np.abs(birth_rates - clearance_rate) * counts
+		variances = (birth_rates + clearance_rate) * counts
+
+		with np.errstate(divide='ignore'):
+			tau = min(np.min(bounds / means), np.min(bounds ** 2 / variances))
+
+		return min(tau, self.max_step)
+
+	def leap(self, host, time, tau, birth_rates):
+		"""
+		This method advances the population of the host by one leap of length 
+		tau.
+		"""
+		population = host.viruses
+
+		survival = np.exp(-self.cumulative_clearance(host, time, time + tau))
+
+		num_cleared = population.rng.binomial(population.counts, 1 - survival)
+		num_children = population.rng.poisson(population.counts * survival * \
+			np.expm1(birth_rates * tau))
+
+		population.grow(num_children, num_cleared, \
+			host.environment.current_time)
+
+	def advance(self, host, duration=1):
+		"""
+		This method advances the within-host dynamics of the host over the 
+		last duration generations, i.e. from current_time - duration (or from 
+		the last infection of the host, if that is later) to the current time 
+		of its environment. It stops early if the host is cleared of viruses 
+		or dies.
+
+		Returns: the number of leaps that were taken.
+		"""
+		if not isinstance(host.viruses, GenotypePopulation):
+			raise ValueError('Tau-leaping requires a genotype-deduplicated '
+				'population!')
+
+		end = host.environment.current_time
+		time = max(end - duration, max(host.infection_history.keys()))
+		num_leaps = 0
+
+		while time < end and len(host.viruses) > 0 and not host.is_dead():
+			birth_rates = self.birth_rates(host.viruses)
+			clearance_rate = self.clearance_rate(host, time)
+
+			tau = self.select_step(host.viruses.counts, birth_rates, \
+				clearance_rate)
+			tau = min(tau, end - time, self.generation_end(time) - time)
+
+			self.leap(host, time, tau, birth_rates)
+			time += tau
+			num_leaps += 1
+
+		host.update_state()
+
+		return num_leaps
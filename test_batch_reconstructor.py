@@ -0,0 +1,44 @@
+import os
+import pickle
+import shutil
+
+import pytest
+
+pytest.importorskip('Bio')
+
+from batch_reconstructor import reconstruct_run, reconstruct_runs, \
+	run_filenames, is_up_to_date
+
+FIXTURE_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), \
+	'Simulated Sequences')
+
+def test_reconstruct_run_smoke(tmp_path):
+	"""
+	Reconstruct one small simulated run, and check that both gpickles are
+	written and that the run is then up to date.
+	"""
+	sequence_directory = str(tmp_path / 'sequences')
+	network_directory = str(tmp_path / 'networks')
+	os.makedirs(sequence_directory)
+	os.makedirs(network_directory)
+
+	inputs, outputs = run_filenames(0, sequence_directory, network_directory)
+	for filename in inputs:
+		shutil.copy(os.path.join(FIXTURE_DIRECTORY, \
+			os.path.basename(filename)), filename)
+
+	run_number, wall_time = reconstruct_run((0, inputs, outputs, 1, None))
+	assert run_number == 0
+
+	with open(outputs[0], 'rb') as handle:
+		G_all = pickle.load(handle)
+	with open(outputs[1], 'rb') as handle:
+		G_null = pickle.load(handle)
+
+	assert G_all.number_of_edges() > 0
+	assert G_null.number_of_edges() == G_all.number_of_edges()
+	assert set(G_null.nodes()) == set(G_all.nodes())
+	assert is_up_to_date(inputs, outputs)
+
+	assert reconstruct_runs(sequence_directory, network_directory, \
+		run_numbers=range(1), num_workers=1) == dict()
@@ -1,15 +1,21 @@
 from random import random, randint, choice
-from segment import Segment
+from segment import Segment, sequence_cache
+from sequence import generate_sequences
 from copy import deepcopy, copy
 from host import Host
 from datetime import datetime
 from joblib import Parallel, delayed
 from id_generator import generate_id
+from genealogy import genealogy_of
 from multiprocessing import Pool
 from time import time
 import ctypes
 
 import hashlib
+import numpy as np
+
+# The default length of a segment, in nucleotides.
+SEGMENT_LENGTH = 1800
 
 def _replicate(virus):
 	"""
@@ -18,6 +24,28 @@ def _replicate(virus):
 	"""
 	return virus.replicate()
 
+def pairwise_hamming_distances(viruses):
+	"""
+	This function computes the matrix of Hamming distances between all pairs 
+	of viruses in a list, summed over all of their segments.
+
+	The distances are computed from the segments' mutation dictionaries (see 
+	Virus.hamming_distance), so neither the viral sequences nor any FASTA 
+	files are needed.
+
+	Returns: a symmetric NumPy integer matrix of shape (n, n).
+	"""
+	num_viruses = len(viruses)
+	distances = np.zeros((num_viruses, num_viruses), dtype=np.int64)
+
+	for i in range(num_viruses):
+		for j in range(i + 1, num_viruses):
+			distance = viruses[i].hamming_distance(viruses[j])
+			distances[i, j] = distance
+			distances[j, i] = distance
+
+	return distances
+
 class Virus(object):
 	"""
 	The Virus class is at the third highest level in the viral simulator. The 
@@ -67,6 +95,10 @@ class Virus(object):
 	 	a method that returns a list of progeny that were replicated out of the
 	 	virus.
 
+	- hamming_distance:
+	 	a method that returns the Hamming distance to another virus, computed 
+	 	from the mutation dictionaries of the segments.
+
 	The methods described above are the main and important methods; the other
 	methods in this class are mostly helper methods that do getting/setting of 
 	attributes (with type checking for setters).
@@ -79,7 +111,7 @@ class Virus(object):
 		"""
 		super(Virus, self).__init__()
 
-		self.id = generate_id()
+		self.id = generate_id(self)
 
 		self.parent = None
 
@@ -91,7 +123,6 @@ class Virus(object):
 			raise TypeError('A Host object must be specified!')
 		else:
 			self.host = host
-			host.add_virus(self)
 
 		self.burst_size_range = None
 		self.set_burst_size_range(burst_size_range)
@@ -99,6 +130,14 @@ class Virus(object):
 		self.replication_time = None
 		self.set_replication_time(replication_time)
 
+		genealogy = genealogy_of(host)
+		if genealogy is not None:
+			genealogy.record_virus(self)
+
+		# The virus is added to the host last, so that a host that keeps its 
+		# viruses in an ArrayPopulation can record all of its attributes.
+		host.add_virus(self)
+
 
 	def __repr__(self):
 		return str(self.id)
@@ -115,19 +154,39 @@ class Virus(object):
 	def sequence(self):
 		"""
 		This method returns the sequence of each of the segments of the virus.
+
+		Repeated calls are served from segment.sequence_cache, which holds at 
+		most sequence_cache.max_bytes nucleotides, and whose entries follow 
+		changes made to the segments in place.
 		"""
 		sequences = [segment.compute_sequence() for segment in self.segments]
 
 		return sequences
 
+	def hamming_distance(self, other):
+		"""
+		This method returns the Hamming distance between this virus and 
+		another virus, summed over all segments. The cost is proportional to 
+		the number of mutations, not to the genome length.
+		"""
+		if len(self.segments) != len(other.segments):
+			raise ValueError('The two viruses must have the same number of segments.')
+
+		distance = sum(segment.hamming_distance(other_segment) for segment, \
+			other_segment in zip(self.segments, other.segments))
+
+		return distance
+
 	def mutate(self):
 		"""
 		This method will mutate all of the viral segments according to their 
 		specified substitution rates.
-		"""
 
-		for segment in self.segments:
-			segment.mutate()
+		Segments may be shared with other viruses (see Segment.replicate), so 
+		each segment is replaced by its mutated copy rather than being mutated 
+		in place.
+		"""
+		self.segments = [segment.replicate() for segment in self.segments]
 
 	def burst_size(self):
 		"""
@@ -152,7 +211,9 @@ class Virus(object):
 
 	def replicate(self):
 		"""
-		This method returns a deep copy of the virus chosen to replicate.
+		This method returns a copy of the virus chosen to replicate. The 
+		segments are shared with the parent until they mutate, so only the 
+		segments that actually mutate are copied (see Segment.replicate).
 
 		mutate is guaranteed to be called, but not guaranteed to happen. 
 		Whether a mutation occurs or not depends on the mutation rate of the 
@@ -166,15 +227,19 @@ class Virus(object):
 		new_virus = copy(self)
 		new_virus.creation_date = self.host.environment.current_time
 		new_virus.parent = self.id
-		new_virus.id = generate_id()
-		new_virus.segments = deepcopy(self.segments)
+		new_virus.id = generate_id(new_virus)
+		new_virus.segments = list(self.segments)
 		new_virus.mutate()
 
+		genealogy = genealogy_of(self.host)
+		if genealogy is not None:
+			genealogy.record_virus(new_virus, parent_segments=self.segments)
+
 		return new_virus
 
 
 	def generate_segment(self, segment_number, substitution_rate=7E-3, \
-		sequence=None, length=1800):
+		sequence=None, length=SEGMENT_LENGTH):
 		"""
 		This method creates a segment with the parameters passed in.
 		"""
@@ -187,7 +252,10 @@ class Virus(object):
 		"""
 		This method generates the specified number of segments.
 		"""
-		segments = [self.generate_segment(i) for i in range(num_segments)]
+		# The seed sequences of all of the segments are drawn at once.
+		seeds = generate_sequences(num_segments, SEGMENT_LENGTH)
+		segments = [self.generate_segment(i, sequence=seed) for i, seed in \
+			enumerate(seeds)]
 
 		# for i in range(num_segments):
 		# 	segments.append(self.generate_segment(segment_number=i))